@@ -2,71 +2,241 @@
 Check Data midi files is or not have music
 """
 import torch
+import torch.nn.functional as F
 import numpy as np
 import os
+import random
+import contextlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import Dataset
 from music21 import converter, stream, instrument, stream, note, tempo, midi
-from grammar import unparse_grammar
-from qa import prune_grammar, prune_notes, clean_up_notes
+from grammar import unparse_grammar, scale_tone_ratio
+from qa import build_prune_tables, prune_grammar_ids, prune_note_events, clean_up_note_events, take_metrics, score_take
+from model import beam_search, build_grammar_mask
+import events
+import score
+import smf
 
-def check_data(data_file):
-    midi_data = converter.parse(data_file)
+def check_data(data_file, use_mmap=False):
+    """
+    打印 MIDI 文件中每个轨道 (Part) 的概况，用来决定 get_musical_data 的轨道索引。
+    直接读取 MIDI 事件 (见 score.py)，不经过 converter.parse。
+
+    Parameters:
+    data_file (str): MIDI 文件路径
+    use_mmap (bool): 以内存映射方式读取文件
+
+    Return:
+    midi_data (score.Score): 解析结果 (midi_data.parts 与 converter.parse(...).parts 一一对应)
+    """
+    midi_data = score.read_score(data_file, use_mmap=use_mmap)
 
     print("\n--- 自动化轨道检查 ---")
 
-    # midi_data.parts 是访问所有轨道的标准方式
+    # midi_data.parts 与 converter.parse 得到的 parts 顺序相同 (没有音符的轨道不算 Part)
     print(f"文件总共有 {len(midi_data.parts)} 个轨道 (Parts)。")
 
     # 遍历所有轨道
     for i, part in enumerate(midi_data.parts):
-        print(f"\n--- 轨道 {i} ('midi_data[{i}]') ---")
+        print(f"\n--- 轨道 {i} ('midi_data.parts[{i}]') ---")
         
-        # 2.1 尝试获取这个轨道的乐器名称
-        # .getInstrument() 是一个好用的函数
-        inst = part.getInstrument()
-        if inst:
-            print(f"  乐器: {inst.instrumentName}")
+        # 2.1 尝试获取这个轨道的乐器名称 (轨道名，没有时使用音色号对应的乐器)
+        if part.name:
+            print(f"  乐器: {part.name}")
+        elif part.program is not None:
+            print(f"  乐器: {instrument.instrumentFromMidiProgram(part.program).instrumentName}")
         else:
             print("  乐器: 未指定")
             
-        # 2.2 查看这个轨道里包含哪些类型的 '元素'
-        # .classes 会告诉你这个轨道里有什么 (Note, Chord, Voice...)
-        print(f"  包含的元素类型: {part.classes}")
+        # 2.2 查看这个轨道里包含哪些类型的音符 (Note, Chord, Unpitched...)
+        kinds = Counter(e.kind for m in part.measures for e in m.elements if e.kind in score.NOTE_KINDS)
+        kinds.update(x.kind for m in part.measures for v in m.voices() for x in v.elements)
+        names = {score.KIND_REST: 'Rest', score.KIND_NOTE: 'Note', score.KIND_CHORD: 'Chord',
+                 score.KIND_UNPITCHED: 'Unpitched', score.KIND_PERCUSSION: 'PercussionChord'}
+        print(f"  包含的元素类型: {', '.join(f'{names[k]} x {n}' for k, n in sorted(kinds.items()))}")
+        print(f"  MIDI 音符数: {part.num_notes}, 通道: {part.channels}, 小节数: {len(part.measures)}")
         
         # 2.3 专门检查它是否包含 'Voice' (这正是你出错的地方)
-        # 这等价于 deepjazz 脚本中的 .getElementsByClass(stream.Voice)
-        voices = part.getElementsByClass(stream.Voice)
+        # 有重叠音符的小节会被分成多个声部 (同 music21 的 makeVoices)
+        num_voiced = sum(m.has_voices() for m in part.measures)
         
-        print(f"  找到 'stream.Voice' 对象的数量: {len(voices)}, 轨道{i}")
+        print(f"  包含 'stream.Voice' 的小节数: {num_voiced}, 轨道{i}")
 
-def generate_music(model, 
-                           indices_val, 
-                           original_chords_stream, 
-                           n_values, 
-                           n_a, 
-                           Ty_per_measure=50, 
-                           temperature=0.0,
-                           device='cuda'):
+    return midi_data
+
+def __token_durations(indices_val, n_values, device):
     """
+    辅助函数：每个 token 的时值 (quarterLength) 表，用于按小节长度提前结束解码。
+    token 的格式为 '类型,时值[,音程]'，无法解析的 token (例如 '<unk>') 时值记为 0。
+
+    Return:
+    durations (torch.Tensor): (n_values,) float64
+    """
+    durations = np.zeros(n_values, dtype=np.float64)
+    for idx, token in indices_val.items():
+        try:
+            durations[idx] = float(token.split(',')[1])
+        except (IndexError, ValueError):
+            pass
+    return torch.tensor(durations, dtype=torch.float64, device=device)
+
+def __decode_measures(model,
+                      num_measures,
+                      n_values,
+                      n_a,
+                      Ty_per_measure,
+                      temperature,
+                      measures_per_batch,
+                      device,
+                      stop_durations=None,
+                      measure_lengths=None,
+                      decode_kwargs=None,
+                      beam_width=1):
+    """
+    辅助函数：把多个小节拼成一个 batch，通过 model.generate (或 beam_search) 一次性解码。
+
     Parameters:
-    model: trained Pytorch_models
-    indices_val (dict): 索引 -> Token (来自 get_corpus_data)
-    original_chords_stream (stream.Stream): 原始伴奏 (来自 get_musical_data)
-    n_values (int): 词汇表大小 (例如 78)
-    n_a (int): 隐藏层维度 (例如 64)
-    Ty_per_measure (int): 为每个小节生成多少个 token
-    temperature (float): 采样温度 (0.0 = argmax，复现原始逻辑)
-    device (str): 'cuda' 或 'cpu'
+    num_measures (int): 需要解码的小节数
+    measures_per_batch (int): 每个 batch 包含多少个小节 (None 或 <= 0 = 全部)
+    stop_durations (torch.Tensor): token 时值表 (None = 每个小节固定解码 Ty_per_measure 个 token)
+    measure_lengths (list[float]): 每个小节的长度，给出 stop_durations 时，
+                                   每个小节在累计时值填满小节后各自结束
+    decode_kwargs (dict): 传给 model.generate 的 top_k / top_p / grammar_mask (见 __decode_kwargs)
+    beam_width (int): > 1 时用 beam search 解码 (忽略 temperature/top_k/top_p)
+
+    Return:
+    generated (np.ndarray): (num_measures, 步数) 的 token 索引，顺序与小节一致，
+                            提前结束的小节在末尾用 -1 填充
     """
-    
-    print("开始生成音乐...")
-    model.eval() # 确保模型处于评估模式
-    
-    # 1. 初始化空的输出流
-    out_stream = stream.Stream()
-    curr_offset = 0.0
+    if not measures_per_batch or measures_per_batch <= 0:
+        measures_per_batch = num_measures
+
+    generated = []
+    for start in range(0, num_measures, measures_per_batch):
+        batch_size = min(measures_per_batch, num_measures - start)
+
+        # 为生成器准备初始输入 (batch_size 个小节)
+        x_initializer = torch.zeros(batch_size, n_values, device=device)
+        a_initializer = torch.zeros(batch_size, n_a, device=device)
+        c_initializer = torch.zeros(batch_size, n_a, device=device)
+
+        stop_kwargs = {}
+        if stop_durations is not None:
+            stop_kwargs['stop_durations'] = stop_durations
+            stop_kwargs['stop_at'] = torch.tensor(measure_lengths[start:start + batch_size],
+                                                  dtype=torch.float64, device=device)
+
+        with torch.inference_mode():
+            if beam_width > 1:
+                generated_sequence_tensor = beam_search(
+                    model,
+                    x_initializer,
+                    a_initializer,
+                    c_initializer,
+                    Ty=Ty_per_measure,
+                    beam_width=beam_width,
+                    grammar_mask=(decode_kwargs or {}).get('grammar_mask'),
+                    **stop_kwargs
+                )[0]
+            else:
+                generated_sequence_tensor = model.generate(
+                    x_initializer,
+                    a_initializer,
+                    c_initializer,
+                    Ty=Ty_per_measure,
+                    temperature=temperature, # 0.0 复现原始的 argmax
+                    **stop_kwargs,
+                    **(decode_kwargs or {})
+                )
+
+        generated.append(generated_sequence_tensor.to('cpu').numpy())
+
+    # 各个 batch 提前结束的步数可能不同，用 -1 补齐成一个数组
+    width = max(batch.shape[1] for batch in generated)
+    generated_indices = np.full((num_measures, width), -1, dtype=np.int64)
+    start = 0
+    for batch in generated:
+        generated_indices[start:start + len(batch), :batch.shape[1]] = batch
+        start += len(batch)
+
+    return generated_indices
+
+def __decode_kwargs(indices_val, n_values, device, top_k, top_p, constrained):
+    """
+    辅助函数：model.generate 的解码选项。只放入非默认值，这样不支持这些参数的旧解码器
+    (例如之前 export_decoder 保存的 TorchScript 文件) 在默认设置下仍然可以使用。
+
+    Return:
+    decode_kwargs (dict): top_k / top_p / grammar_mask 中需要传入的部分
+    """
+    decode_kwargs = {}
+    if top_k:
+        decode_kwargs['top_k'] = top_k
+    if top_p < 1.0:
+        decode_kwargs['top_p'] = top_p
+    if constrained:
+        decode_kwargs['grammar_mask'] = build_grammar_mask(indices_val, n_values, device)
+    return decode_kwargs
+
+def __prune_measures(generated_indices, prune_tables, seeds):
+    """
+    辅助函数：在 token 索引上完成 A/X -> C 替换与时值取整 (prune_grammar)，
+    整批小节一次 NumPy 查表，只在这里生成语法字符串。
+
+    Parameters:
+    generated_indices (np.ndarray): (小节数, 步数) 的 token 索引 (-1 为填充)
+    prune_tables (np.ndarray): qa.build_prune_tables 的结果
+    seeds (list[int]): 每个小节的随机种子 (None = 使用全局 random 的状态)
+
+    Return:
+    grammars (list[str]): 每个小节的语法字符串
+    """
+    if seeds is None:
+        rng = None
+    else:
+        rng = [np.random.default_rng(measure_seed) for measure_seed in seeds]
+    return prune_grammar_ids(generated_indices, prune_tables, rng)
 
-    # 2. 将原始伴奏流按小节切分
-    # 我们使用 .makeMeasures()，这比原版脚本中的 group 逻辑更健壮
+def __unparse_measure(task):
+    """
+    辅助函数：对单个小节的语法字符串进行反解析与 QA。
+    定义在模块顶层，以便 ProcessPoolExecutor 在子进程中调用。
+
+    Parameters:
+    task (tuple): (predicted_grammar_str, curr_chords_measure, measure_seed)，
+                  语法字符串已经由 __prune_measures 完成后处理
+
+    Return:
+    sounds (np.ndarray): 小节内的旋律事件数组 (见 events.py)，offset 相对于小节开头
+    """
+    predicted_grammar_str, curr_chords_measure, measure_seed = task
+    if measure_seed is not None:
+        random.seed(measure_seed)
+
+    # c. 反解析 (Unparsing)：将语法字符串转换为旋律事件数组
+    # 我们使用当前小节的和弦 (curr_chords_measure) 作为上下文
+    # 事件数组不创建 music21 对象，跨进程传递时也只需序列化一块连续内存
+    try:
+        sounds = unparse_grammar(predicted_grammar_str, curr_chords_measure, as_events=True)
+    except Exception as e:
+        # print(f"警告：反解析语法时出错: {e}。跳过此小节。")
+        sounds = events.make_events() # 创建一个空数组以跳过
+
+    # d. 质量保证 (QA)
+    sounds = prune_note_events(sounds)
+    sounds = clean_up_note_events(sounds)
+
+    return sounds
+
+def __split_measures(original_chords_stream):
+    """
+    辅助函数：将原始伴奏流按小节切分。
+    我们使用 .makeMeasures()，这比原版脚本中的 group 逻辑更健壮
+
+    Return:
+    accompaniment_measures (stream.Stream): 伴奏小节 (出错或没有小节时返回 None)
+    """
     try:
         accompaniment_measures = original_chords_stream.makeMeasures()
         num_measures = len(accompaniment_measures)
@@ -80,74 +250,551 @@ def generate_music(model,
         print("错误：伴奏流不包含任何小节。")
         return None
 
-    # 3. 循环遍历每个小节，为其生成新的旋律
-    for i in range(num_measures):
-        curr_chords_measure = accompaniment_measures[i]
-
-        # a. 为生成器准备初始输入 (batch_size=1)
-        x_initializer = torch.zeros(1, n_values).to(device)
-        a_initializer = torch.zeros(1, n_a).to(device)
-        c_initializer = torch.zeros(1, n_a).to(device)
-
-        # b. 生成一个 token 序列
-        with torch.no_grad():
-            generated_sequence_tensor = model.generate(
-                x_initializer, 
-                a_initializer, 
-                c_initializer, 
-                Ty=Ty_per_measure,
-                temperature=temperature # 0.0 复现原始的 argmax
-            )
-        
-        # c. 将 Tensor 转换为 token 索引列表
-        generated_indices = generated_sequence_tensor.to('cpu').numpy().squeeze().tolist()
-        # ----------------------------------------------------
-        
-        # d. 解码：将索引列表转换回语法字符串
-        pred_tokens = [indices_val[idx] for idx in generated_indices]
-        predicted_grammar_str = ' '.join(pred_tokens)
-        
-        # e. 后处理 (Post-processing)，同 data_utils.py
-        predicted_grammar_str = predicted_grammar_str.replace(' A',' C').replace(' X',' C')
-        predicted_grammar_str = prune_grammar(predicted_grammar_str)
+    return accompaniment_measures
 
-        # f. 反解析 (Unparsing)：将语法字符串转换为 music21 音符
-        # 我们使用当前小节的和弦 (curr_chords_measure) 作为上下文
-        try:
-            sounds = unparse_grammar(predicted_grammar_str, curr_chords_measure)
-        except Exception as e:
-            # print(f"警告：在小节 {i} 反解析语法时出错: {e}。跳过此小节。")
-            sounds = [] # 创建一个空列表以跳过
+def __assemble_music(all_sounds, accompaniment_events, measure_lengths, return_stream):
+    """
+    辅助函数：按小节顺序拼接旋律与伴奏，写入 output/my_music.midi。
+
+    Parameters:
+    all_sounds (list[np.ndarray]): 每个小节的旋律事件数组 (offset 相对于小节开头)
+    accompaniment_events (list[list]): 每个小节的 (offset, 伴奏元素)，在反解析之前记录
+    measure_lengths (list[float]): 每个小节的长度
+    return_stream (bool): 同 generate_music
+
+    Return:
+    同 generate_music
+    """
+    num_measures = len(all_sounds)
+    out_stream = stream.Stream()
+    curr_offset = 0.0
 
-        # g. 质量保证 (QA)
-        sounds = prune_notes(sounds)
-        sounds = clean_up_notes(sounds)
+    # 按小节顺序拼接新生成的旋律 (sounds) 和原始伴奏
+    melody_events = []
+    accompaniment = []
+    for i in range(num_measures):
+        sounds = all_sounds[i]
 
         if len(sounds)>0:
             print(f"小节 {i+1}/{num_measures}: 生成了 {len(sounds)} 个音符事件。")
 
-        # h. 将新生成的旋律 (sounds) 和原始伴奏 (curr_chords_measure) 插入到输出流
-        for m in sounds:
-            out_stream.insert(curr_offset + m.offset, m)
-        for mc in curr_chords_measure.notesAndRests: # 只插入音符和休止符
-            out_stream.insert(curr_offset + mc.offset, mc)
+        melody_events.append(events.shift_events(sounds, curr_offset))
+        for offset, mc in accompaniment_events[i]:
+            accompaniment.append((curr_offset + offset, mc))
             
-        # i. 更新偏移量，准备下一个小节
-        curr_offset += curr_chords_measure.duration.quarterLength
+        # 更新偏移量，准备下一个小节
+        curr_offset += measure_lengths[i]
 
-    # 4. 设置速度并保存 MIDI 文件
-    out_stream.insert(0.0, tempo.MetronomeMark(number=130)) # 同原版
-    
+    melody_events = np.concatenate(melody_events) if melody_events else events.make_events()
+    # makeMeasures 会在小节线处把伴奏拆成连音，写 MIDI 前合并回一个音
+    chord_events = events.from_music21(accompaniment, merge_ties=True)
+
+    # 设置速度并保存 MIDI 文件 (直接编码事件数组，不经过 music21 Stream)
     # 确保 output 文件夹存在
     if not os.path.exists("output"):
         os.makedirs("output")
         
     file_path = "output/my_music.midi"
-    mf = midi.translate.streamToMidiFile(out_stream)
-    mf.open(file_path, 'wb')
-    mf.write()
-    mf.close()
+    # 数组的顺序相当于插入 Stream 的顺序：offset 相同时旋律在伴奏之前 (同原版)
+    smf.write_midi(file_path, [melody_events, chord_events], bpm=130) # 同原版
     
     print(f"音乐生成完毕！已保存至: {file_path}")
+
+    if not return_stream:
+        return np.concatenate([melody_events, chord_events])
+
+    # 旋律只在需要返回 Stream 时才转换为 music21 音符
+    for offset, m in events.to_music21(melody_events):
+        out_stream.insert(offset, m)
+    for offset, mc in accompaniment:
+        out_stream.insert(offset, mc)
+    out_stream.insert(0.0, tempo.MetronomeMark(number=130)) # 同原版
+    
+    return out_stream
+
+def generate_music(model, 
+                           indices_val, 
+                           original_chords_stream, 
+                           n_values, 
+                           n_a, 
+                           Ty_per_measure=50, 
+                           temperature=0.0,
+                           device='cuda',
+                           measures_per_batch=None,
+                           workers=None,
+                           seed=None,
+                           early_stop=False,
+                           return_stream=True,
+                           top_k=0,
+                           top_p=1.0,
+                           beam_width=1,
+                           constrained=False):
+    """
+    Parameters:
+    model: trained Pytorch_models (也可以是 model.script_decoder / load_decoder 得到的 TorchScript 解码器)
+    indices_val (dict): 索引 -> Token (来自 get_corpus_data)
+    original_chords_stream (stream.Stream): 原始伴奏 (来自 get_musical_data)
+    n_values (int): 词汇表大小 (例如 78)
+    n_a (int): 隐藏层维度 (例如 64)
+    Ty_per_measure (int): 为每个小节生成多少个 token (early_stop=True 时为上限)
+    temperature (float): 采样温度 (0.0 = argmax，复现原始逻辑)
+    device (str): 'cuda' 或 'cpu'
+    measures_per_batch (int): 每次批量解码多少个小节 (None = 所有小节一次解码,
+                              1 = 逐小节解码，同原版)
+    workers (int): 反解析/QA 使用的进程数 (None 或 1 = 串行)
+    seed (int): 反解析的随机种子，小节 i 使用 seed + i (None = 不重设随机状态)
+    early_stop (bool): True = 按 token 时值累计，小节填满后就停止解码该小节，
+                       不再生成 (并反解析) 超出小节长度的多余 token
+    return_stream (bool): True = 同时构建并返回 music21 Stream (同原版);
+                          False = 只写 MIDI 文件，返回整首曲子的事件数组 (旋律 + 伴奏)
+    top_k (int): temperature > 0 时只在概率最高的 k 个 token 中采样 (0 = 不限制)
+    top_p (float): temperature > 0 时的 nucleus 采样阈值 (1.0 = 不限制)
+    beam_width (int): > 1 时每个小节用 beam search 解码，取对数概率最高的序列
+                      (代替 argmax/采样，忽略 temperature/top_k/top_p)
+    constrained (bool): True = 解码时屏蔽语法上无效的 token (见 model.build_grammar_mask)，
+                        避免在反解析/QA 中丢弃的 token 浪费解码步数
+    """
     
-    return out_stream
\ No newline at end of file
+    print("开始生成音乐...")
+    model.eval() # 确保模型处于评估模式
+
+    # 1. 将原始伴奏流按小节切分
+    accompaniment_measures = __split_measures(original_chords_stream)
+    if accompaniment_measures is None:
+        return None
+    num_measures = len(accompaniment_measures)
+    measure_lengths = [m.duration.quarterLength for m in accompaniment_measures]
+
+    # 2. 批量解码：一次性为多个小节生成 token 序列
+    # 每个小节的初始输入/状态都是零向量，彼此独立，因此可以拼成一个 batch
+    stop_durations = __token_durations(indices_val, n_values, device) if early_stop else None
+    decode_kwargs = __decode_kwargs(indices_val, n_values, device, top_k, top_p, constrained)
+    all_generated_indices = __decode_measures(model,
+                                              num_measures,
+                                              n_values,
+                                              n_a,
+                                              Ty_per_measure,
+                                              temperature,
+                                              measures_per_batch,
+                                              device,
+                                              stop_durations,
+                                              measure_lengths,
+                                              decode_kwargs,
+                                              beam_width)
+
+    # 3. 对解码结果逐小节进行后处理、反解析与 QA
+    # 每个小节使用独立的随机种子 (seed + i)，因此并行与串行的结果完全一致
+    if workers is not None and workers > 1 and seed is None:
+        seed = random.randrange(2**32)
+
+    measure_seeds = None if seed is None else [seed + i for i in range(num_measures)]
+
+    # 后处理 (A/X -> C 替换、时值取整) 直接在 token 索引上批量完成
+    prune_tables = build_prune_tables(indices_val, n_values)
+    grammars = __prune_measures(all_generated_indices, prune_tables, measure_seeds)
+
+    tasks = []
+    for i in range(num_measures):
+        measure_seed = None if measure_seeds is None else measure_seeds[i]
+        tasks.append((grammars[i], accompaniment_measures[i], measure_seed))
+
+    # 在反解析之前记录伴奏的偏移量与时长 (unparse_grammar 可能会修改和弦的 offset)
+    accompaniment_events = [[(mc.offset, mc) for mc in m.notesAndRests] # 只插入音符和休止符
+                            for m in accompaniment_measures]
+
+    if workers is not None and workers > 1:
+        print(f"使用 {workers} 个进程并行反解析...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, num_measures // (workers * 4))
+            all_sounds = list(executor.map(__unparse_measure, tasks, chunksize=chunksize))
+    else:
+        all_sounds = [__unparse_measure(task) for task in tasks]
+
+    # 4. 拼接旋律与伴奏，写 MIDI 文件
+    return __assemble_music(all_sounds, accompaniment_events, measure_lengths, return_stream)
+
+def __unparse_takes(task):
+    """
+    辅助函数：反解析一个小节的所有候选 (take) 并打分，只返回得分最高的一个。
+    定义在模块顶层，以便 ProcessPoolExecutor 在子进程中调用；
+    每个小节的和弦只传给子进程一次，落选的 take 不会传回主进程。
+
+    Parameters:
+    task (tuple): (grammars, curr_chords_measure, take_seeds, measure_length)，
+                  grammars 是该小节每个 take 的语法字符串，take_seeds 是对应的随机种子 (或 None)
+
+    Return:
+    sounds (np.ndarray): 得分最高的 take 的旋律事件数组
+    scores (np.ndarray): 每个 take 的分数 (见 qa.score_take)
+    """
+    grammars, curr_chords_measure, take_seeds, measure_length = task
+
+    best_sounds = None
+    scores = np.empty(len(grammars), dtype=np.float64)
+    for k, grammar in enumerate(grammars):
+        take_seed = None if take_seeds is None else take_seeds[k]
+        sounds = __unparse_measure((grammar, curr_chords_measure, take_seed))
+
+        pitch_range, density = take_metrics(sounds, measure_length)
+        scale_ratio = scale_tone_ratio(curr_chords_measure, sounds)
+        scores[k] = score_take(scale_ratio, pitch_range, density)
+        if best_sounds is None or scores[k] > scores[:k].max():
+            best_sounds = sounds
+
+    return best_sounds, scores
+
+def generate_music_takes(model,
+                         indices_val,
+                         original_chords_stream,
+                         n_values,
+                         n_a,
+                         num_takes=4,
+                         temperatures=(1.0,),
+                         Ty_per_measure=50,
+                         device='cuda',
+                         measures_per_batch=None,
+                         workers=None,
+                         seed=None,
+                         early_stop=False,
+                         return_stream=True,
+                         top_k=0,
+                         top_p=1.0,
+                         constrained=False):
+    """
+    一次生成多个候选 (take) 并自动挑选：每个小节解码 num_takes 个变体，
+    用廉价的数组指标 (音阶音比例、音域、音符密度，见 qa.score_take) 打分，
+    每个小节只保留得分最高的 take 写入 MIDI (以及转换为 music21)。
+
+    代替手动多次调用 generate_music 再逐个试听：伴奏只 makeMeasures 一次，
+    所有小节的所有 take 拼成一个 batch 一次解码 (每种温度一次)。
+
+    Parameters:
+    (model ~ n_a、Ty_per_measure ~ constrained 同 generate_music)
+    num_takes (int): 每个小节的候选数
+    temperatures (tuple[float]): take k 使用 temperatures[k % len(temperatures)]，
+                                 相同温度的 take 在同一次调用中解码；
+                                 温度为 0.0 (argmax) 的 take 解码结果相同，只解码一次，
+                                 之后共用 (各 take 只在反解析的随机种子上不同)
+    seed (int): 随机种子。解码前用 seed 重设 torch 的随机状态 (在 fork_rng 中进行，
+                不影响调用方的全局随机状态)，所以同样的 seed、temperatures 与
+                measures_per_batch 得到同样的 take；反解析时小节 i 的 take k
+                使用 seed + i * num_takes + k。
+                (同一温度的 take 在一个 batch 中一起采样，无法给每个 take 单独的 Generator)
+
+    Return:
+    result: 同 generate_music (Stream 或事件数组，只包含每个小节得分最高的 take)
+    take_scores (np.ndarray): (小节数, num_takes) 每个 take 的分数
+    """
+    print(f"开始生成音乐 (每个小节 {num_takes} 个候选)...")
+    model.eval() # 确保模型处于评估模式
+
+    # 1. 将原始伴奏流按小节切分 (只做一次)
+    accompaniment_measures = __split_measures(original_chords_stream)
+    if accompaniment_measures is None:
+        return None, None
+    num_measures = len(accompaniment_measures)
+    measure_lengths = [m.duration.quarterLength for m in accompaniment_measures]
+
+    # 2. 批量解码：同一温度的所有小节 x take 拼成一个 batch
+    stop_durations = __token_durations(indices_val, n_values, device) if early_stop else None
+    decode_kwargs = __decode_kwargs(indices_val, n_values, device, top_k, top_p, constrained)
+    take_temperatures = [temperatures[k % len(temperatures)] for k in range(num_takes)]
+
+    take_indices = [None] * num_takes
+    with torch.random.fork_rng() if seed is not None else contextlib.nullcontext():
+        if seed is not None:
+            torch.manual_seed(seed)
+        for temperature in dict.fromkeys(take_temperatures):
+            takes = [k for k in range(num_takes) if take_temperatures[k] == temperature]
+            # argmax 的 take 彼此相同，只解码一份
+            num_copies = 1 if temperature == 0.0 else len(takes)
+            generated = __decode_measures(model,
+                                          num_measures * num_copies,
+                                          n_values,
+                                          n_a,
+                                          Ty_per_measure,
+                                          temperature,
+                                          measures_per_batch,
+                                          device,
+                                          stop_durations,
+                                          measure_lengths * num_copies,
+                                          decode_kwargs)
+            for j, k in enumerate(takes):
+                copy = j % num_copies
+                take_indices[k] = generated[copy * num_measures:(copy + 1) * num_measures]
+
+    # 各次调用提前结束的步数可能不同，用 -1 补齐后按 (小节, take) 排列
+    width = max(indices.shape[1] for indices in take_indices)
+    all_generated_indices = np.full((num_measures, num_takes, width), -1, dtype=np.int64)
+    for k, indices in enumerate(take_indices):
+        all_generated_indices[:, k, :indices.shape[1]] = indices
+    all_generated_indices = all_generated_indices.reshape(num_measures * num_takes, width)
+
+    # 3. 后处理、反解析与打分，每个小节只保留得分最高的 take
+    if workers is not None and workers > 1 and seed is None:
+        seed = random.randrange(2**32)
+
+    take_seeds = None if seed is None else [seed + i for i in range(num_measures * num_takes)]
+
+    prune_tables = build_prune_tables(indices_val, n_values)
+    grammars = __prune_measures(all_generated_indices, prune_tables, take_seeds)
+
+    tasks = []
+    for i in range(num_measures):
+        rows = slice(i * num_takes, (i + 1) * num_takes)
+        tasks.append((grammars[rows], accompaniment_measures[i],
+                      None if take_seeds is None else take_seeds[rows], measure_lengths[i]))
+
+    # 在反解析之前记录伴奏的偏移量与时长 (unparse_grammar 可能会修改和弦的 offset)
+    accompaniment_events = [[(mc.offset, mc) for mc in m.notesAndRests] # 只插入音符和休止符
+                            for m in accompaniment_measures]
+
+    if workers is not None and workers > 1:
+        print(f"使用 {workers} 个进程并行反解析...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, num_measures // (workers * 4))
+            results = list(executor.map(__unparse_takes, tasks, chunksize=chunksize))
+    else:
+        results = [__unparse_takes(task) for task in tasks]
+
+    all_sounds = [sounds for sounds, scores in results]
+    take_scores = np.stack([scores for sounds, scores in results])
+    chosen = np.argmax(take_scores, axis=1)
+    print(f"各 take 被选中的小节数: {np.bincount(chosen, minlength=num_takes).tolist()}")
+
+    # 4. 拼接旋律与伴奏，写 MIDI 文件
+    return __assemble_music(all_sounds, accompaniment_events, measure_lengths, return_stream), take_scores
+
+def generate_music_stream(model,
+                          indices_val,
+                          original_chords_stream,
+                          n_values,
+                          n_a,
+                          Ty_per_measure=50,
+                          temperature=0.0,
+                          device='cuda',
+                          seed=None,
+                          carry_state=True,
+                          early_stop=False,
+                          top_k=0,
+                          top_p=1.0,
+                          beam_width=1,
+                          constrained=False):
+    """
+    流式生成：逐小节解码、反解析，每完成一个小节就立即 yield，调用方 (实时播放、
+    网络推送等) 在第一个小节完成后就可以开始使用，不需要等整首曲子生成和 MIDI 写完。
+
+    与 generate_music 不同，相邻小节之间延续 LSTM 的状态 (a, c) 和上一个 token，
+    下一个小节从上一个小节结束的地方继续生成，而不是每个小节都从零状态重新开始。
+
+    Parameters:
+    (model ~ device 同 generate_music)
+    seed (int): 反解析的随机种子，小节 i 使用 seed + i (None = 不重设随机状态)
+    carry_state (bool): True = 延续状态；False = 每个小节都从零状态开始 (同 generate_music)
+    early_stop (bool): 小节填满后停止解码该小节 (同 generate_music)
+    top_k, top_p, beam_width, constrained: 解码方式 (同 generate_music)
+
+    Yield:
+    measure_index (int): 小节序号
+    measure_offset (float): 该小节在整首曲子中的起始 offset
+    measure_stream (stream.Stream): 该小节的旋律和伴奏 (offset 相对于小节开头)
+    """
+    model.eval() # 确保模型处于评估模式
+
+    accompaniment_measures = __split_measures(original_chords_stream)
+    if accompaniment_measures is None:
+        return
+
+    stop_durations = __token_durations(indices_val, n_values, device) if early_stop else None
+    decode_kwargs = __decode_kwargs(indices_val, n_values, device, top_k, top_p, constrained)
+    prune_tables = build_prune_tables(indices_val, n_values)
+
+    # 第一个小节从零输入/零状态开始 (同 generate_music)
+    x = torch.zeros(1, n_values, device=device)
+    a = torch.zeros(1, n_a, device=device)
+    c = torch.zeros(1, n_a, device=device)
+
+    curr_offset = 0.0
+    for i, curr_chords_measure in enumerate(accompaniment_measures):
+        measure_length = curr_chords_measure.duration.quarterLength
+
+        stop_kwargs = {}
+        if stop_durations is not None:
+            stop_kwargs['stop_durations'] = stop_durations
+            stop_kwargs['stop_at'] = torch.tensor([measure_length], dtype=torch.float64, device=device)
+
+        with torch.inference_mode():
+            if beam_width > 1:
+                generated, a_last, c_last, _ = beam_search(
+                    model, x, a, c,
+                    Ty=Ty_per_measure,
+                    beam_width=beam_width,
+                    grammar_mask=decode_kwargs.get('grammar_mask'),
+                    **stop_kwargs
+                )
+            else:
+                generated, a_last, c_last = model.generate_with_state(
+                    x, a, c,
+                    Ty=Ty_per_measure,
+                    temperature=temperature,
+                    **stop_kwargs,
+                    **decode_kwargs
+                )
+
+        # 下一个小节接着这个小节最后的状态和 token 继续
+        if carry_state:
+            a, c = a_last, c_last
+            # 提前结束 (或 beam search 中较早结束的候选) 时末尾是 -1，取最后一个有效的 token
+            last_token = generated[generated >= 0][-1:]
+            x = F.one_hot(last_token, num_classes=n_values).float()
+
+        # 在反解析之前记录伴奏的偏移量与时长 (unparse_grammar 可能会修改和弦的 offset)
+        accompaniment_events = [(mc.offset, mc) for mc in curr_chords_measure.notesAndRests]
+
+        measure_seed = None if seed is None else seed + i
+        grammar = __prune_measures(generated.to('cpu').numpy(), prune_tables,
+                                   None if measure_seed is None else [measure_seed])[0]
+        sounds = __unparse_measure((grammar, curr_chords_measure, measure_seed))
+
+        measure_stream = stream.Stream()
+        for offset, m in events.to_music21(sounds):
+            measure_stream.insert(offset, m)
+        for offset, mc in accompaniment_events:
+            measure_stream.insert(offset, mc)
+
+        yield i, curr_offset, measure_stream
+
+        curr_offset += measure_length
+
+
+class CorpusWindowDataset(Dataset):
+    """
+    按索引切窗口的训练数据集，替代 notebook 中的 create_dataset。
+
+    create_dataset 会把所有窗口展开成 (num_samples, Tx, n_values) 的 float32
+    one-hot 张量，内存是 O(语料长度 x Tx x 词汇表大小)。这里只保存一份 int
+    token 数组，窗口是它上面的零拷贝滑动视图 (sliding_window_view)，取样本时
+    才复制 Tx + 1 个索引，内存是 O(语料长度)。one-hot/embedding 留给训练循环
+    按 batch 在 device 上完成，例如 F.one_hot(seq.to(device), n_values).float()。
+
+    样本与 create_dataset(corpus, val_indices, n_values, Tx, step) 完全一致：
+    第 i 个样本的输入是 token_ids[i*step : i*step + Tx]，标签是向后错一位的序列。
+
+    Parameters:
+    token_ids (array-like): 整个语料的 token 索引 (list / np.ndarray / np.memmap 均可)
+    Tx (int): 窗口长度
+    step (int): 窗口步长
+    """
+    def __init__(self, token_ids, Tx, step=1):
+        token_ids = np.asarray(token_ids)
+        if token_ids.ndim != 1 or not np.issubdtype(token_ids.dtype, np.integer):
+            raise ValueError("token_ids 必须是一维的整数数组。")
+        if Tx < 1 or step < 1:
+            raise ValueError("Tx 和 step 必须是正整数。")
+
+        self.token_ids = token_ids
+        self.Tx = Tx
+        self.step = step
+
+        # (num_samples, Tx + 1) 的只读视图，与 token_ids 共享内存
+        if len(token_ids) > Tx:
+            windows = np.lib.stride_tricks.sliding_window_view(token_ids, Tx + 1)
+        else:
+            windows = token_ids[:0].reshape(0, Tx + 1)
+        self.windows = windows[::step]
+
+    @classmethod
+    def from_corpus(cls, corpus, val_indices, Tx, step=1):
+        """
+        Parameters:
+        corpus (list[str]): token 序列 (来自 get_corpus_data)
+        val_indices (dict): token -> 索引 (来自 get_corpus_data)
+
+        Return:
+        dataset (CorpusWindowDataset): 参数 Tx/step 同构造函数
+        """
+        token_ids = np.fromiter((val_indices[token] for token in corpus),
+                                dtype=np.int64, count=len(corpus))
+        return cls(token_ids, Tx, step)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, i):
+        """
+        Return:
+        x (torch.Tensor): 输入 token 索引 (Tx,)，int64
+        y (torch.Tensor): 标签 token 索引 (Tx,)，int64
+        """
+        window = torch.from_numpy(self.windows[i].astype(np.int64))
+        return window[:-1], window[1:]
+
+
+class CorpusStreamDataset(Dataset):
+    """
+    截断 BPTT (truncated backpropagation through time) 用的训练数据：把整个语料切成
+    batch_size 条首尾相接、互不重叠的连续流 (每个 batch 行一条)，再沿时间切成长度为 Tx 的块。
+
+    第 i 个样本是所有流的第 i 块，形状 (batch_size, Tx)。块 i + 1 紧接在块 i 之后，
+    所以训练时可以把块 i 结束时的 (a, c) (detach 后) 作为块 i + 1 的初始状态
+    (见 model.train_tbptt)。每个 token 每个 epoch 只被处理一次，而 CorpusWindowDataset
+    (step=1) 中每个 token 会出现在 Tx 个窗口里。
+
+    样本必须按顺序使用 (不要 shuffle，DataLoader 的 batch_size 设为 None)。
+
+    Parameters:
+    token_ids (array-like): 整个语料的 token 索引
+    batch_size (int): 流的条数 (每个块的行数)
+    Tx (int): 块长度 (反向传播的截断长度)；最后一块可能更短
+    """
+    def __init__(self, token_ids, batch_size, Tx):
+        token_ids = np.asarray(token_ids)
+        if token_ids.ndim != 1 or not np.issubdtype(token_ids.dtype, np.integer):
+            raise ValueError("token_ids 必须是一维的整数数组。")
+        if Tx < 1 or batch_size < 1:
+            raise ValueError("Tx 和 batch_size 必须是正整数。")
+
+        # 每条流的长度 (输入和标签错开一位，所以最多用到 len - 1 个输入)
+        stream_length = (len(token_ids) - 1) // batch_size
+        if stream_length < 1:
+            raise ValueError(f"语料太短 ({len(token_ids)} 个 token)，不够切成 {batch_size} 条流。")
+
+        self.token_ids = token_ids
+        self.batch_size = batch_size
+        self.Tx = Tx
+        self.stream_length = stream_length
+
+        # (batch_size, stream_length) 的视图，与 token_ids 共享内存
+        used = batch_size * stream_length
+        self.inputs = token_ids[:used].reshape(batch_size, stream_length)
+        self.labels = token_ids[1:used + 1].reshape(batch_size, stream_length)
+
+    @classmethod
+    def from_corpus(cls, corpus, val_indices, batch_size, Tx):
+        """
+        Parameters:
+        corpus (list[str]): token 序列 (来自 get_corpus_data)
+        val_indices (dict): token -> 索引 (来自 get_corpus_data)
+
+        Return:
+        dataset (CorpusStreamDataset): 参数 batch_size/Tx 同构造函数
+        """
+        token_ids = np.fromiter((val_indices[token] for token in corpus),
+                                dtype=np.int64, count=len(corpus))
+        return cls(token_ids, batch_size, Tx)
+
+    def __len__(self):
+        return -(-self.stream_length // self.Tx)
+
+    def __getitem__(self, i):
+        """
+        Return:
+        x (torch.Tensor): 所有流的第 i 块输入 (batch_size, Tx)，int64
+        y (torch.Tensor): 对应的标签 (batch_size, Tx)，int64
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        chunk = slice(i * self.Tx, (i + 1) * self.Tx)
+        x = torch.from_numpy(self.inputs[:, chunk].astype(np.int64))
+        y = torch.from_numpy(self.labels[:, chunk].astype(np.int64))
+        return x, y
@@ -0,0 +1,152 @@
+'''
+events.py
+紧凑的音符事件表示：用一个 NumPy 结构化数组 (每个音符/休止符一行) 代替成千上万个
+music21 Note/Rest 对象。生成流程 (unparse_grammar -> prune_notes/clean_up_notes ->
+拼接小节) 全程传递事件数组，只在导出 (写 MIDI / 返回 Stream) 时才转换为 music21。
+'''
+
+import numpy as np
+from music21 import note, chord, pitch
+
+# 事件类型
+KIND_REST = 0
+KIND_NOTE = 1
+KIND_CHORD = 2 # 和弦中的一个音：同一个和弦的各个音相邻存放，offset 和 duration 相同
+
+EVENT_DTYPE = np.dtype([('pitch', np.int16),      # MIDI 音高 (休止符为 -1)
+                        ('offset', np.float64),   # 起始位置 (quarterLength)
+                        ('duration', np.float64), # 时值 (quarterLength)
+                        ('velocity', np.uint8),   # 力度 (0 = 不设置，使用 music21 的默认值)
+                        ('kind', np.uint8)])
+
+def make_events(records=()):
+    """
+    Parameters:
+    records (list[tuple]): (pitch, offset, duration, velocity, kind) 元组列表
+
+    Return:
+    events (np.ndarray): EVENT_DTYPE 的结构化数组
+    """
+    return np.array(list(records), dtype=EVENT_DTYPE)
+
+def shift_events(events, offset):
+    """
+    返回把所有事件平移 offset 之后的副本 (例如把小节内的事件放到整首曲子中的位置)。
+    """
+    shifted = events.copy()
+    shifted['offset'] += offset
+    return shifted
+
+def __tie_type(element, ix):
+    # 和弦的 tie 只说明 *某些* 音有连音，优先使用各个音自己的 tie
+    if isinstance(element, chord.Chord):
+        tie = element.notes[ix].tie or element.tie
+    else:
+        tie = element.tie
+    return None if tie is None else tie.type
+
+def from_music21(elements, merge_ties=False):
+    """
+    把 music21 的音符/休止符/和弦转换为事件数组 (其他类型的元素被忽略)。
+
+    Parameters:
+    elements (iterable): music21 元素，或 (offset, 元素) 元组 (未给出 offset 时使用 element.offset)
+    merge_ties (bool): True = 把连音 (例如 makeMeasures 在小节线处拆开的音) 合并为一个事件：
+                       同一音高上首尾相接的 continue/stop 片段被并入前面的 start 事件
+
+    Return:
+    events (np.ndarray): EVENT_DTYPE 的结构化数组
+    """
+    records = []
+    open_ties = {} # 音高 -> 尚未结束的连音在 records 中的位置
+    for item in elements:
+        if isinstance(item, tuple):
+            offset, element = item
+        else:
+            offset, element = item.offset, item
+        offset = float(offset)
+        duration = float(element.quarterLength)
+
+        if isinstance(element, note.Rest):
+            records.append((-1, offset, duration, 0, KIND_REST))
+            continue
+
+        if isinstance(element, note.Note):
+            kind = KIND_NOTE
+        elif isinstance(element, chord.Chord):
+            kind = KIND_CHORD
+        else:
+            continue
+
+        # 同 music21 导出 MIDI 的规则：和弦的各个音有自己的力度时使用各自的力度
+        if kind == KIND_CHORD and element.hasComponentVolumes():
+            velocities = [n.volume.velocity or 0 for n in element.notes]
+        else:
+            velocity = (element.volume.velocity or 0) if element.hasVolumeInformation() else 0
+            velocities = [velocity] * len(element.pitches)
+
+        for ix, (p, velocity) in enumerate(zip(element.pitches, velocities)):
+            midi = p.midi
+            tie_type = __tie_type(element, ix) if merge_ties else None
+            if tie_type in ('continue', 'stop') and midi in open_ties:
+                start = open_ties[midi]
+                p_midi, p_offset, p_duration, p_velocity, p_kind = records[start]
+                if abs(p_offset + p_duration - offset) < 1e-6:
+                    records[start] = (p_midi, p_offset, p_duration + duration, p_velocity, p_kind)
+                    if tie_type == 'stop':
+                        del open_ties[midi]
+                    continue
+
+            records.append((midi, offset, duration, velocity, kind))
+            if tie_type in ('start', 'continue'):
+                open_ties[midi] = len(records) - 1
+            else:
+                open_ties.pop(midi, None)
+
+    return make_events(records)
+
+def to_music21(events):
+    """
+    把事件数组转换为 music21 元素 (只在导出时调用)。
+
+    Parameters:
+    events (np.ndarray): EVENT_DTYPE 的结构化数组
+
+    Return:
+    elements (list[tuple]): (offset, music21 Note/Rest/Chord) 列表
+    """
+    elements = []
+    ix = 0
+    num_events = len(events)
+    while ix < num_events:
+        midi, offset, duration, velocity, kind = events[ix].item()
+
+        if kind == KIND_CHORD:
+            # 把相邻的、offset/duration 相同的和弦音合并为一个 Chord
+            end = ix + 1
+            while (end < num_events and events[end]['kind'] == KIND_CHORD
+                   and events[end]['offset'] == offset
+                   and events[end]['duration'] == duration):
+                end += 1
+            element = chord.Chord([pitch.Pitch(midi=int(p)) for p in events['pitch'][ix:end]])
+            velocities = events['velocity'][ix:end]
+            if (velocities != velocity).any():
+                # 各个音的力度不同：设置到和弦的各个音上
+                # (每个音都要有 Volume，否则 music21 会忽略各个音的力度)
+                for n, v in zip(element.notes, velocities.tolist()):
+                    n.volume.velocity = v or None
+                velocity = 0
+            ix = end
+        elif kind == KIND_REST:
+            element = note.Rest()
+            ix += 1
+        else:
+            element = note.Note(pitch.Pitch(midi=midi))
+            ix += 1
+
+        element.quarterLength = duration
+        if velocity and kind != KIND_REST:
+            element.volume.velocity = velocity
+        elements.append((offset, element))
+
+    return elements
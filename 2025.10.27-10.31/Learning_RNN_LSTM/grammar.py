@@ -10,47 +10,135 @@ https://github.com/evancchow/jazzml,with permission.
 from collections import OrderedDict, defaultdict
 from itertools import groupby
 from music21 import *
-import copy, random, pdb
+import bisect, copy, random, pdb
+
+import events
 
 #from preprocess import *
 
+''' Bit assigned to every spelled note name seen so far ('C', 'C#', 'D-', ...).
+    The tone masks below are built over these bits, so a lookup keeps the
+    exact name (spelling) semantics of the original music21 comparisons. '''
+__NAME_BITS = {}
+
+''' Memoized tone tables, keyed by the set of note names in a chord. Each table
+    holds the chord-tone and approach-tone masks, plus scale-tone masks and
+    major-scale note names keyed by chord quality (filled in lazily). '''
+__TONE_TABLES = {}
+
+''' Helper function to get the bit for a note name, assigning a new one if
+    the name has not been seen yet. '''
+def __name_bit(name):
+    bit = __NAME_BITS.get(name)
+    if bit is None:
+        bit = 1 << len(__NAME_BITS)
+        __NAME_BITS[name] = bit
+    return bit
+
+''' Helper function to OR together the bits of a list of note names. '''
+def __names_mask(names):
+    mask = 0
+    for name in names:
+        mask |= __name_bit(name)
+    return mask
+
+''' Helper function to get (or build) the memoized tone table of a chord. '''
+def __tone_table(chord):
+    key = frozenset(p.name for p in chord.pitches)
+    table = __TONE_TABLES.get(key)
+    if table is None:
+        # Chord tones: the chord's own note names.
+        chordMask = __names_mask(p.name for p in chord.pitches)
+
+        # Approach tones: +/- 1 half step from a chord tone (and enharmonics).
+        approachMask = 0
+        for chordPitch in chord.pitches:
+            stepUp = chordPitch.transpose(1)
+            stepDown = chordPitch.transpose(-1)
+            approachMask |= __names_mask([stepDown.name,
+                                          stepDown.getEnharmonic().name,
+                                          stepUp.name,
+                                          stepUp.getEnharmonic().name])
+
+        table = {'chord': chordMask, 'approach': approachMask,
+                 'scale': {}, 'majorNames': None}
+        __TONE_TABLES[key] = table
+    return table
+
+''' Helper function to get the scale-tone mask of a chord. '''
+def __scale_mask(chord):
+    table = __tone_table(chord)
+    quality = chord.quality
+    mask = table['scale'].get(quality)
+    if mask is None:
+        # Derive major or minor scales (minor if 'other') based on the quality
+        # of the chord. The derived scale only depends on the chord's pitch
+        # classes, so it is computed once per table.
+        scaleType = scale.DorianScale() # i.e. minor pentatonic
+        if quality == 'major':
+            scaleType = scale.MajorScale()
+        scales = scaleType.derive(chord) # use deriveAll() later for flexibility
+        mask = __names_mask(p.name for p in scales.getPitches())
+        table['scale'][quality] = mask
+    return mask
+
+''' Helper function to check whether a note name is in a tone mask. '''
+def __in_mask(mask, name):
+    return (mask & __NAME_BITS.get(name, 0)) != 0
+
+''' Note name of each pitch class, spelled the way
+    lowPitch.transpose(i).simplifyEnharmonic() spells it (C, C#, D, E-, ...). '''
+__PC_NAMES = [pitch.Pitch('C4').transpose(pc).simplifyEnharmonic().name
+              for pc in range(12)]
+
+''' Memoized interval name ('m3', 'P-4', ...) -> directed semitones. '''
+__INTERVAL_SEMITONES = {}
+
+''' Memoized 12-bit pitch-class masks, keyed by note-name mask. '''
+__PC_MASKS = {}
+
+''' Helper function to parse an interval name into directed semitones. '''
+def __interval_semitones(name):
+    semitones = __INTERVAL_SEMITONES.get(name)
+    if semitones is None:
+        semitones = interval.Interval(name).semitones
+        __INTERVAL_SEMITONES[name] = semitones
+    return semitones
+
+''' Helper function to turn a note-name mask into a mask over the 12 pitch
+    classes (bit pc is set if __PC_NAMES[pc] is in the name mask). '''
+def __pitch_class_mask(nameMask):
+    pcMask = __PC_MASKS.get(nameMask)
+    if pcMask is None:
+        pcMask = 0
+        for pc, name in enumerate(__PC_NAMES):
+            if __in_mask(nameMask, name):
+                pcMask |= 1 << pc
+        __PC_MASKS[nameMask] = pcMask
+    return pcMask
+
+''' Helper function to get the nameWithOctave of a MIDI pitch number. '''
+def __ps_name_with_octave(ps):
+    return "%s%d" % (__PC_NAMES[ps % 12], ps // 12 - 1)
+
+''' Helper function to build a music21 Pitch from a MIDI pitch number. '''
+def __ps_to_pitch(ps):
+    return pitch.Pitch(__PC_NAMES[ps % 12], octave=ps // 12 - 1)
+
 ''' Helper function to determine if a note is a scale tone. '''
 def __is_scale_tone(chord, note):
-    # Method: generate all scales that have the chord notes th check if note is
-    # in names
-
-    # Derive major or minor scales (minor if 'other') based on the quality
-    # of the chord.
-    scaleType = scale.DorianScale() # i.e. minor pentatonic
-    if chord.quality == 'major':
-        scaleType = scale.MajorScale()
-    # Can change later to deriveAll() for flexibility. If so then use list
-    # comprehension of form [x for a in b for x in a].
-    scales = scaleType.derive(chord) # use deriveAll() later for flexibility
-    allPitches = list(set([pitch for pitch in scales.getPitches()]))
-    allNoteNames = [i.name for i in allPitches] # octaves don't matter
-
-    # Get note name. Return true if in the list of note names.
-    noteName = note.name
-    return (noteName in allNoteNames)
+    # Octaves don't matter: compare the note name against the memoized mask of
+    # the scale derived from the chord.
+    return __in_mask(__scale_mask(chord), note.name)
 
 ''' Helper function to determine if a note is an approach tone. '''
 def __is_approach_tone(chord, note):
     # Method: see if note is +/- 1 a chord tone.
-
-    for chordPitch in chord.pitches:
-        stepUp = chordPitch.transpose(1)
-        stepDown = chordPitch.transpose(-1)
-        if (note.name == stepDown.name or 
-            note.name == stepDown.getEnharmonic().name or
-            note.name == stepUp.name or
-            note.name == stepUp.getEnharmonic().name):
-                return True
-    return False
+    return __in_mask(__tone_table(chord)['approach'], note.name)
 
 ''' Helper function to determine if a note is a chord tone. '''
 def __is_chord_tone(lastChord, note):
-    return (note.name in (p.name for p in lastChord.pitches))
+    return __in_mask(__tone_table(lastChord)['chord'], note.name)
 
 ''' Helper function to generate a chord tone. '''
 def __generate_chord_tone(lastChord):
@@ -61,19 +149,26 @@ def __generate_chord_tone(lastChord):
 def __generate_scale_tone(lastChord):
     # Derive major or minor scales (minor if 'other') based on the quality
     # of the lastChord.
-    scaleType = scale.WeightedHexatonicBlues() # minor pentatonic
     if lastChord.quality == 'major':
-        scaleType = scale.MajorScale()
-    # Can change later to deriveAll() for flexibility. If so then use list
-    # comprehension of form [x for a in b for x in a].
-    scales = scaleType.derive(lastChord) # use deriveAll() later for flexibility
-    allPitches = list(set([pitch for pitch in scales.getPitches()]))
-    allNoteNames = [i.name for i in allPitches] # octaves don't matter
+        # The major scale is deterministic, so its note names are memoized.
+        table = __tone_table(lastChord)
+        if table['majorNames'] is None:
+            scales = scale.MajorScale().derive(lastChord)
+            allPitches = list(dict.fromkeys(scales.getPitches()))
+            table['majorNames'] = [i.name for i in allPitches]
+        allNoteNames = table['majorNames']
+    else:
+        # WeightedHexatonicBlues is a probabilistic scale (derive() and
+        # getPitches() draw from `random`), so it has to be derived per call.
+        scales = scale.WeightedHexatonicBlues().derive(lastChord) # minor pentatonic
+        allPitches = list(dict.fromkeys(scales.getPitches()))
+        allNoteNames = [i.name for i in allPitches] # octaves don't matter
 
     # Return a note (no octave here) in a scale that matches the lastChord.
     sNoteName = random.choice(allNoteNames)
-    lastChordSort = lastChord.sortAscending()
-    sNoteOctave = random.choice([i.octave for i in lastChordSort.pitches])
+    # Same order as lastChord.sortAscending(), without copying the chord.
+    lastChordSort = sorted(lastChord.pitches, key=lambda p: (p.diatonicNoteNum, p.ps))
+    sNoteOctave = random.choice([i.octave for i in lastChordSort])
     sNote = note.Note(("%s%s" % (sNoteName, sNoteOctave)))
     return sNote
 
@@ -88,6 +183,19 @@ def __generate_arbitrary_tone(lastChord):
     return __generate_scale_tone(lastChord) # fix later, make random note.
 
 
+''' Helper function to get the last chord starting at or before `offset`.
+    `chordOffsets` is the sorted offset list parallel to `chords`. If no chord
+    starts that early, the first chord is shifted to `startOffset` (in the
+    offset list only, the chord itself is not modified). '''
+def __last_chord(chords, chordOffsets, offset, startOffset):
+    ix = bisect.bisect_right(chordOffsets, offset) - 1
+    if ix < 0:
+        chordOffsets[0] = startOffset
+        ix = bisect.bisect_right(chordOffsets, offset) - 1
+        if ix < 0:
+            raise IndexError("no chord at or before offset %s" % offset)
+    return chords[ix]
+
 ''' Given the notes in a measure ('measure') and the chords in that measure
     ('chords'), generate a list of abstract grammatical symbols to represent 
     that measure as described in GTK's "Learning Jazz Grammars" (2009). 
@@ -126,17 +234,18 @@ def __generate_arbitrary_tone(lastChord):
                              (interval <a,b> is not ordered). '''
 
 def parse_melody(fullMeasureNotes, fullMeasureChords):
-    # Remove extraneous elements.x
-    measure = copy.deepcopy(fullMeasureNotes)
-    chords = copy.deepcopy(fullMeasureChords)
-    measure.removeByNotOfClass([note.Note, note.Rest])
-    chords.removeByNotOfClass([chord.Chord])
+    # Select the notes/rests and chords (no copies of the input streams). The
+    # offsets are read once here; the chord offsets stay sorted for bisect.
+    measure = list(fullMeasureNotes.getElementsByClass([note.Note, note.Rest]))
+    measureOffsets = [fullMeasureNotes.elementOffset(n) for n in measure]
+    chords = list(fullMeasureChords.getElementsByClass(chord.Chord))
+    chordOffsets = [fullMeasureChords.elementOffset(c) for c in chords]
 
     # Information for the start of the measure.
     # 1) measureStartTime: the offset for measure's start, e.g. 476.0.
     # 2) measureStartOffset: how long from the measure start to the first element.
-    measureStartTime = measure[0].offset - (measure[0].offset % 4)
-    measureStartOffset  = measure[0].offset - measureStartTime
+    measureStartTime = measureOffsets[0] - (measureOffsets[0] % 4)
+    measureStartOffset  = measureOffsets[0] - measureStartTime
 
     # Iterate over the notes and rests in measure, finding the grammar for each
     # note in the measure and adding an abstract grammatical string for it. 
@@ -147,11 +256,8 @@ def parse_melody(fullMeasureNotes, fullMeasureChords):
     for ix, nr in enumerate(measure):
         # Get the last chord. If no last chord, then (assuming chords is of length
         # >0) shift first chord in chords to the beginning of the measure.
-        try: 
-            lastChord = [n for n in chords if n.offset <= nr.offset][-1]
-        except IndexError:
-            chords[0].offset = measureStartTime
-            lastChord = [n for n in chords if n.offset <= nr.offset][-1]
+        lastChord = __last_chord(chords, chordOffsets, measureOffsets[ix],
+                                 measureStartTime)
 
         # FIRST, get type of note, e.g. R for Rest, C for Chord, etc.
         # Dealing with solo notes here. If unexpected chord: still call 'C'.
@@ -177,9 +283,9 @@ def parse_melody(fullMeasureNotes, fullMeasureChords):
         # to simplify things you'll use the direct num, e.g. R,0.125
         if (ix == (len(measure)-1)):
             # formula for a in "a - b": start of measure (e.g. 476) + 4
-            diff = measureStartTime + 4.0 - nr.offset
+            diff = measureStartTime + 4.0 - measureOffsets[ix]
         else:
-            diff = measure[ix + 1].offset - nr.offset
+            diff = measureOffsets[ix + 1] - measureOffsets[ix]
 
         # Combine into the note info.
         noteInfo = "%s,%.3f" % (elementType, nr.quarterLength) # back to diff
@@ -211,20 +317,30 @@ def parse_melody(fullMeasureNotes, fullMeasureChords):
 
     return fullGrammar.rstrip()
 
-''' Given a grammar string and chords for a measure, returns measure notes. '''
-def unparse_grammar(m1_grammar, m1_chords):
+''' Given a grammar string and chords for a measure, returns measure notes.
+    With as_events=True the notes are returned as a compact event array (see
+    events.py) instead of a stream.Voice, and no music21 Note/Rest objects are
+    created for them. '''
+def unparse_grammar(m1_grammar, m1_chords, as_events=False):
     
     # --- 修复版 ---
     # 原始函数在第一个 token 是 Rest 时会失败。
     # 这个版本修复了这个问题。
     
     m1_elements = stream.Voice()
+    m1_events = [] # as_events=True 时使用: (pitch, offset, duration, velocity, kind)
     currOffset = 0.0 # for recalculate last chord.
-    prevElement = None # 将保持为 None，直到第一个 *Note* 被生成
+
+    # 和弦按 offset 排好序，之后用二分查找定位当前和弦 (不修改传入的 m1_chords)
+    chordElements = list(m1_chords)
+    chordOffsets = [m1_chords.elementOffset(n) for n in chordElements]
+    # 上一个音符的 MIDI 音高和 nameWithOctave，直到第一个 *Note* 被生成前都是 None
+    prevPs = None
+    prevName = None
     
     # 确保 m1_grammar 是一个非空字符串
     if not m1_grammar:
-        return m1_elements
+        return events.make_events() if as_events else m1_elements
 
     for ix, grammarElement in enumerate(m1_grammar.split(' ')):
         if not grammarElement: # 跳过
@@ -249,27 +365,27 @@ def unparse_grammar(m1_grammar, m1_chords):
         
         # Case 1: 这是一个休止符 (Rest)
         if terms[0] == 'R':
-            rNote = note.Rest(quarterLength = duration)
-            m1_elements.insert(currOffset, rNote)
+            if as_events:
+                # 与 note.Rest(quarterLength=0.0) 一致：时值为 0 的休止符得到默认时值 1.0
+                m1_events.append((-1, currOffset, duration or 1.0, 0, events.KIND_REST))
+            else:
+                rNote = note.Rest(quarterLength = duration)
+                m1_elements.insert(currOffset, rNote)
             # 注意：我们不再 `continue`。
-            # prevElement 保持不变 (它可能是 None，也可能是上一个音符)
+            # prevPs/prevName 保持不变 (可能是 None，也可能是上一个音符)
         
         # Case 2: 这是一个音符 (Note)
         else:
-            # 无论如何，我们都需要一个音符对象
-            insertNote = note.Note() 
-            insertNote.quarterLength = duration
+            # 选中的音：insertPitch 为 None 时只用 insertPs 表示 (按 __PC_NAMES 拼写)
+            insertNote = None
+            insertPitch = None
 
             # 获取当前位置的和弦
-            try: 
-                lastChord = [n for n in m1_chords if n.offset <= currOffset][-1]
-            except IndexError:
-                m1_chords[0].offset = 0.0
-                lastChord = [n for n in m1_chords if n.offset <= currOffset][-1]
+            lastChord = __last_chord(chordElements, chordOffsets, currOffset, 0.0)
 
-            # Sub-case A: 这是第一个音符 (prevElement is None)
+            # Sub-case A: 这是第一个音符 (prevPs is None)
             # 或者 语法中没有提供音程 (len(terms) == 2)
-            if prevElement is None or len(terms) == 2:
+            if prevPs is None or len(terms) == 2:
                 
                 # Case C: chord note.
                 if terms[0] == 'C':
@@ -284,73 +400,111 @@ def unparse_grammar(m1_grammar, m1_chords):
                 insertNote.quarterLength = duration
                 if insertNote.octave < 4: # (原始逻辑)
                     insertNote.octave = 4
+                insertPitch = insertNote.pitch
                 
             # Sub-case B: 这是一个后续音符，且我们有音程
             else:
-                # (这个 'else' 分支中的逻辑与原版文件完全相同)
-                
-                # Get lower, upper intervals and notes.
-                interval1 = interval.Interval(terms[2].replace("<",''))
-                interval2 = interval.Interval(terms[3].replace(">",''))
-                if interval1.cents > interval2.cents:
-                    upperInterval, lowerInterval = interval1, interval2
+                # 在 MIDI 音高 (整数半音) 上完成候选音的筛选，
+                # 只为最终选中的音创建 music21 Note (结果与原版逐个构造 Note 完全一致)
+
+                # Get lower, upper intervals (in semitones) and MIDI pitches.
+                semitones1 = __interval_semitones(terms[2].replace("<",''))
+                semitones2 = __interval_semitones(terms[3].replace(">",''))
+                if semitones1 > semitones2:
+                    upperSemitones, lowerSemitones = semitones1, semitones2
                 else:
-                    upperInterval, lowerInterval = interval2, interval1
-                lowPitch = interval.transposePitch(prevElement.pitch, lowerInterval)
-                highPitch = interval.transposePitch(prevElement.pitch, upperInterval)
-                numNotes = int(highPitch.ps - lowPitch.ps + 1) # for range(s, e)
-
-                # Case C: chord note
-                if terms[0] == 'C':
-                    relevantChordTones = []
-                    for i in range(0, numNotes):
-                        currNote = note.Note(lowPitch.transpose(i).simplifyEnharmonic())
-                        if __is_chord_tone(lastChord, currNote):
-                            relevantChordTones.append(currNote)
-                    if len(relevantChordTones) > 1:
-                        insertNote = random.choice([i for i in relevantChordTones
-                            if i.nameWithOctave != prevElement.nameWithOctave])
-                    elif len(relevantChordTones) == 1:
-                        insertNote = relevantChordTones[0]
-                    else: 
-                        insertNote = prevElement.transpose(random.choice([-2,2]))
-
-                # Case S: scale note
-                elif terms[0] == 'S':
-                    relevantScaleTones = []
-                    for i in range(0, numNotes):
-                        currNote = note.Note(lowPitch.transpose(i).simplifyEnharmonic())
-                        if __is_scale_tone(lastChord, currNote):
-                            relevantScaleTones.append(currNote)
-                    if len(relevantScaleTones) > 1:
-                        insertNote = random.choice([i for i in relevantScaleTones
-                            if i.nameWithOctave != prevElement.nameWithOctave])
-                    elif len(relevantScaleTones) == 1:
-                        insertNote = relevantScaleTones[0]
+                    upperSemitones, lowerSemitones = semitones2, semitones1
+                lowPs = prevPs + lowerSemitones
+                highPs = prevPs + upperSemitones
+
+                relevantTones = []
+                if highPs >= lowPs:
+                    # Case C: chord note, Case S: scale note,
+                    # Case A or X: approach tone
+                    if terms[0] == 'C':
+                        toneMask = __tone_table(lastChord)['chord']
+                    elif terms[0] == 'S':
+                        toneMask = __scale_mask(lastChord)
                     else:
-                        insertNote = prevElement.transpose(random.choice([-2,2]))
-
-                # Case A or X: approach tone
+                        toneMask = __tone_table(lastChord)['approach']
+                    pcMask = __pitch_class_mask(toneMask)
+                    relevantTones = [ps for ps in range(lowPs, highPs + 1)
+                                     if (pcMask >> (ps % 12)) & 1]
+
+                if len(relevantTones) > 1:
+                    insertPs = random.choice([ps for ps in relevantTones
+                        if __ps_name_with_octave(ps) != prevName])
+                elif len(relevantTones) == 1:
+                    insertPs = relevantTones[0]
                 else:
-                    relevantApproachTones = []
-                    for i in range(0, numNotes):
-                        currNote = note.Note(lowPitch.transpose(i).simplifyEnharmonic())
-                        if __is_approach_tone(lastChord, currNote):
-                            relevantApproachTones.append(currNote)
-                    if len(relevantApproachTones) > 1:
-                        insertNote = random.choice([i for i in relevantApproachTones
-                            if i.nameWithOctave != prevElement.nameWithOctave])
-                    elif len(relevantApproachTones) == 1:
-                        insertNote = relevantApproachTones[0]
-                    else:
-                        insertNote = prevElement.transpose(random.choice([-2,2]))
-                
-                insertNote.quarterLength = duration
-                if insertNote.octave < 3: # (原始逻辑)
-                    insertNote.octave = 3
+                    # 等价于 prevElement.transpose(...)，但不复制音符本身
+                    # (复制出的音符会沿 derivation 链查找调号，链越长越慢)
+                    insertPitch = pitch.Pitch(prevName).transpose(random.choice([-2,2]))
+
+                if insertPitch is None:
+                    if insertPs // 12 - 1 < 3: # (原始逻辑: octave < 3 时设为 3)
+                        insertPs = insertPs % 12 + 48
+                elif insertPitch.octave < 3: # (原始逻辑)
+                    insertPitch.octave = 3
             
-            # 插入音符并将其设置为“上一个元素”
-            m1_elements.insert(currOffset, insertNote)
-            prevElement = insertNote
+            if insertPitch is not None:
+                insertPs = int(insertPitch.ps)
+                insertName = insertPitch.nameWithOctave
+            else:
+                insertName = __ps_name_with_octave(insertPs)
 
-    return m1_elements
\ No newline at end of file
+            # 插入音符并将其设置为“上一个元素”
+            if as_events:
+                m1_events.append((insertPs, currOffset, duration, 0, events.KIND_NOTE))
+            else:
+                if insertNote is None:
+                    if insertPitch is None:
+                        insertPitch = __ps_to_pitch(insertPs)
+                    insertNote = note.Note(insertPitch)
+                    insertNote.quarterLength = duration
+                m1_elements.insert(currOffset, insertNote)
+            prevPs = insertPs
+            prevName = insertName
+
+    if as_events:
+        return events.make_events(m1_events)
+    return m1_elements
+
+''' Memoized 12-bit pitch-class masks of every spelling in a note-name mask
+    (unlike __pitch_class_mask, enharmonic spellings such as D# count too). '''
+__SPELLED_PC_MASKS = {}
+
+''' Helper function to turn a note-name mask into a 12-bit pitch-class mask
+    covering all of its spellings. '''
+def __spelled_pitch_class_mask(nameMask):
+    pcMask = __SPELLED_PC_MASKS.get(nameMask)
+    if pcMask is None:
+        pcMask = 0
+        for name, bit in __NAME_BITS.items():
+            if nameMask & bit:
+                pcMask |= 1 << pitch.Pitch(name).pitchClass
+        __SPELLED_PC_MASKS[nameMask] = pcMask
+    return pcMask
+
+''' Given the chords for a measure and the note events unparsed for it (see
+    events.py, e.g. unparse_grammar(..., as_events=True)), returns the fraction
+    of notes that are scale tones of the chord sounding at their offset. Only
+    the memoized masks are used, no music21 notes are created. Returns 0.0 for
+    a measure without notes or chords. '''
+def scale_tone_ratio(m1_chords, note_events):
+    notes = note_events[note_events['pitch'] >= 0]
+    if len(notes) == 0:
+        return 0.0
+
+    # Only chords have a scale (the accompaniment can also hold single notes).
+    chordElements = [n for n in m1_chords if isinstance(n, chord.Chord)]
+    if not chordElements:
+        return 0.0
+    chordOffsets = [m1_chords.elementOffset(n) for n in chordElements]
+
+    numScaleTones = 0
+    for ps, offset in zip(notes['pitch'].tolist(), notes['offset'].tolist()):
+        lastChord = __last_chord(chordElements, chordOffsets, offset, 0.0)
+        pcMask = __spelled_pitch_class_mask(__scale_mask(lastChord))
+        numScaleTones += (pcMask >> (ps % 12)) & 1
+    return numScaleTones / len(notes)
@@ -1,117 +1,393 @@
 """
 File: midi.py
 Author: Addy771
-Description: 
-A script which converts MIDI files to WAV and optionally to MP3 using ffmpeg. 
-Works by playing each file and using the stereo mix device to record at the same time
+Description:
+A script which converts MIDI files to WAV and optionally to MP3 using ffmpeg.
+Works by synthesizing the note events of each file offline (a small additive
+oscillator/envelope bank in NumPy) and streaming the samples to the WAV file in
+blocks, so no audio hardware is needed and rendering runs much faster than real time.
+Files are rendered concurrently in a process pool; MP3 output is piped straight into
+ffmpeg, and files whose output is already up to date are skipped.
 """
 
 
-import pyaudio  # audio recording
-import wave     # file saving
-import pygame   # midi playback
-import fnmatch  # name matching
-import os       # file listing
+import wave        # file saving
+import fnmatch     # name matching
+import os          # file listing
+import subprocess  # ffmpeg
+import hashlib     # skip outputs that are up to date
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import smf         # MIDI event reader
 
 
 #### CONFIGURATION ####
 
-do_ffmpeg_convert = True    # Uses FFmpeg to convert WAV files to MP3. Requires ffmpeg.exe in the script folder or PATH
-do_wav_cleanup = True       # Deletes WAV files after conversion to MP3
+do_ffmpeg_convert = True    # Batch conversion writes MP3 by piping samples into FFmpeg. Requires ffmpeg.exe in the script folder or PATH
 sample_rate = 44100         # Sample rate used for WAV/MP3
 channels = 2                # Audio channels (1 = mono, 2 = stereo)
-buffer = 1024               # Audio buffer size
+buffer = 1024               # Audio buffer size (rendering block = buffer * block_buffers samples)
+block_buffers = 16          # Buffers per rendering block; larger blocks are faster but use more memory
 mp3_bitrate = 128           # Bitrate to save MP3 with in kbps (CBR)
-input_device = 1            # Which recording device to use. On my system Stereo Mix = 1
+master_gain = 0.2           # Gain applied to every note before the soft limiter
+
+
+#### SYNTH ####
+
+DEFAULT_TEMPO = 500000      # Microseconds per quarter note when the file has no tempo event (120 BPM)
+PERCUSSION_CHANNEL = 10
+
+# Timbres: harmonic weights and ADSR envelope (seconds; sustain is a level).
+# Picked by General MIDI program family (program // 8).
+TIMBRES = {
+    'piano':   {'harmonics': (1.0, 0.45, 0.2, 0.1), 'attack': 0.005, 'decay': 0.6, 'sustain': 0.25, 'release': 0.15},
+    'organ':   {'harmonics': (1.0, 0.6, 0.4, 0.25), 'attack': 0.01,  'decay': 0.1, 'sustain': 0.9,  'release': 0.08},
+    'guitar':  {'harmonics': (1.0, 0.5, 0.3, 0.15), 'attack': 0.003, 'decay': 0.4, 'sustain': 0.15, 'release': 0.1},
+    'bass':    {'harmonics': (1.0, 0.3, 0.1),       'attack': 0.005, 'decay': 0.3, 'sustain': 0.5,  'release': 0.08},
+    'strings': {'harmonics': (1.0, 0.5, 0.33, 0.25),'attack': 0.08,  'decay': 0.3, 'sustain': 0.8,  'release': 0.25},
+    'lead':    {'harmonics': (1.0, 0.3, 0.2),       'attack': 0.01,  'decay': 0.2, 'sustain': 0.7,  'release': 0.1},
+}
+PROGRAM_FAMILIES = ['piano', 'piano', 'organ', 'guitar', 'bass', 'strings', 'strings', 'lead',
+                    'lead', 'lead', 'lead', 'strings', 'organ', 'piano', 'piano', 'piano']
+DRUM = {'decay': 0.06, 'release': 0.02}
+
+
+
+# Converts MIDI ticks to seconds using the tempo events of all tracks
+def ticks_to_seconds(ticks, ticks_per_quarter, tempo_events):
+    tempo_events = sorted(tempo_events)
+    if not tempo_events or tempo_events[0][0] > 0:
+        tempo_events.insert(0, (0, DEFAULT_TEMPO))
+    change_ticks = np.array([tick for tick, _ in tempo_events], dtype=np.int64)
+    seconds_per_tick = np.array([tempo for _, tempo in tempo_events], dtype=np.float64) / 1e6 / ticks_per_quarter
+
+    # Time at each tempo change, then linear within each tempo segment
+    change_seconds = np.concatenate([[0.0], np.cumsum(np.diff(change_ticks) * seconds_per_tick[:-1])])
+    segment = np.searchsorted(change_ticks, ticks, side='right') - 1
+    return change_seconds[segment] + (ticks - change_ticks[segment]) * seconds_per_tick[segment]
+
+
+
+# Reads a MIDI file into flat note arrays (times in samples) plus the timbre of each note
+def load_notes(music_file, rate):
+    ticks_per_quarter, tracks = smf.read_midi(music_file)
+
+    tempo_events = []
+    programs = {}    # channel -> first program
+    for track in tracks:
+        for tick, meta_type, data in track.meta:
+            if meta_type == smf.META_TEMPO and len(data) == 3:
+                tempo_events.append((tick, int.from_bytes(data, 'big')))
+        for tick, channel, program in track.programs:
+            programs.setdefault(channel, program)
+
+    notes = [track.notes for track in tracks if len(track.notes)]
+    notes = np.concatenate(notes) if notes else np.zeros(0, dtype=smf.NOTE_DTYPE)
+    notes = notes[np.argsort(notes['on'], kind='stable')]
+
+    start = np.rint(ticks_to_seconds(notes['on'], ticks_per_quarter, tempo_events) * rate).astype(np.int64)
+    stop = np.rint(ticks_to_seconds(notes['off'], ticks_per_quarter, tempo_events) * rate).astype(np.int64)
+    stop = np.maximum(stop, start + 1)
+    timbres = ['drum' if channel == PERCUSSION_CHANNEL else PROGRAM_FAMILIES[programs.get(channel, 0) // 8]
+               for channel in notes['channel'].tolist()]
+    return {'start': start,
+            'stop': stop,
+            'pitch': notes['pitch'].astype(np.float64),
+            'velocity': notes['velocity'].astype(np.float64),
+            'timbre': np.array(timbres, dtype=object)}
+
+
+
+# One period of each timbre's waveform, with 1..n harmonics (high notes use fewer harmonics to stay below Nyquist)
+TABLE_SIZE = 2048
+def build_tables():
+    phase = 2.0 * np.pi * np.arange(TABLE_SIZE) / TABLE_SIZE
+    tables = {}
+    for name, timbre in TIMBRES.items():
+        harmonics = timbre['harmonics']
+        tables[name] = [sum(w * np.sin(k * phase) for k, w in enumerate(harmonics[:n], start=1))
+                        / sum(harmonics[:n]) for n in range(1, len(harmonics) + 1)]
+    return tables
+
+
+
+# Envelope of one note: t = samples since note on, held = note length in samples
+def envelope(t, held, rate, attack, decay, sustain, release):
+    def level(s):
+        rising = np.minimum(s / attack, 1.0)
+        falling = sustain + (1.0 - sustain) * np.exp(-np.maximum(s - attack, 0.0) / decay)
+        return np.where(s < attack, rising, falling)
+
+    seconds = t / rate
+    held_seconds = held / rate
+    # After note off: linear release from the level reached at note off
+    released = level(held_seconds) * np.maximum(1.0 - (seconds - held_seconds) / release, 0.0)
+    return np.where(seconds < held_seconds, level(seconds), released)
+
+
+
+# Adds the part of each note that sounds inside [block_start, block_start + size) to a mono buffer.
+# Only the samples where a note actually sounds are computed.
+def render_block(notes, block_start, size, rate, rng, tables):
+    out = np.zeros(size, dtype=np.float64)
+    block_end = block_start + size
+
+    for start, stop, pitch, velocity, name in zip(notes['start'].tolist(), notes['stop'].tolist(),
+                                                  notes['pitch'].tolist(), notes['velocity'].tolist(),
+                                                  notes['timbre'].tolist()):
+        timbre = DRUM if name == 'drum' else TIMBRES[name]
+        lo = max(start, block_start)
+        hi = min(stop + int(timbre['release'] * rate) + 1, block_end)
+        if hi <= lo:
+            continue
+
+        t = np.arange(lo - start, hi - start, dtype=np.float64)  # samples since note on
+        gain = velocity / 127.0 * master_gain
+        if name == 'drum':
+            # Short noise burst; low drum keys (kicks, toms) ring a little longer
+            decay = timbre['decay'] * (1.0 + min(max((60.0 - pitch) / 25.0, 0.0), 1.0))
+            env = envelope(t, stop - start, rate, 0.001, decay, 0.0, timbre['release'])
+            out[lo - block_start:hi - block_start] += 0.5 * gain * env * rng.standard_normal(len(t))
+            continue
+
+        freq = 440.0 * 2.0 ** ((pitch - 69.0) / 12.0)
+        num_harmonics = max(1, min(len(timbre['harmonics']), int((rate / 2) / freq)))
+        table = tables[name][num_harmonics - 1]
+        index = (t * (freq * TABLE_SIZE / rate)).astype(np.int64) % TABLE_SIZE
+        env = envelope(t, stop - start, rate, timbre['attack'], timbre['decay'], timbre['sustain'], timbre['release'])
+        out[lo - block_start:hi - block_start] += gain * env * table[index]
+
+    return out
+
+
+
+# Synthesizes a MIDI file block by block; yields interleaved 16 bit PCM bytes
+def render_pcm(music_file, rate=None, num_channels=None, block_size=None, seed=0):
+    rate = sample_rate if rate is None else rate
+    num_channels = channels if num_channels is None else num_channels
+    block_size = buffer * block_buffers if block_size is None else block_size
+
+    notes = load_notes(music_file, rate)
+    longest_release = max(max(t['release'] for t in TIMBRES.values()), DRUM['release'])
+    tail = int(longest_release * rate) + 1
+    total = int(notes['stop'].max()) + tail if len(notes['stop']) else 0
+    rng = np.random.default_rng(seed)
+    tables = build_tables()
+
+    # Notes sorted by start: only look at the ones that can still sound
+    first = 0
+    for block_start in range(0, total, block_size):
+        size = min(block_size, total - block_start)
+        while first < len(notes['start']) and notes['stop'][first] + tail <= block_start:
+            first += 1
+        last = np.searchsorted(notes['start'], block_start + size)
+        window = {key: value[first:last] for key, value in notes.items()}
 
+        mono = render_block(window, block_start, size, rate, rng, tables)
+        samples = np.tanh(mono)  # soft limiter instead of clipping
+        pcm = (samples * 32767).astype('<i2')
+        yield np.repeat(pcm, num_channels).tobytes()
 
 
-# Begins playback of a MIDI file
-def play_music(music_file):
 
+# Synthesizes a MIDI file into a WAV file, writing one block at a time. Returns the length in seconds
+def render_midi(music_file, wav_file, rate=None, num_channels=None, block_size=None, seed=0):
+    rate = sample_rate if rate is None else rate
+    num_channels = channels if num_channels is None else num_channels
+
+    num_bytes = 0
+    wave_file = wave.open(wav_file, 'wb')
+    wave_file.setnchannels(num_channels)
+    wave_file.setsampwidth(2)  # 16 bit
+    wave_file.setframerate(rate)
     try:
-        pygame.mixer.music.load(music_file)
-        
-    except pygame.error:
-        print ("Couldn't play %s! (%s)" % (music_file, pygame.get_error()))
-        return
-        
-    pygame.mixer.music.play()
+        for block in render_pcm(music_file, rate, num_channels, block_size, seed):
+            wave_file.writeframes(block)
+            num_bytes += len(block)
+    finally:
+        wave_file.close()
+
+    return num_bytes / (2 * num_channels * rate)
+
+
+
+# Synthesizes a MIDI file straight into ffmpeg's stdin and encodes it to MP3 (no intermediate WAV file).
+# Returns the length in seconds
+def render_mp3(music_file, mp3_file, rate=None, num_channels=None, block_size=None, seed=0):
+    rate = sample_rate if rate is None else rate
+    num_channels = channels if num_channels is None else num_channels
+
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 's16le', '-ar', str(rate), '-ac', str(num_channels), '-i', 'pipe:0',
+               '-f', 'mp3', '-ab', str(mp3_bitrate) + 'k', '-ac', str(num_channels), '-ar', str(rate),
+               '-vn', mp3_file]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    num_bytes = 0
+    try:
+        for block in render_pcm(music_file, rate, num_channels, block_size, seed):
+            process.stdin.write(block)
+            num_bytes += len(block)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its error is reported below
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    errors = process.stderr.read().decode(errors='replace').strip()
+    if process.wait() != 0:
+        raise RuntimeError("ffmpeg failed for %s: %s" % (mp3_file, errors or 'exit code %d' % process.returncode))
+
+    return num_bytes / (2 * num_channels * rate)
 
 
 
-# Init pygame playback
-bitsize = -16   # unsigned 16 bit
-pygame.mixer.init(sample_rate, bitsize, channels, buffer)
+#### BATCH CONVERSION ####
 
-# optional volume 0 to 1.0
-pygame.mixer.music.set_volume(1.0)
+RENDER_VERSION = 1                      # Bump when the synth changes, so existing outputs are re-rendered
+MANIFEST_NAME = '.midi_render.json'     # Kept in the output directory: source file -> what it was rendered from
 
-# Init pyAudio
-format = pyaudio.paInt16
-audio = pyaudio.PyAudio()
 
 
+# Settings that change the rendered output
+def render_settings(to_mp3):
+    return {'version': RENDER_VERSION, 'sample_rate': sample_rate, 'channels': channels,
+            'format': 'mp3' if to_mp3 else 'wav', 'mp3_bitrate': mp3_bitrate if to_mp3 else None}
 
-try:
 
-    # Make a list of .mid files in the current directory and all subdirectories
+
+# SHA-256 of a file, read in chunks
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+
+# Decides whether an output is up to date. Unchanged size + mtime means unchanged source;
+# otherwise the content hash decides (a touched or copied file with the same content is skipped).
+# Returns (up_to_date, sha256 or None if the file was not hashed, i.e. size and mtime were unchanged)
+def is_up_to_date(song, output, entry, settings):
+    if entry is None or not os.path.exists(output) or entry.get('settings') != settings:
+        return False, None
+    info = os.stat(song)
+    if entry.get('size') == info.st_size and entry.get('mtime_ns') == info.st_mtime_ns:
+        return True, None
+    sha256 = file_hash(song)
+    return sha256 == entry.get('sha256'), sha256
+
+
+
+# Renders one file (runs in a worker process). Writes to a temporary name and renames when done,
+# so an interrupted run never leaves a truncated file that looks up to date
+def convert_file(task):
+    song, output, to_mp3 = task
+    tmp_output = output + '.part'
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        if to_mp3:
+            length = render_mp3(song, tmp_output)
+        else:
+            length = render_midi(song, tmp_output)
+        os.replace(tmp_output, output)
+    except Exception as e:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        return song, None, str(e)
+    return song, length, time.perf_counter() - start
+
+
+
+# Renders every MIDI file under root_dir into out_dir (same relative paths) using a process pool.
+# Files whose output is up to date (see is_up_to_date) are skipped unless force is set.
+def convert_directory(root_dir='./', out_dir=None, workers=None, to_mp3=None, force=False):
+    out_dir = root_dir if out_dir is None else out_dir
+    to_mp3 = do_ffmpeg_convert if to_mp3 is None else to_mp3
+    workers = os.cpu_count() if workers is None else workers
+    settings = render_settings(to_mp3)
+
+    # Make a list of .mid files in root_dir and all subdirectories
     matches = []
-    for root, dirnames, filenames in os.walk("./"):
-        for filename in fnmatch.filter(filenames, '*.mid'):
-            matches.append(os.path.join(root, filename))
-            
-    # Play each song in the list
+    for root, dirnames, filenames in os.walk(root_dir):
+        for pattern in ('*.mid', '*.midi'):
+            for filename in fnmatch.filter(filenames, pattern):
+                matches.append(os.path.join(root, filename))
+    matches.sort()
+
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    tasks = []
+    hashes = {}
+    skipped = 0
     for song in matches:
+        relative = os.path.relpath(song, root_dir)
+        output = os.path.join(out_dir, os.path.splitext(relative)[0] + ('.mp3' if to_mp3 else '.wav'))
+        up_to_date, sha256 = (False, None) if force else is_up_to_date(song, output, manifest.get(relative), settings)
+        if up_to_date:
+            skipped += 1
+            if sha256 is not None:  # only hashed when the mtime changed: same content, remember the new mtime
+                info = os.stat(song)
+                manifest[relative].update(size=info.st_size, mtime_ns=info.st_mtime_ns)
+            continue
+        hashes[song] = sha256
+        tasks.append((song, output, to_mp3))
+    print("%d MIDI files, %d up to date, %d to render" % (len(matches), skipped, len(tasks)))
 
-        # Create a filename with a .wav extension
-        file_name = os.path.splitext(os.path.basename(song))[0]
-        new_file = file_name + '.wav'
-
-        # Open the stream and start recording
-        stream = audio.open(format=format, channels=channels, rate=sample_rate, input=True, input_device_index=input_device, frames_per_buffer=buffer)
-        
-        # Playback the song
-        print("Playing " + file_name + ".mid\n")
-        play_music(song)
-        
-        frames = []
-        
-        # Record frames while the song is playing
-        while pygame.mixer.music.get_busy():
-            frames.append(stream.read(buffer))
-            
-        # Stop recording
-        stream.stop_stream()
-        stream.close()
-
-        
-        # Configure wave file settings
-        wave_file = wave.open(new_file, 'wb')
-        wave_file.setnchannels(channels)
-        wave_file.setsampwidth(audio.get_sample_size(format))
-        wave_file.setframerate(sample_rate)
-        
-        print("Saving " + new_file)   
-        
-        # Write the frames to the wave file
-        wave_file.writeframes(b''.join(frames))
-        wave_file.close()
-        
-        # Call FFmpeg to handle the MP3 conversion if desired
-        if do_ffmpeg_convert:
-            os.system('ffmpeg -i ' + new_file + ' -y -f mp3 -ab ' + str(mp3_bitrate) + 'k -ac ' + str(channels) + ' -ar ' + str(sample_rate) + ' -vn ' + file_name + '.mp3')
-            
-            # Delete the WAV file if desired
-            if do_wav_cleanup:        
-                os.remove(new_file)
-        
-    # End PyAudio    
-    audio.terminate()    
- 
-except KeyboardInterrupt:
-    # if user hits Ctrl/C then exit
-    # (works only in console mode)
-    pygame.mixer.music.fadeout(1000)
-    pygame.mixer.music.stop()
-    raise SystemExit
\ No newline at end of file
+    def record(result):
+        song, length, detail = result
+        if length is None:
+            print("Couldn't render %s! (%s)" % (song, detail))
+            return
+        print("Rendered %s (%.1f s of audio in %.2f s)" % (song, length, detail))
+        info = os.stat(song)
+        manifest[os.path.relpath(song, root_dir)] = {'sha256': hashes[song] or file_hash(song),
+                                                     'size': info.st_size,
+                                                     'mtime_ns': info.st_mtime_ns,
+                                                     'settings': settings}
+
+    start = time.perf_counter()
+    try:
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(convert_file, tasks):
+                    record(result)
+        else:
+            for task in tasks:
+                record(convert_file(task))
+    finally:
+        # Save what finished even when interrupted
+        os.makedirs(out_dir, exist_ok=True)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    print("Done in %.2f s" % (time.perf_counter() - start))
+    return manifest
+
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render MIDI files to WAV/MP3 with the offline synth")
+    parser.add_argument('root', nargs='?', default='./', help="Directory searched recursively for *.mid / *.midi")
+    parser.add_argument('--out-dir', default=None, help="Output directory (default: next to each MIDI file)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--wav', action='store_true', help="Write WAV files instead of piping to ffmpeg for MP3")
+    parser.add_argument('--force', action='store_true', help="Re-render files that are up to date")
+    args = parser.parse_args()
+
+    convert_directory(args.root, args.out_dir, workers=args.workers,
+                      to_mp3=False if args.wav else None, force=args.force)
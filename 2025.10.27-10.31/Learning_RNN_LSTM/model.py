@@ -0,0 +1,961 @@
+'''
+model.py
+DeepJazzPyTorch 模型 (从 Learning_RNN_LSTM.ipynb 中移出，便于在脚本和子进程中复用)。
+'''
+
+import os
+import math
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional, Tuple
+
+INPUT_MODES = ('one_hot', 'embedding')
+
+class DeepJazzPyTorch(nn.Module):
+    """
+    Def LSTM
+    """
+    def __init__(self, n_values=155, n_a=64, input_mode='one_hot'):
+        """
+        Parameters:
+        n_values: Tokens long
+        n_a: hidden_layers_size
+        input_mode: 'one_hot' = 输入 one-hot 向量 (原版)；
+                    'embedding' = 直接输入 int64 token 索引，查表得到输入项
+        """
+        super(DeepJazzPyTorch, self).__init__()
+        
+        if input_mode not in INPUT_MODES:
+            raise ValueError(f"未知的 input_mode: '{input_mode}'，可选值为 {INPUT_MODES}")
+
+        self.n_values = n_values
+        self.n_a = n_a
+        self.input_mode = input_mode
+
+        if input_mode == 'one_hot':
+            self.lstm_cell = nn.LSTMCell(input_size=n_values, hidden_size=n_a)
+        else:
+            # one-hot 向量乘 weight_ih 等于取出 weight_ih 的一列，所以输入项可以直接查表：
+            # embedding.weight[k] = lstm_cell.weight_ih[:, k]，形状 (n_values, 4 * n_a)
+            self.embedding = nn.Embedding(n_values, 4 * n_a)
+            # 隐藏状态的投影: weight = lstm_cell.weight_hh, bias = bias_ih + bias_hh
+            self.recurrent = nn.Linear(in_features=n_a, out_features=4 * n_a)
+
+            # 与 nn.LSTMCell 相同的初始化
+            bound = 1.0 / math.sqrt(n_a)
+            for param in (self.embedding.weight, self.recurrent.weight, self.recurrent.bias):
+                nn.init.uniform_(param, -bound, bound)
+
+            # 加载旧的 (one_hot 模式) checkpoint 时自动转换参数
+            self.register_load_state_dict_pre_hook(self._convert_one_hot_checkpoint)
+
+        self.densor = nn.Linear(in_features=n_a, out_features=n_values)
+
+    def _convert_one_hot_checkpoint(self, module, state_dict, prefix, *args):
+        """
+        load_state_dict 的 pre-hook：遇到 one_hot 模式的参数 (lstm_cell.*) 时，
+        就地转换为等价的 embedding 模式参数。
+        """
+        if prefix + 'lstm_cell.weight_ih' in state_dict:
+            convert_one_hot_state_dict(state_dict, prefix)
+
+    def _input_gates(self, X):
+        """
+        embedding 模式：计算 4 个门的输入项 (不含偏置)。
+
+        Parameters:
+        X (torch.Tensor): int64 token 索引 (...,)；或 float 的 one-hot/零向量 (..., n_values)，
+                          用于兼容原来以 one-hot (或全零的初始输入) 调用的代码
+
+        Return:
+        gates (torch.Tensor): (..., 4 * n_a)
+        """
+        if X.is_floating_point():
+            return X @ self.embedding.weight
+        return self.embedding(X)
+
+    def _embedding_cell(self, x, state):
+        """
+        embedding 模式下的单步 LSTM，与 nn.LSTMCell 的计算完全相同 (门的顺序为 i, f, g, o)。
+
+        Parameters:
+        x (torch.Tensor): token 索引 (batch_size,) 或 one-hot (batch_size, n_values)
+        state (tuple): (a, c)，形状均为 (batch_size, n_a)
+
+        Return:
+        a, c (torch.Tensor): 新的隐藏状态和细胞状态
+        """
+        a, c = state
+        gates = self._input_gates(x) + self.recurrent(a)
+        i, f, g, o = gates.chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        a = torch.sigmoid(o) * torch.tanh(c)
+        return a, c
+
+    def _step(self, x, state):
+        """
+        单步 LSTM：按 input_mode 选择 LSTMCell 或查表的实现。
+        """
+        if self.input_mode == 'embedding':
+            return self._embedding_cell(x, state)
+        return self.lstm_cell(x, state)
+
+    def forward(self, X, a0=None, c0=None, fused=True, return_state=False):
+        """
+        Parameters:
+        X (torch.Tensor): (batch_size, Tx, n_values) 的 one-hot；
+                          embedding 模式下也可以是 (batch_size, Tx) 的 int64 token 索引
+        a0 (torch.Tensor): initial hidden layer (batch_size, n_a)
+        c0 (torch.Tensor): initial cell status (batch_size, n_a)
+        fused (bool): True = 整个窗口交给融合的 LSTM 序列算子 (CPU 上是 ATen 的
+                      序列 LSTM，GPU 上是 cuDNN)，densor 只对全部输出调用一次；
+                      False = 原来的逐时间步 LSTMCell 循环。两者使用同一组权重，结果一致
+        return_state (bool): True = 同时返回最后一步的 (a, c)，用于截断 BPTT 时
+                             把状态传给下一个块 (见 train_tbptt)
+        
+        Return:
+        outputs (torch.Tensor): 所有时间步的输出 logits，形状为 (batch_size, Tx, n_values)
+        a, c (torch.Tensor): return_state=True 时另外返回最后一步的状态 (batch_size, n_a)
+        """
+        
+        # 获取批次大小和序列长度
+        batch_size, Tx = X.shape[:2]
+        
+        # 初始化隐藏状态和细胞状态 (只给出其中一个视为调用错误)
+        if (a0 is None) != (c0 is None):
+            raise ValueError("a0 和 c0 必须同时给出，或者同时省略 (从零状态开始)")
+        if a0 is None and c0 is None:
+            a = torch.zeros(batch_size, self.n_a, device=X.device)
+            c = torch.zeros(batch_size, self.n_a, device=X.device)
+        else:
+            a, c = a0, c0
+
+        if fused:
+            outputs, a, c = self._forward_fused(X, a, c)
+            return (outputs, a, c) if return_state else outputs
+            
+        # 存储每一步的输出
+        outputs = []
+
+        for t in range(Tx):
+            # 从 X 中获取当前时间步的输入
+            # X: (batch_size, Tx, n_values)
+            x = X[:, t]
+
+            # 运行 LSTM 单元一步
+            a, c = self._step(x, (a, c))
+
+            # 用全连接层计算输出 logits
+            out = self.densor(a) # 形状: (batch_size, n_values)
+            
+            outputs.append(out)
+            
+        # 将 list of (batch_size, n_values) 堆叠成 (batch_size, Tx, n_values)
+        # 这对于计算损失函数很方便
+        outputs_tensor = torch.stack(outputs, dim=1)
+
+        if return_state:
+            return outputs_tensor, a, c
+        return outputs_tensor
+
+    def _forward_fused(self, X, a, c):
+        """
+        融合路径：直接把 lstm_cell 的参数传给 torch.lstm (nn.LSTM 内部调用的同一个算子)，
+        不额外注册 nn.LSTM 子模块，所以 state_dict 的键与旧的 checkpoint 完全相同，
+        generate 也继续使用同一个 lstm_cell。
+
+        Parameters:
+        X (torch.Tensor): (batch_size, Tx, n_values)，embedding 模式下也可以是 (batch_size, Tx)
+        a, c (torch.Tensor): 初始状态 (batch_size, n_a)
+
+        Return:
+        outputs (torch.Tensor): (batch_size, Tx, n_values)
+        a, c (torch.Tensor): 最后一步的状态 (batch_size, n_a)
+        """
+        if self.input_mode == 'embedding':
+            # 先查表得到整个窗口的输入项，再让序列算子用单位矩阵作为 weight_ih，
+            # 只负责循环部分 (weight_hh + 偏置)
+            X = self._input_gates(X)
+            eye = torch.eye(4 * self.n_a, dtype=X.dtype, device=X.device)
+            weights = [eye, self.recurrent.weight,
+                       self.recurrent.bias, torch.zeros_like(self.recurrent.bias)]
+        else:
+            cell = self.lstm_cell
+            weights = [cell.weight_ih, cell.weight_hh, cell.bias_ih, cell.bias_hh]
+
+        # torch.lstm 的状态形状是 (num_layers, batch_size, n_a)
+        hidden, a, c = torch.lstm(X, (a.unsqueeze(0), c.unsqueeze(0)), weights,
+                                  True,           # has_biases
+                                  1,              # num_layers
+                                  0.0,            # dropout
+                                  self.training,
+                                  False,          # bidirectional
+                                  True)           # batch_first
+
+        # (batch_size, Tx, n_a) -> (batch_size, Tx, n_values)，一次矩阵乘法
+        return self.densor(hidden), a.squeeze(0), c.squeeze(0)
+
+    def decode_step(self, x, a, c):
+        """
+        单步解码 (beam_search 使用)。
+
+        Parameters:
+        x (torch.Tensor): (batch_size,) 的 int64 token 索引，或 (batch_size, n_values) 的 one-hot/零向量
+        a, c (torch.Tensor): 当前状态 (batch_size, n_a)
+
+        Return:
+        logits (torch.Tensor): (batch_size, n_values)
+        a, c (torch.Tensor): 新的状态
+        """
+        if self.input_mode == 'one_hot' and not x.is_floating_point():
+            x = F.one_hot(x, num_classes=self.n_values).float()
+        a, c = self._step(x, (a, c))
+        return self.densor(a), a, c
+
+    def generate(self, x0, a0=None, c0=None, Ty=100, temperature=1.0,
+                 stop_durations=None, stop_at=None, top_k=0, top_p=1.0, grammar_mask=None):
+        """
+        Parameters:
+        x0 (torch.Tensor): (batch_size, n_values)---起始音节
+                           (embedding 模式下也可以是 (batch_size,) 的 int64 token 索引)
+        X (torch.Tensor): (batch_size, Tx, n_values)
+        a0 (torch.Tensor): initial hidden layer (batch_size, n_a)
+        c0 (torch.Tensor): initial cell status (batch_size, n_a)
+        Ty (int): 要生成的时间步数量 (提前结束时为上限)
+        temperature(float): 采样温度 0.0 = argmax, >0 = 随机采样
+        stop_durations (torch.Tensor): (n_values,) 每个 token 的时值 (quarterLength)；
+                                       给出时按累计时值提前结束 (None = 固定生成 Ty 步)
+        stop_at (torch.Tensor): (batch_size,) 每个序列的目标总时值 (例如小节长度)，
+                                累计时值达到它之后该序列结束，其余位置填 -1；
+                                所有序列都结束后停止解码
+        top_k (int): temperature > 0 时只在概率最高的 k 个 token 中采样 (0 = 不限制)
+        top_p (float): temperature > 0 时只在累计概率达到 p 的最小 token 集合中采样 (nucleus，1.0 = 不限制)
+        grammar_mask (tuple): build_grammar_mask 的结果 (allowed, transitions)，
+                              每一步屏蔽在当前语法状态下无效的 token (None = 不屏蔽)
+        
+        Return: 
+        generated_indices (torch.Tensor): 生成的 token 索引，形状 (batch_size, Ty)；
+                                          提前结束时为 (batch_size, 实际步数)
+        """
+        return self.generate_with_state(x0, a0, c0, Ty=Ty, temperature=temperature,
+                                        stop_durations=stop_durations, stop_at=stop_at,
+                                        top_k=top_k, top_p=top_p, grammar_mask=grammar_mask)[0]
+
+    def generate_with_state(self, x0, a0=None, c0=None, Ty=100, temperature=1.0,
+                            stop_durations=None, stop_at=None, top_k=0, top_p=1.0, grammar_mask=None):
+        """
+        与 generate 相同 (参数同 generate)，但同时返回最后的 LSTM 状态，
+        便于下一段生成接着当前状态继续 (见 data_utils.generate_music_stream)。
+
+        Return:
+        generated_indices (torch.Tensor): 生成的 token 索引，形状 (batch_size, Ty)
+        a (torch.Tensor): 最后一步的隐藏状态 (batch_size, n_a)
+        c (torch.Tensor): 最后一步的细胞状态 (batch_size, n_a)
+        """
+
+        batch_size = x0.shape[0]
+        
+        # 1. 初始化状态 (同 forward)
+        if (a0 is None) != (c0 is None):
+            raise ValueError("a0 和 c0 必须同时给出，或者同时省略 (从零状态开始)")
+        if a0 is None and c0 is None:
+            a = torch.zeros(batch_size, self.n_a, device=x0.device)
+            c = torch.zeros(batch_size, self.n_a, device=x0.device)
+        else:
+            a, c = a0, c0
+            
+        # 初始输入
+        x = x0
+        
+        # 存储生成的 token 索引
+        generated_indices = []
+
+        # 提前结束：记录每个序列的累计时值
+        if stop_durations is not None:
+            elapsed = torch.zeros(batch_size, dtype=torch.float64, device=x0.device)
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=x0.device)
+
+        # 语法状态：每个序列都从状态 0 (还没有音符) 开始
+        if grammar_mask is not None:
+            allowed, transitions = grammar_mask
+            grammar_state = torch.zeros(batch_size, dtype=torch.long, device=x0.device)
+        
+        for t in range(Ty):
+            # 运行 LSTM 单元一步
+            a, c = self._step(x, (a, c))
+            
+            # 计算输出 logits
+            out = self.densor(a) # (batch_size, n_values)
+
+            if grammar_mask is not None:
+                out = out.masked_fill(~allowed[grammar_state], float('-inf'))
+            
+            if temperature == 0.0:
+                next_token_idx = torch.argmax(out, dim=1)
+            else:
+                logits_with_temp = filter_logits(out / temperature, top_k, top_p)
+                probs = F.softmax(logits_with_temp, dim=1)
+
+                next_token_idx = torch.multinomial(probs, num_samples=1)
+                next_token_idx = next_token_idx.squeeze(1)
+
+            if grammar_mask is not None:
+                grammar_state = transitions[grammar_state, next_token_idx]
+            # 存储这个索引
+            if stop_durations is not None:
+                generated_indices.append(next_token_idx.masked_fill(finished, -1))
+                elapsed += stop_durations[next_token_idx]
+                finished |= elapsed >= stop_at
+            else:
+                generated_indices.append(next_token_idx)
+            
+            # 将索引转换回 One-Hot 向量，作为下一步的输入
+            # (embedding 模式直接用索引查表，不需要 One-Hot)
+            if self.input_mode == 'embedding':
+                x = next_token_idx
+            else:
+                x = F.one_hot(next_token_idx, num_classes=self.n_values).float()
+
+            if stop_durations is not None and bool(finished.all()):
+                break
+
+        # 堆叠所有生成的索引
+        # list of (batch_size,) 堆叠成 (batch_size, Ty)
+        generated_indices_tensor = torch.stack(generated_indices, dim=1)
+        
+        return generated_indices_tensor, a, c
+
+    def beam_search(self, x0, a0=None, c0=None, Ty=100, beam_width=4, grammar_mask=None,
+                    stop_durations=None, stop_at=None, length_penalty=1.0):
+        """
+        批量 beam search，参数与返回值见模块函数 beam_search。
+        """
+        return beam_search(self, x0, a0, c0, Ty=Ty, beam_width=beam_width, grammar_mask=grammar_mask,
+                           stop_durations=stop_durations, stop_at=stop_at, length_penalty=length_penalty)
+
+def filter_logits(logits: torch.Tensor, top_k: int = 0, top_p: float = 1.0) -> torch.Tensor:
+    """
+    top-k / nucleus (top-p) 过滤：把不参与采样的 token 的 logits 设为 -inf。
+    整批一次完成，不逐行循环 (DeepJazzPyTorch 与 ScriptedDecoder 共用)。
+
+    Parameters:
+    logits (torch.Tensor): (batch_size, n_values)，已经除以温度
+    top_k (int): 只保留每行最大的 k 个 (0 = 不限制)
+    top_p (float): 只保留累计概率达到 p 的最小集合 (1.0 = 不限制)，概率最高的 token 总是保留
+
+    Return:
+    logits (torch.Tensor): 过滤后的 logits (新张量)
+    """
+    if top_k > 0 and top_k < logits.size(1):
+        kth = torch.topk(logits, top_k, dim=1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, dim=1, descending=True)
+        sorted_probs = F.softmax(sorted_logits, dim=1)
+        # 之前 token 的累计概率已经达到 top_p 的 token 被去掉
+        sorted_remove = (torch.cumsum(sorted_probs, dim=1) - sorted_probs) >= top_p
+        remove = torch.zeros_like(sorted_remove).scatter(1, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, float('-inf'))
+    return logits
+
+GRAMMAR_STATES = 2 # 0 = 小节内还没有音符，1 = 已经有音符 (之后的音程 token 才有意义)
+
+def build_grammar_mask(indices_val, n_values, device='cpu'):
+    """
+    从词汇表构建语法有效性掩码 (一个在 device 上查表的小状态机)。
+
+    token 的格式为 '类型,时值[,<音程上限,音程下限>]'。规则:
+    - 无法解析的 token (例如 '<unk>')、时值 <= 0 的 token 在任何状态下都无效；
+    - 带音程的 token 描述相对上一个音符的移动，小节内第一个音符之前无效
+      (unparse_grammar 会忽略它的音程，模型的这一步等于白费)；
+    - 生成音符 (非 'R') 之后进入状态 1，之后所有有效 token 都允许。
+
+    Parameters:
+    indices_val (dict): 索引 -> token
+    n_values (int): 词汇表大小
+    device (str): 'cpu' 或 'cuda'
+
+    Return:
+    allowed (torch.Tensor): (GRAMMAR_STATES, n_values) bool，状态下允许的 token
+    transitions (torch.Tensor): (GRAMMAR_STATES, n_values) int64，生成 token 后的下一个状态
+    """
+    allowed = torch.zeros(GRAMMAR_STATES, n_values, dtype=torch.bool)
+    transitions = torch.arange(GRAMMAR_STATES).unsqueeze(1).repeat(1, n_values)
+    for idx, token in indices_val.items():
+        terms = token.split(',')
+        if len(terms) < 2 or terms[0] not in ('C', 'S', 'A', 'X', 'R'):
+            continue
+        try:
+            duration = float(terms[1])
+        except ValueError:
+            continue
+        if duration <= 0:
+            continue
+
+        allowed[1, idx] = True
+        allowed[0, idx] = len(terms) == 2
+        if terms[0] != 'R':
+            transitions[:, idx] = 1
+
+    if not allowed[0].any():
+        raise ValueError("词汇表中没有可以作为小节开头的 token，无法构建语法掩码")
+    return allowed.to(device), transitions.to(device)
+
+def beam_search(model, x0, a0=None, c0=None, Ty=100, beam_width=4, grammar_mask=None,
+                stop_durations=None, stop_at=None, length_penalty=1.0):
+    """
+    批量 beam search：batch 中每个序列保留 beam_width 个候选，所有候选拼成
+    (batch_size * beam_width) 的一个 batch 同时解码，选择/重排都是张量操作，不逐个候选循环。
+
+    给出 grammar_mask 时，无效 token 的对数概率为 -inf，走进死路的候选在 topk 中直接被淘汰。
+    给出 stop_durations/stop_at 时，填满小节的候选不再扩展 (分数保持不变，之后的位置为 -1)，
+    所有候选都结束后停止解码。
+
+    Parameters:
+    model: DeepJazzPyTorch 或 ScriptedDecoder (需要 decode_step 方法)
+    x0 (torch.Tensor): (batch_size, n_values) 的 one-hot/零向量，或 (batch_size,) 的 int64 token 索引
+    a0, c0 (torch.Tensor): 初始状态 (batch_size, n_a)
+    Ty (int): 最多解码的步数
+    beam_width (int): 每个序列保留的候选数 (1 = 贪心，等于 temperature=0.0 的 generate)
+    grammar_mask (tuple): build_grammar_mask 的结果 (None = 不屏蔽)
+    stop_durations, stop_at (torch.Tensor): 按累计时值提前结束，同 DeepJazzPyTorch.generate
+    length_penalty (float): 最后选择候选时用 对数概率之和 / 长度**length_penalty 比较
+                            (提前结束时各候选长度不同；0.0 = 直接比较对数概率之和)
+
+    Return:
+    generated_indices (torch.Tensor): 每个序列最好的候选 (batch_size, 步数)，结束后的位置为 -1
+    a, c (torch.Tensor): 最好的候选最后的状态 (batch_size, n_a)
+    scores (torch.Tensor): 最好的候选的分数 (batch_size,)，即上面归一化后的对数概率
+    """
+    batch_size = x0.shape[0]
+    device = x0.device
+    n_values = model.n_values
+    width = beam_width
+
+    # 初始状态的规则同 DeepJazzPyTorch.forward
+    if (a0 is None) != (c0 is None):
+        raise ValueError("a0 和 c0 必须同时给出，或者同时省略 (从零状态开始)")
+    if a0 is None or c0 is None:
+        a0 = torch.zeros(batch_size, model.n_a, device=device)
+        c0 = torch.zeros(batch_size, model.n_a, device=device)
+
+    # (batch_size, ...) -> (batch_size * width, ...)，第 b 个序列的候选在 b * width ... b * width + width - 1 行
+    x = x0.repeat_interleave(width, dim=0)
+    a = a0.repeat_interleave(width, dim=0)
+    c = c0.repeat_interleave(width, dim=0)
+
+    # 开始时所有候选相同，只保留第一个，否则 topk 会选出 width 份一样的序列
+    scores = torch.full((batch_size, width), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    lengths = torch.zeros(batch_size, width, device=device)
+    history = torch.empty(batch_size, width, 0, dtype=torch.long, device=device)
+    row_offsets = (torch.arange(batch_size, device=device) * width).unsqueeze(1)
+
+    if grammar_mask is not None:
+        allowed, transitions = grammar_mask
+        grammar_state = torch.zeros(batch_size * width, dtype=torch.long, device=device)
+
+    finished = torch.zeros(batch_size * width, dtype=torch.bool, device=device)
+    if stop_durations is not None:
+        elapsed = torch.zeros(batch_size * width, dtype=torch.float64, device=device)
+        stop_at = stop_at.repeat_interleave(width)
+        # 已经结束的候选只有一个后续 (填充，对数概率 0)，分数保持不变
+        finished_log_probs = torch.full((n_values,), float('-inf'), device=device)
+        finished_log_probs[0] = 0.0
+
+    for t in range(Ty):
+        logits, a_next, c_next = model.decode_step(x, a, c)
+        log_probs = F.log_softmax(logits.float(), dim=1)
+        if stop_durations is not None:
+            # 已经结束的候选保持结束时的状态 (返回给调用方接着生成)
+            a_next = torch.where(finished.unsqueeze(1), a, a_next)
+            c_next = torch.where(finished.unsqueeze(1), c, c_next)
+        a, c = a_next, c_next
+
+        if grammar_mask is not None:
+            log_probs = log_probs.masked_fill(~allowed[grammar_state], float('-inf'))
+        if stop_durations is not None:
+            log_probs = torch.where(finished.unsqueeze(1), finished_log_probs, log_probs)
+
+        # 每个序列在 width * n_values 个扩展中选出最好的 width 个
+        candidates = scores.unsqueeze(2) + log_probs.view(batch_size, width, n_values)
+        scores, flat_indices = candidates.view(batch_size, -1).topk(width, dim=1)
+        origins = torch.div(flat_indices, n_values, rounding_mode='floor') # 来自哪个候选
+        tokens = (flat_indices % n_values).view(-1)
+        rows = (origins + row_offsets).view(-1)
+
+        a, c = a[rows], c[rows]
+        was_finished = finished[rows]
+        history = torch.cat([history.gather(1, origins.unsqueeze(2).expand(-1, -1, t)),
+                             tokens.masked_fill(was_finished, -1).view(batch_size, width, 1)], dim=2)
+        lengths = lengths.gather(1, origins) + (~was_finished).view(batch_size, width)
+
+        if grammar_mask is not None:
+            grammar_state = transitions[grammar_state[rows], tokens]
+        x = tokens
+
+        if stop_durations is not None:
+            elapsed = elapsed[rows] + stop_durations[tokens]
+            finished = was_finished | (elapsed >= stop_at)
+            if bool(finished.all()):
+                break
+
+    normalized = scores / lengths.clamp(min=1.0) ** length_penalty
+    best_scores, best = normalized.max(dim=1)
+    best_rows = best + row_offsets.squeeze(1)
+    generated_indices = history[torch.arange(batch_size, device=device), best]
+    return generated_indices, a[best_rows], c[best_rows], best_scores
+
+def convert_one_hot_state_dict(state_dict, prefix=''):
+    """
+    把 one_hot 模式 (LSTMCell) 的参数就地转换为 embedding 模式的等价参数，
+    转换后的模型对任意 token 序列给出相同的输出。
+
+    Parameters:
+    state_dict (dict): model.state_dict() 或 torch.load 的结果 (会被修改)
+    prefix (str): 参数名前缀 (模型作为子模块时使用)
+
+    Return:
+    state_dict (dict): 同一个字典
+    """
+    weight_ih = state_dict.pop(prefix + 'lstm_cell.weight_ih')
+    weight_hh = state_dict.pop(prefix + 'lstm_cell.weight_hh')
+    bias_ih = state_dict.pop(prefix + 'lstm_cell.bias_ih')
+    bias_hh = state_dict.pop(prefix + 'lstm_cell.bias_hh')
+
+    state_dict[prefix + 'embedding.weight'] = weight_ih.t().contiguous()
+    state_dict[prefix + 'recurrent.weight'] = weight_hh
+    state_dict[prefix + 'recurrent.bias'] = bias_ih + bias_hh
+    return state_dict
+
+class ScriptedDecoder(nn.Module):
+    """
+    可以用 torch.jit.script 编译的解码器 (LSTM 单元 + densor + 温度采样)。
+
+    参数在构造时从 DeepJazzPyTorch 拷贝 (one_hot 模式会先转换为等价的查表形式)，
+    之后与原模型无关。保存 (export_decoder) 后的文件可以直接用 torch.jit.load
+    加载，不需要 notebook/model.py 中的类定义。
+
+    提供与 DeepJazzPyTorch.generate 相同签名的 generate 方法，所以可以直接传给
+    generate_music 代替原模型。
+
+    Parameters:
+    model (DeepJazzPyTorch): 训练好的模型 (任意 input_mode)
+    """
+    def __init__(self, model):
+        super(ScriptedDecoder, self).__init__()
+
+        state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        if 'lstm_cell.weight_ih' in state_dict:
+            convert_one_hot_state_dict(state_dict)
+
+        self.n_values = model.n_values
+        self.n_a = model.n_a
+
+        # 预先转置，循环中直接用 addmm
+        self.register_buffer('embedding', state_dict['embedding.weight'])              # (n_values, 4 * n_a)
+        self.register_buffer('recurrent_weight', state_dict['recurrent.weight'].t().contiguous()) # (n_a, 4 * n_a)
+        self.register_buffer('recurrent_bias', state_dict['recurrent.bias'])           # (4 * n_a,)
+        self.register_buffer('densor_weight', state_dict['densor.weight'].t().contiguous())       # (n_a, n_values)
+        self.register_buffer('densor_bias', state_dict['densor.bias'])                 # (n_values,)
+
+    def forward(self,
+                x0: torch.Tensor,
+                a0: Optional[torch.Tensor] = None,
+                c0: Optional[torch.Tensor] = None,
+                Ty: int = 100,
+                temperature: float = 1.0,
+                stop_durations: Optional[torch.Tensor] = None,
+                stop_at: Optional[torch.Tensor] = None,
+                top_k: int = 0,
+                top_p: float = 1.0,
+                grammar_mask: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> torch.Tensor:
+        """
+        参数与返回值同 DeepJazzPyTorch.generate。
+        """
+        return self.generate_with_state(x0, a0, c0, Ty, temperature, stop_durations, stop_at,
+                                        top_k, top_p, grammar_mask)[0]
+
+    @torch.jit.export
+    def decode_step(self,
+                    x: torch.Tensor,
+                    a: torch.Tensor,
+                    c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        单步解码，同 DeepJazzPyTorch.decode_step (beam_search 使用)。
+        """
+        if x.is_floating_point():
+            gates_x = torch.mm(x, self.embedding)
+        else:
+            gates_x = self.embedding.index_select(0, x)
+        gates = torch.addmm(self.recurrent_bias, a, self.recurrent_weight) + gates_x
+        i, f, g, o = gates.chunk(4, 1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        a = torch.sigmoid(o) * torch.tanh(c)
+        return torch.addmm(self.densor_bias, a, self.densor_weight), a, c
+
+    @torch.jit.export
+    def generate_with_state(self,
+                            x0: torch.Tensor,
+                            a0: Optional[torch.Tensor] = None,
+                            c0: Optional[torch.Tensor] = None,
+                            Ty: int = 100,
+                            temperature: float = 1.0,
+                            stop_durations: Optional[torch.Tensor] = None,
+                            stop_at: Optional[torch.Tensor] = None,
+                            top_k: int = 0,
+                            top_p: float = 1.0,
+                            grammar_mask: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Parameters:
+        x0 (torch.Tensor): (batch_size, n_values) 的 one-hot/零向量，或 (batch_size,) 的 int64 token 索引
+        a0 (torch.Tensor): initial hidden layer (batch_size, n_a)
+        c0 (torch.Tensor): initial cell status (batch_size, n_a)
+        Ty (int): 要生成的时间步数量 (提前结束时为上限)
+        temperature(float): 采样温度 0.0 = argmax, >0 = 随机采样
+        stop_durations, stop_at (torch.Tensor): 按累计时值提前结束，同 DeepJazzPyTorch.generate
+        top_k, top_p, grammar_mask: 采样过滤与语法掩码，同 DeepJazzPyTorch.generate
+
+        Return:
+        generated_indices (torch.Tensor): 生成的 token 索引，形状 (batch_size, Ty)
+                                          (提前结束时为 (batch_size, 实际步数)，结束后的位置为 -1)
+        a, c (torch.Tensor): 最后一步的隐藏状态和细胞状态 (batch_size, n_a)
+        """
+        batch_size = x0.size(0)
+
+        if (a0 is None) != (c0 is None):
+            raise ValueError("a0 和 c0 必须同时给出，或者同时省略 (从零状态开始)")
+        if a0 is None or c0 is None:
+            a = torch.zeros(batch_size, self.n_a, dtype=self.embedding.dtype, device=x0.device)
+            c = torch.zeros(batch_size, self.n_a, dtype=self.embedding.dtype, device=x0.device)
+        else:
+            a = a0
+            c = c0
+
+        # 第一步的输入项
+        if x0.is_floating_point():
+            gates_x = torch.mm(x0, self.embedding)
+        else:
+            gates_x = self.embedding.index_select(0, x0)
+
+        # 预先分配输出
+        generated_indices = torch.empty(batch_size, Ty, dtype=torch.long, device=x0.device)
+        num_steps = Ty
+
+        # 提前结束：记录每个序列的累计时值
+        elapsed = torch.zeros(batch_size, dtype=torch.float64, device=x0.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=x0.device)
+
+        # 语法状态 (见 build_grammar_mask)
+        grammar_state = torch.zeros(batch_size, dtype=torch.long, device=x0.device)
+
+        for t in range(Ty):
+            gates = torch.addmm(self.recurrent_bias, a, self.recurrent_weight) + gates_x
+            i, f, g, o = gates.chunk(4, 1)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            a = torch.sigmoid(o) * torch.tanh(c)
+
+            out = torch.addmm(self.densor_bias, a, self.densor_weight)
+
+            if grammar_mask is not None:
+                out = out.masked_fill(~grammar_mask[0].index_select(0, grammar_state), float('-inf'))
+
+            if temperature == 0.0:
+                next_token_idx = torch.argmax(out, dim=1)
+            else:
+                probs = F.softmax(filter_logits(out / temperature, top_k, top_p), dim=1)
+                next_token_idx = torch.multinomial(probs, num_samples=1).squeeze(1)
+
+            if grammar_mask is not None:
+                grammar_state = grammar_mask[1][grammar_state, next_token_idx]
+
+            gates_x = self.embedding.index_select(0, next_token_idx)
+
+            if stop_durations is not None and stop_at is not None:
+                generated_indices[:, t] = next_token_idx.masked_fill(finished, -1)
+                elapsed += stop_durations.index_select(0, next_token_idx).to(torch.float64)
+                finished |= elapsed >= stop_at
+                if bool(finished.all()):
+                    num_steps = t + 1
+                    break
+            else:
+                generated_indices[:, t] = next_token_idx
+
+        return generated_indices[:, :num_steps], a, c
+
+    @torch.jit.export
+    def generate(self,
+                 x0: torch.Tensor,
+                 a0: Optional[torch.Tensor] = None,
+                 c0: Optional[torch.Tensor] = None,
+                 Ty: int = 100,
+                 temperature: float = 1.0,
+                 stop_durations: Optional[torch.Tensor] = None,
+                 stop_at: Optional[torch.Tensor] = None,
+                 top_k: int = 0,
+                 top_p: float = 1.0,
+                 grammar_mask: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> torch.Tensor:
+        """
+        与 DeepJazzPyTorch.generate 相同的接口，参数见 generate_with_state。
+        """
+        return self.forward(x0, a0, c0, Ty, temperature, stop_durations, stop_at,
+                            top_k, top_p, grammar_mask)
+
+def script_decoder(model):
+    """
+    Parameters:
+    model (DeepJazzPyTorch): 训练好的模型
+
+    Return:
+    decoder (torch.jit.ScriptModule): 编译好的解码器 (eval 模式)
+    """
+    return torch.jit.script(ScriptedDecoder(model).eval())
+
+def export_decoder(model, path):
+    """
+    把模型编译为 TorchScript 解码器并保存，服务端用 load_decoder (或 torch.jit.load) 加载。
+
+    Parameters:
+    model (DeepJazzPyTorch): 训练好的模型
+    path (str): 输出文件路径 (例如 'decoder.pt')
+
+    Return:
+    decoder (torch.jit.ScriptModule): 编译好的解码器
+    """
+    decoder = script_decoder(model)
+    decoder.save(path)
+    return decoder
+
+def load_decoder(path, device='cpu'):
+    """
+    Parameters:
+    path (str): export_decoder 保存的文件
+    device (str): 'cpu' 或 'cuda'
+
+    Return:
+    decoder (torch.jit.ScriptModule): 可以直接调用 decoder.generate(...) 的解码器
+    """
+    return torch.jit.load(path, map_location=device).eval()
+
+def benchmark_decode(model, batch_size=1, Ty_values=(50, 300), repeats=20, temperature=0.0, device='cpu'):
+    """
+    比较 eager 的 model.generate 与 TorchScript 解码器的单次调用延迟 (均在 inference_mode 下)。
+
+    Parameters:
+    model (DeepJazzPyTorch): 要测试的模型
+    batch_size (int): 一次解码的序列数 (服务端单请求通常为 1)
+    Ty_values (tuple[int]): 要测试的生成长度
+    repeats (int): 每种情况计时的调用次数 (另外先预热两次)
+    temperature (float): 采样温度
+    device (str): 'cpu' 或 'cuda'
+
+    Return:
+    results (dict): {Ty: {'eager': 毫秒/次, 'scripted': 毫秒/次}}
+    """
+    model = model.to(device).eval()
+    decoders = (('eager', model), ('scripted', script_decoder(model).to(device)))
+    x0 = torch.zeros(batch_size, model.n_values, device=device)
+
+    results = {}
+    with torch.inference_mode():
+        for Ty in Ty_values:
+            results[Ty] = {}
+            for name, decoder in decoders:
+                for i in range(repeats + 2):
+                    if i == 2: # 前两次调用用于预热 (TorchScript 在前几次调用时做优化)，不计时
+                        if device != 'cpu':
+                            torch.cuda.synchronize()
+                        start = time.perf_counter()
+                    decoder.generate(x0, Ty=Ty, temperature=temperature)
+                if device != 'cpu':
+                    torch.cuda.synchronize()
+                results[Ty][name] = (time.perf_counter() - start) / repeats * 1000.0
+
+    return results
+
+def benchmark_forward(n_values=155, n_a=64, batch_size=64, Tx=300, repeats=5, device='cpu',
+                      input_mode='one_hot'):
+    """
+    比较逐时间步 LSTMCell 循环与融合 LSTM 路径的训练吞吐量 (前向 + 反向)。
+
+    Parameters:
+    n_values (int): 词汇表大小
+    n_a (int): 隐藏层维度
+    batch_size (int): 每个 batch 的窗口数
+    Tx (int): 窗口长度
+    repeats (int): 计时的迭代次数 (另外先预热一次)
+    device (str): 'cpu' 或 'cuda'
+    input_mode (str): 'one_hot' 或 'embedding'
+
+    Return:
+    results (dict): {'stepwise': tokens/sec, 'fused': tokens/sec}
+    """
+    model = DeepJazzPyTorch(n_values=n_values, n_a=n_a, input_mode=input_mode).to(device)
+    model.train()
+    criterion = nn.CrossEntropyLoss()
+
+    seq = torch.randint(n_values, (batch_size, Tx), device=device)
+    labels = torch.randint(n_values, (batch_size, Tx), device=device)
+    X = seq if input_mode == 'embedding' else F.one_hot(seq, n_values).float()
+
+    results = {}
+    for name, fused in (('stepwise', False), ('fused', True)):
+        for i in range(repeats + 1):
+            if i == 1: # 第一次迭代用于预热，不计时
+                if device != 'cpu':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            model.zero_grad()
+            logits = model(X, fused=fused)
+            loss = criterion(logits.reshape(-1, n_values), labels.reshape(-1))
+            loss.backward()
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        results[name] = batch_size * Tx * repeats / elapsed
+
+    return results
+
+def save_checkpoint(path, model, optimizer, progress):
+    """
+    保存训练 checkpoint (模型、优化器和训练进度)。先写临时文件再改名，
+    写到一半被中断时不会损坏已有的 checkpoint。
+
+    Parameters:
+    path (str): checkpoint 文件路径
+    model (DeepJazzPyTorch): 模型
+    optimizer (torch.optim.Optimizer): 优化器
+    progress (dict): 训练进度 (见 train_tbptt)，其中的张量会一起保存
+    """
+    tmp_path = path + '.tmp'
+    torch.save({'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'progress': progress}, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, model, optimizer=None, device='cpu'):
+    """
+    Parameters:
+    path (str): save_checkpoint 保存的文件
+    model (DeepJazzPyTorch): 要恢复的模型 (参数就地加载)
+    optimizer (torch.optim.Optimizer): 要恢复的优化器 (None = 只加载模型)
+    device (str): 'cpu' 或 'cuda'
+
+    Return:
+    progress (dict): 保存时的训练进度
+    """
+    checkpoint = torch.load(path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    return checkpoint['progress']
+
+def train_tbptt(model, streams, optimizer, epochs=100, device='cpu', criterion=None,
+                checkpoint_path=None, checkpoint_every=50, resume=True, clip_grad_norm=None,
+                log_every=10):
+    """
+    截断 BPTT 的有状态训练：streams (data_utils.CorpusStreamDataset) 的块按顺序训练，
+    每个块结束时的 (a, c) detach 后作为下一个块的初始状态，所以模型能学到比 Tx 更长的上下文，
+    而每个 token 每个 epoch 只前向/反向一次 (重叠窗口 step=1 时约为 Tx 次)。
+    每个 epoch 开始时状态清零。
+
+    给出 checkpoint_path 时，每 checkpoint_every 个块以及每个 epoch 结束时保存 checkpoint，
+    其中包括优化器状态和流的状态 (当前 epoch、下一个块的序号、块之间传递的 (a, c)、损失记录)；
+    resume=True 且文件存在时从中断的位置继续，结果与不中断时相同。
+
+    Parameters:
+    model (DeepJazzPyTorch): 要训练的模型 (已在 device 上)
+    streams (CorpusStreamDataset): 训练数据
+    optimizer (torch.optim.Optimizer): 优化器
+    epochs (int): 总 epoch 数 (恢复时包括已经完成的 epoch)
+    device (str): 'cpu' 或 'cuda'
+    criterion: 损失函数 (None = nn.CrossEntropyLoss())
+    checkpoint_path (str): checkpoint 文件路径 (None = 不保存)
+    checkpoint_every (int): 每多少个块保存一次 (0 = 只在 epoch 结束时保存)
+    resume (bool): checkpoint 存在时是否从中恢复
+    clip_grad_norm (float): 梯度裁剪的最大范数 (None = 不裁剪)
+    log_every (int): 每多少个 epoch 打印一次损失
+
+    Return:
+    train_losses (list[float]): 每个 epoch 的平均损失
+    """
+    if criterion is None:
+        criterion = nn.CrossEntropyLoss()
+
+    layout = {'batch_size': streams.batch_size, 'Tx': streams.Tx,
+              'stream_length': streams.stream_length}
+    zero_state = lambda: (torch.zeros(streams.batch_size, model.n_a, device=device),
+                          torch.zeros(streams.batch_size, model.n_a, device=device))
+
+    progress = {'epoch': 0, 'chunk': 0, 'epoch_loss': 0.0, 'train_losses': [],
+                'layout': layout, 'state': zero_state()}
+    if checkpoint_path is not None and resume and os.path.exists(checkpoint_path):
+        progress = load_checkpoint(checkpoint_path, model, optimizer, device)
+        if progress['layout'] != layout:
+            raise ValueError(f"checkpoint 的数据划分 {progress['layout']} 与当前的 {layout} 不同，无法继续训练")
+        print(f"从 checkpoint 恢复: epoch {progress['epoch'] + 1}, 块 {progress['chunk']}/{len(streams)}")
+
+    num_chunks = len(streams)
+    model.train()
+    while progress['epoch'] < epochs:
+        a, c = progress['state']
+        for i in range(progress['chunk'], num_chunks):
+            seq, labels = streams[i]
+            seq, labels = seq.to(device), labels.to(device)
+            if model.input_mode == 'one_hot':
+                seq = F.one_hot(seq, model.n_values).float()
+
+            Y_pred_logits, a, c = model(seq, a, c, return_state=True)
+            loss = criterion(Y_pred_logits.reshape(-1, model.n_values), labels.reshape(-1))
+
+            optimizer.zero_grad()
+            loss.backward()
+            if clip_grad_norm is not None:
+                nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
+            optimizer.step()
+
+            # 截断：状态带到下一个块，但梯度不再穿过块的边界
+            a, c = a.detach(), c.detach()
+            progress['epoch_loss'] += loss.item()
+            progress['chunk'] = i + 1
+            progress['state'] = (a, c)
+
+            if (checkpoint_path is not None and checkpoint_every
+                    and progress['chunk'] % checkpoint_every == 0 and progress['chunk'] < num_chunks):
+                save_checkpoint(checkpoint_path, model, optimizer, progress)
+
+        avg_epoch_loss = progress['epoch_loss'] / num_chunks
+        progress['train_losses'].append(avg_epoch_loss)
+        progress['epoch'] += 1
+        progress['chunk'] = 0
+        progress['epoch_loss'] = 0.0
+        progress['state'] = zero_state()
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, model, optimizer, progress)
+
+        if log_every and progress['epoch'] % log_every == 0:
+            print(f'Epoch: {progress["epoch"]:3d}/{epochs}, Loss: {avg_epoch_loss:.6f}')
+
+    return progress['train_losses']
+
+
+# ------------------------------------------------------------------
+# 示例用法 (main guard)：python model.py
+# ------------------------------------------------------------------
+if __name__ == "__main__":
+    for input_mode in INPUT_MODES:
+        results = benchmark_forward(device='cpu', input_mode=input_mode)
+        print(f"[{input_mode}]")
+        print(f"  逐时间步 LSTMCell: {results['stepwise']:,.0f} tokens/sec")
+        print(f"  融合 LSTM:         {results['fused']:,.0f} tokens/sec")
+        print(f"  加速比: {results['fused'] / results['stepwise']:.2f}x")
+
+    model = DeepJazzPyTorch()
+    if os.path.exists('generate_music_model.pth'):
+        model.load_state_dict(torch.load('generate_music_model.pth', map_location='cpu'))
+    print("\n单次解码延迟 (batch_size=1, argmax):")
+    for Ty, times in benchmark_decode(model).items():
+        print(f"  Ty={Ty:3d}: eager {times['eager']:.2f} ms, TorchScript {times['scripted']:.2f} ms, "
+              f"加速比 {times['eager'] / times['scripted']:.2f}x")
@@ -6,27 +6,160 @@ preprocess.py (健壮版)
 '''
 
 import os
-from music21 import converter, stream, chord, instrument, note
-from collections import OrderedDict
+import io
+import json
+import fnmatch
+import itertools
+import hashlib
+import pickle
+import contextlib
+import argparse
+import numpy as np
+import music21
+from concurrent.futures import ProcessPoolExecutor
+from music21 import converter, stream, chord, instrument, note, meter, tie, pitch
+from collections import OrderedDict, Counter
 import sys
 
 # 确保 grammar.py 在路径中，并且可以被导入
 try:
+    import grammar
     from grammar import parse_melody
 except ImportError:
     print("错误: 无法导入 'grammar.py'。", file=sys.stderr)
     print("请确保 grammar.py 与 preprocess.py 在同一目录中。", file=sys.stderr)
     sys.exit(1)
 
+import events
+import score
+import smf
+
+# 缓存文件格式版本：修改下面的序列化格式时需要加 1
+CACHE_FORMAT_VERSION = 1
+
+# 默认缓存目录：与本模块放在一起，不受调用方当前工作目录的影响
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
 #----------------------------私有辅助函数----------------------------------#
 
-def __get_abstract_grammars(melody_stream, chord_stream):
+def __grammar_version():
+    """
+    辅助函数：生成语法的所有模块 (本模块、grammar.py、score.py、smf.py、events.py)
+    源码的哈希值，加上 music21 的版本号 (music21 解析器和 score.py 的对照对象)。
+    其中任何一个改变后，旧的缓存自动失效。
+    """
+    source_hash = hashlib.sha256()
+    for module_file in (__file__, grammar.__file__, score.__file__, smf.__file__, events.__file__):
+        with open(module_file, 'rb') as f:
+            source_hash.update(hashlib.sha256(f.read()).digest())
+    return f"{CACHE_FORMAT_VERSION}-{music21.__version__}-{source_hash.hexdigest()}"
+
+def __cache_path(cache_dir, data_fn, melody_part_index, accompaniment_part_indices, parser):
+    """
+    辅助函数：按内容寻址的缓存文件路径。
+    文件名由 MIDI 文件内容的哈希、轨道索引与 parser 共同决定，与文件名/路径无关。
+    """
+    with open(data_fn, 'rb') as f:
+        midi_hash = hashlib.sha256(f.read()).hexdigest()
+    parts_key = f"{melody_part_index}-{list(accompaniment_part_indices)}-{parser}"
+    parts_hash = hashlib.sha256(parts_key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{midi_hash[:32]}_{parts_hash[:16]}.pkl")
+
+def __serialize_stream(s):
+    """
+    辅助函数：把伴奏流压缩为纯 Python 元组，只保留生成/播放需要的信息
+    (拍号，以及音符/和弦/休止符的 offset、时值、音高、力度和连音线)。
+    """
+    time_signatures = [(s.elementOffset(ts), ts.ratioString)
+                       for ts in s.getElementsByClass(meter.TimeSignature)]
+    events = []
+    for n in s.notesAndRests:
+        if isinstance(n, note.Rest):
+            kind, velocity = 'R', None
+        else:
+            kind, velocity = ('C' if isinstance(n, chord.Chord) else 'N'), n.volume.velocity
+        pitches = tuple(p.nameWithOctave for p in n.pitches)
+        tie_type = None if n.tie is None else n.tie.type
+        events.append((s.elementOffset(n), n.quarterLength, kind, pitches, velocity, tie_type))
+    return {'time_signatures': time_signatures, 'events': events}
+
+def __deserialize_stream(data):
+    """
+    辅助函数：由 __serialize_stream 的结果重建 music21 伴奏流。
+    """
+    s = stream.Stream()
+    for offset, ratio in data['time_signatures']:
+        s.coreInsert(offset, meter.TimeSignature(ratio))
+    for offset, quarterLength, kind, pitches, velocity, tie_type in data['events']:
+        if kind == 'R':
+            n = note.Rest(quarterLength=quarterLength)
+        elif kind == 'N':
+            n = note.Note(pitches[0], quarterLength=quarterLength)
+        else:
+            n = chord.Chord(pitches, quarterLength=quarterLength)
+        if velocity is not None:
+            n.volume.velocity = velocity
+        if tie_type is not None:
+            n.tie = tie.Tie(tie_type)
+        s.coreInsert(offset, n)
+    s.coreElementsChanged()
+    return s
+
+def __load_cache(path, version):
+    """
+    辅助函数：读取缓存；不存在、损坏或 grammar 版本不一致时返回 None。
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception as e:
+        print(f"警告: 无法读取缓存 '{path}': {e}")
+        return None
+    if cached.get('version') != version:
+        print("缓存已过期 (解析代码已修改)，重新解析...")
+        return None
+    return cached
+
+def __save_cache(path, version, chords_for_playback, abstract_grammars):
+    """
+    辅助函数：写入缓存 (先写临时文件再替换，避免留下写了一半的文件)。
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cached = {'version': version,
+              'abstract_grammars': abstract_grammars,
+              'chords_for_playback': __serialize_stream(chords_for_playback)}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def __parse_measure(measures):
+    """
+    辅助函数：为一对对齐的 (旋律小节, 和弦小节) 生成抽象语法。
+    定义在模块顶层，以便 ProcessPoolExecutor 在子进程中调用。
+
+    返回:
+    (parsed, error): 成功时 error 为 None；失败时 parsed 为 None，error 为错误信息
+    """
+    m_measure, c_measure = measures
+
+    # `parse_melody` 期望两个 stream 对象 (Measure 是 Stream 的子类)
+    try:
+        return parse_melody(m_measure, c_measure), None
+    except Exception as e:
+        # 只返回错误信息字符串，异常对象本身不一定能被 pickle
+        return None, str(e)
+
+def __get_abstract_grammars(melody_stream, chord_stream, workers=None):
     """
     辅助函数：给定旋律流和和弦流，逐小节生成抽象语法。
 
     参数:
     melody_stream (stream.Stream): 包含旋律音符的 music21 Stream
     chord_stream (stream.Stream): 包含和弦分析的 music21 Stream (通常来自 .chordify())
+    workers (int): 并行解析小节的进程数 (None 或 1 = 串行)
     """
     
     print("正在将旋律和和弦按小节对齐...")
@@ -40,6 +173,17 @@ def __get_abstract_grammars(melody_stream, chord_stream):
     melody_measures = melody_measures_stream.getElementsByClass(stream.Measure)
     chord_measures = chord_measures_stream.getElementsByClass(stream.Measure)
 
+    return __parse_measures(melody_measures, chord_measures, workers)
+
+def __parse_measures(melody_measures, chord_measures, workers=None):
+    """
+    辅助函数：逐对解析对齐的 (旋律小节, 和弦小节)，生成抽象语法。
+
+    参数:
+    melody_measures (list[stream.Measure]): 旋律的小节
+    chord_measures (list[stream.Measure]): 和弦分析的小节
+    workers (int): 并行解析小节的进程数 (None 或 1 = 串行)
+    """
     num_measures = min(len(melody_measures), len(chord_measures))
     if len(melody_measures) != len(chord_measures):
         print(f"警告: 旋律小节数 ({len(melody_measures)}) 与 和弦小节数 ({len(chord_measures)}) 不匹配。")
@@ -49,47 +193,78 @@ def __get_abstract_grammars(melody_stream, chord_stream):
     
     print(f"正在逐小节生成语法 (共 {num_measures} 个小节)...")
     
-    # 3. 遍历所有对齐的小节
-    for i in range(num_measures):
-        m_measure = melody_measures[i]
-        c_measure = chord_measures[i]
-        
-        # 4. 调用 grammar.py 中的解析器
-        # `parse_melody` 期望两个 stream 对象 (Measure 是 Stream 的子类)
-        try:
-            parsed = parse_melody(m_measure, c_measure)
-            if parsed: # 确保 `parse_melody` 返回了非空内容
-                abstract_grammars.append(parsed)
-        except Exception as e:
-            print(f"在处理小节 {i} 时出错: {e}")
-            # print(f"旋律: {m_measure.getElementsNotOfClass(note.Rest)}")
-            # print(f"和弦: {c_measure.getElementsByClass(chord.Chord)}")
-            pass # 跳过这个小节
+    # 1. 遍历所有对齐的小节 (各小节相互独立，可以并行解析)
+    pairs = [(melody_measures[i], chord_measures[i]) for i in range(num_measures)]
+    if workers is not None and workers > 1:
+        print(f"使用 {workers} 个进程并行解析...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, num_measures // (workers * 4))
+            results = list(executor.map(__parse_measure, pairs, chunksize=chunksize))
+    else:
+        results = [__parse_measure(pair) for pair in pairs]
+
+    # 2. 按小节顺序收集 grammar.py 解析器的结果
+    for i, (parsed, error) in enumerate(results):
+        if error is not None:
+            print(f"在处理小节 {i} 时出错: {error}")
+            continue # 跳过这个小节
+        if parsed: # 确保 `parse_melody` 返回了非空内容
+            abstract_grammars.append(parsed)
 
     print("语法生成完毕。")
     return abstract_grammars
 
-#----------------------------公共函数----------------------------------#
+def __parse_corpus_file(task):
+    """
+    辅助函数：批量预处理时解析单个 MIDI 文件 (在子进程中运行)。
+    单个文件的详细输出被屏蔽，只把结果返回给主进程统一打印。
 
-def get_musical_data(data_fn, 
-                     melody_part_index=5, 
-                     accompaniment_part_indices=[0, 1, 6, 7]):
+    返回:
+    (data_fn, abstract_grammars): 解析失败时 abstract_grammars 为 None
     """
-    从 MIDI 文件加载音乐数据，提取旋律和伴奏，并生成抽象语法。
+    data_fn, melody_part_index, accompaniment_part_indices, cache_dir = task
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, abstract_grammars = get_musical_data(data_fn,
+                                                    melody_part_index=melody_part_index,
+                                                    accompaniment_part_indices=accompaniment_part_indices,
+                                                    cache_dir=cache_dir)
+    except Exception as e:
+        print(f"警告: 解析 '{data_fn}' 时出错: {e}", file=sys.stderr)
+        abstract_grammars = None
+    return data_fn, abstract_grammars
 
-    参数:
-    data_fn (str): MIDI 文件的路径
-    melody_part_index (int): 旋律所在的轨道索引 (Part index)。
-                             (原版 deepjazz 使用 5)
-    accompaniment_part_indices (list[int]): 伴奏所在的轨道索引列表。
-                                          (原版 deepjazz 使用 [0, 1, 6, 7])
+class __ShardWriter:
+    """
+    辅助类：把 token 索引按固定大小写成 int32 的 .npy 分片文件。
+    """
+    def __init__(self, out_dir, shard_size):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.buffer = []
+        self.shard_files = []
 
-    返回:
-    chords_for_playback (stream.Stream): 用于后续音乐生成的原始伴奏轨道流。
-    abstract_grammars (list[str]): 抽象语法字符串的列表。
+    def extend(self, ids):
+        self.buffer.extend(ids)
+        while len(self.buffer) >= self.shard_size:
+            self._flush(self.buffer[:self.shard_size])
+            self.buffer = self.buffer[self.shard_size:]
+
+    def close(self):
+        if self.buffer:
+            self._flush(self.buffer)
+            self.buffer = []
+        return self.shard_files
+
+    def _flush(self, ids):
+        file_name = f"shard_{len(self.shard_files):05d}.npy"
+        np.save(os.path.join(self.out_dir, file_name), np.asarray(ids, dtype=np.int32))
+        self.shard_files.append(file_name)
+
+def __musical_data_music21(data_fn, melody_part_index, accompaniment_part_indices, workers):
+    """
+    辅助函数：用 music21 (converter.parse + chordify) 解析 MIDI 文件 (参数同 get_musical_data)。
     """
-    
-    print(f"正在从 '{data_fn}' 加载 MIDI 文件...")
     try:
         s = converter.parse(data_fn)
     except Exception as e:
@@ -129,17 +304,314 @@ def get_musical_data(data_fn,
 
     # --- 4. 生成抽象语法 ---
     # 我们传入“旋律流”和“和弦分析流”
-    abstract_grammars = __get_abstract_grammars(melody_stream, chord_analysis_stream)
+    abstract_grammars = __get_abstract_grammars(melody_stream, chord_analysis_stream, workers)
+
+    return chords_for_playback, abstract_grammars
+
+def __playback_data(score_data, accompaniment_part_indices):
+    """
+    辅助函数：由 score.read_score 的结果构建伴奏流的序列化数据 (格式同 __serialize_stream)，
+    等价于把各伴奏轨道的 flatten() 依次 mergeElements 到一个 Stream 中。
+    通道 10 的打击乐音符没有音高，不放入伴奏 (缓存格式也无法表示它们)。
+    """
+    time_signatures = []
+    elements = []
+    for i in accompaniment_part_indices:
+        if i >= len(score_data.parts):
+            print(f"警告: 伴奏轨道索引 {i} 超出范围，已跳过。")
+            continue
+        for offset, e in score.flatten(score_data.parts[i]):
+            if e.kind == score.KIND_META and e.meta is not None and e.meta[0] == smf.META_TIME_SIGNATURE:
+                time_signatures.append((offset, f"{e.meta[1][0]}/{2 ** e.meta[1][1]}"))
+            elif e.kind in (score.KIND_REST, score.KIND_NOTE, score.KIND_CHORD):
+                elements.append((offset, e))
+
+    # 合并后的 Stream 按 (offset, 是否装饰音, 插入顺序) 排列
+    elements.sort(key=lambda item: (item[0], not item[1].grace))
+    time_signatures.sort(key=lambda ts: ts[0])
+    events = []
+    for offset, e in elements:
+        if e.kind == score.KIND_REST:
+            events.append((offset, e.ql, 'R', (), None, None))
+            continue
+        kind = 'N' if e.kind == score.KIND_NOTE else 'C'
+        pitches = tuple(pitch.Pitch(midi=p).nameWithOctave for p in e.pitches)
+        # 同 music21：和弦的力度是各个音的力度的平均值
+        velocity = int(round(sum(e.velocities) / len(e.velocities)))
+        events.append((offset, e.ql, kind, pitches, velocity, e.ties[0]))
+    return {'time_signatures': time_signatures, 'events': events}
+
+def __musical_data_fast(data_fn, melody_part_index, accompaniment_part_indices, workers):
+    """
+    辅助函数：用 score.py 直接解析 MIDI 事件 (参数同 get_musical_data)。
+    得到的小节、和弦分析与 music21 的结果一致，但不需要为每个事件创建 music21 对象。
+    """
+    try:
+        score_data = score.read_score(data_fn)
+    except Exception as e:
+        print(f"错误: 无法解析 MIDI 文件: {e}", file=sys.stderr)
+        return None, None
+
+    if not score_data.parts:
+        print("错误: MIDI 文件不包含任何轨道 (Parts)。", file=sys.stderr)
+        return None, None
+
+    if melody_part_index >= len(score_data.parts):
+        print(f"错误: 旋律轨道索引 {melody_part_index} 超出范围 (共 {len(score_data.parts)} 个轨道)。", file=sys.stderr)
+        return None, None
+
+    print(f"正在从轨道 {accompaniment_part_indices} 提取伴奏 (用于播放)...")
+    chords_for_playback = __deserialize_stream(__playback_data(score_data, accompaniment_part_indices))
+
+    # 旋律小节与和弦分析 (纵向切片) 的小节，等价于 music21 流程中的 makeMeasures
+    print(f"正在从轨道 {melody_part_index} 提取旋律，并对整个乐曲进行和弦分析...")
+    melody_measures, chord_measures = score.grammar_measures(score_data, melody_part_index)
+
+    abstract_grammars = __parse_measures(melody_measures, chord_measures, workers)
+    return chords_for_playback, abstract_grammars
+
+#----------------------------公共函数----------------------------------#
+
+def get_musical_data(data_fn, 
+                     melody_part_index=5, 
+                     accompaniment_part_indices=[0, 1, 6, 7],
+                     workers=None,
+                     cache_dir=CACHE_DIR,
+                     parser='fast'):
+    """
+    从 MIDI 文件加载音乐数据，提取旋律和伴奏，并生成抽象语法。
+
+    参数:
+    data_fn (str): MIDI 文件的路径
+    melody_part_index (int): 旋律所在的轨道索引 (Part index)。
+                             (原版 deepjazz 使用 5)
+    accompaniment_part_indices (list[int]): 伴奏所在的轨道索引列表。
+                                          (原版 deepjazz 使用 [0, 1, 6, 7])
+    workers (int): 并行生成语法的进程数 (None 或 1 = 串行)
+    cache_dir (str): 解析结果的缓存目录 (默认为本模块旁边的 cache/，None = 不使用缓存)。
+                     缓存按 MIDI 文件内容、轨道索引、parser 与解析代码的版本寻址。
+    parser (str): 'fast' = 用 score.py 直接解析 MIDI 事件 (默认，结果与 music21 一致)；
+                  'music21' = 原来的 converter.parse + chordify
+
+    返回:
+    chords_for_playback (stream.Stream): 用于后续音乐生成的原始伴奏轨道流。
+    abstract_grammars (list[str]): 抽象语法字符串的列表。
+    """
+    if parser not in ('fast', 'music21'):
+        raise ValueError(f"未知的 parser: {parser!r} (可选 'fast' 或 'music21')")
+    
+    # --- 0. 先查缓存 ---
+    cache_path = None
+    if cache_dir is not None and os.path.isfile(data_fn):
+        version = __grammar_version()
+        cache_path = __cache_path(cache_dir, data_fn, melody_part_index, accompaniment_part_indices, parser)
+        cached = __load_cache(cache_path, version)
+        if cached is not None:
+            print(f"从缓存 '{cache_path}' 加载解析结果...")
+            chords_for_playback = __deserialize_stream(cached['chords_for_playback'])
+            return chords_for_playback, cached['abstract_grammars']
+
+    # --- 1. 解析 MIDI 文件，生成抽象语法 ---
+    print(f"正在从 '{data_fn}' 加载 MIDI 文件...")
+    if parser == 'fast':
+        chords_for_playback, abstract_grammars = __musical_data_fast(
+            data_fn, melody_part_index, accompaniment_part_indices, workers)
+    else:
+        chords_for_playback, abstract_grammars = __musical_data_music21(
+            data_fn, melody_part_index, accompaniment_part_indices, workers)
+
+    # --- 2. 写入缓存，下次运行直接读取 ---
+    if cache_path is not None and abstract_grammars:
+        try:
+            __save_cache(cache_path, version, chords_for_playback, abstract_grammars)
+        except Exception as e:
+            print(f"警告: 无法写入缓存 '{cache_path}': {e}")
 
     # 返回 "用于播放的伴奏" 和 "抽象语法"
     # 这满足了 `data_utils.py` 和 `get_corpus_data` 的双重需求
     return chords_for_playback, abstract_grammars
 
-def get_corpus_data(abstract_grammars):
+class Vocabulary:
+    """
+    确定的 token <-> 索引 词汇表。
+
+    token 按词频降序排列，词频相同时按 token 字符串排序，所以同一份语料
+    无论解析顺序如何都会得到完全相同的索引 (原来的 set 枚举顺序依赖于
+    字符串哈希，每次运行都可能不同，训练好的模型换一个进程就对不上了)。
+    可以保存为 JSON，或者用 state_dict() 和模型权重放进同一个 checkpoint。
+
+    兼容原来 get_corpus_data 返回的 values (set) 的用法：len(vocab)、
+    token in vocab、for token in vocab 都可以直接使用。
+
+    参数:
+    tokens (list[str]): 按索引顺序排列的 token
+    counts (list[int]): 每个 token 在语料中的出现次数 (与 tokens 一一对应)
+    unk_token (str): 未登录词对应的 token (None = 不支持未登录词，编码时遇到会报 KeyError)
+    """
+    UNK = '<unk>'
+    VERSION = 1
+
+    def __init__(self, tokens, counts=None, unk_token=None):
+        self.tokens = list(tokens)
+        self.counts = list(counts) if counts is not None else [0] * len(self.tokens)
+        if len(self.counts) != len(self.tokens):
+            raise ValueError("tokens 和 counts 的长度不一致。")
+        if unk_token is not None and unk_token not in self.tokens:
+            raise ValueError(f"未登录词 '{unk_token}' 不在词汇表中。")
+        self.unk_token = unk_token
+
+        self.val_indices = {v: i for i, v in enumerate(self.tokens)}
+        self.indices_val = dict(enumerate(self.tokens))
+        if len(self.val_indices) != len(self.tokens):
+            raise ValueError("词汇表中有重复的 token。")
+        self.unk_index = self.val_indices[unk_token] if unk_token is not None else None
+
+        # NumPy 查找表：解码直接按索引取值 (编码直接查 val_indices 字典)
+        self._token_array = np.array(self.tokens, dtype=object)
+
+    @classmethod
+    def from_counts(cls, counts, min_freq=1):
+        """
+        从 {token: 出现次数} 构建词汇表。
+
+        参数:
+        counts (dict 或 Counter): token -> 出现次数
+        min_freq (int): 出现次数低于此值的 token 合并为 '<unk>' (放在索引 0)；
+                        1 表示保留全部 token，不添加 '<unk>'
+
+        返回:
+        vocab (Vocabulary): 新的词汇表
+        """
+        kept = sorted((v for v, n in counts.items() if n >= min_freq),
+                      key=lambda v: (-counts[v], v))
+        kept_counts = [counts[v] for v in kept]
+        if min_freq <= 1:
+            return cls(kept, kept_counts)
+
+        dropped = sum(n for v, n in counts.items() if n < min_freq)
+        if cls.UNK in counts:
+            raise ValueError(f"语料中已经包含保留的 token '{cls.UNK}'。")
+        return cls([cls.UNK] + kept, [dropped] + kept_counts, unk_token=cls.UNK)
+
+    @classmethod
+    def from_corpus(cls, corpus, min_freq=1):
+        """
+        从 token 列表构建词汇表。参数同 from_counts。
+        """
+        return cls.from_counts(Counter(corpus), min_freq=min_freq)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.val_indices
+
+    def __eq__(self, other):
+        if not isinstance(other, Vocabulary):
+            return NotImplemented
+        return (self.tokens == other.tokens and self.counts == other.counts
+                and self.unk_token == other.unk_token)
+
+    def __repr__(self):
+        return f"Vocabulary(size={len(self)}, unk_token={self.unk_token!r})"
+
+    @property
+    def fingerprint(self):
+        """
+        词汇表 (token 及其顺序) 的哈希值，可以和 checkpoint 一起保存，
+        加载时用来确认模型和词汇表是否匹配。
+        """
+        payload = json.dumps([self.tokens, self.unk_token], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def encode(self, tokens):
+        """
+        把 token 序列批量转换为索引数组。
+
+        参数:
+        tokens (list[str]): token 序列
+
+        返回:
+        ids (np.ndarray): int64 索引数组。未登录词映射为 unk_index，
+                          没有 unk_token 时抛出 KeyError
+        """
+        tokens = np.asarray(tokens, dtype=object)
+        missing = -1 if self.unk_index is None else self.unk_index
+        ids = np.fromiter(map(self.val_indices.get, tokens.flat, itertools.repeat(missing)),
+                          dtype=np.int64, count=tokens.size).reshape(tokens.shape)
+        if self.unk_index is None and (ids < 0).any():
+            raise KeyError(str(tokens[ids < 0].flat[0]))
+        return ids
+
+    def decode(self, ids):
+        """
+        把索引序列批量转换回 token。
+
+        参数:
+        ids (list[int] 或 np.ndarray): 索引序列
+
+        返回:
+        tokens (list[str]): token 序列
+        """
+        return self._token_array[np.asarray(ids, dtype=np.int64)].tolist()
+
+    def state_dict(self):
+        """
+        返回可以直接放进 torch.save / json.dump 的字典。
+        """
+        return {'version': self.VERSION,
+                'tokens': self.tokens,
+                'counts': self.counts,
+                'unk_token': self.unk_token,
+                'fingerprint': self.fingerprint}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        """
+        从 state_dict() 的结果恢复词汇表。
+        """
+        if state.get('version', cls.VERSION) > cls.VERSION:
+            raise ValueError(f"不支持的词汇表版本: {state['version']}")
+        vocab = cls(state['tokens'], state.get('counts'), state.get('unk_token'))
+        if 'fingerprint' in state and state['fingerprint'] != vocab.fingerprint:
+            raise ValueError("词汇表的哈希值不匹配，文件可能已损坏。")
+        return vocab
+
+    def save(self, path):
+        """
+        把词汇表保存为 JSON 文件。
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.state_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        """
+        从 save() 保存的 JSON 文件加载词汇表。
+        """
+        with open(path, encoding='utf-8') as f:
+            return cls.from_state_dict(json.load(f))
+
+def get_corpus_data(abstract_grammars, min_freq=1, vocab=None):
     """
-    (此函数与原版相同，功能正确且无需修改)
-    
     从抽象语法列表创建语料库 (corpus) 和词典。
+
+    词典由 Vocabulary 按词频排序构建，同一份语料每次运行都得到相同的索引。
+
+    参数:
+    abstract_grammars (list[str]): get_musical_data 返回的每小节语法字符串
+    min_freq (int): 出现次数低于此值的 token 替换为 '<unk>' (1 = 保留全部)
+    vocab (Vocabulary): 已有的词汇表 (例如和模型一起保存的)；
+                        给出时直接使用，不再从语料重新构建
+
+    返回:
+    corpus (list[str]): token 序列 (低频词/未登录词已替换为 '<unk>')
+    values (Vocabulary): 词汇表 (可以像原来的 set 一样使用 len() / in / 迭代)
+    val_indices (dict): token -> 索引
+    indices_val (dict): 索引 -> token
     """
     if not abstract_grammars:
         print("错误: 传入的 'abstract_grammars' 为空。", file=sys.stderr)
@@ -155,15 +627,143 @@ def get_corpus_data(abstract_grammars):
         print("错误: 语料库为空，无法创建词典。可能是 'grammar.py' 未正确解析。", file=sys.stderr)
         return None, None, None, None
 
-    # 2. 创建词汇表 (set of unique tokens)
-    values = set(corpus)
-    
-    # 3. 创建 token <-> index 映射字典
-    val_indices = dict((v, i) for i, v in enumerate(values))
-    indices_val = dict((i, v) for i, v in enumerate(values))
+    # 2. 创建 (或复用) 按词频排序的词汇表
+    values = vocab if vocab is not None else Vocabulary.from_corpus(corpus, min_freq=min_freq)
+
+    # 3. 把词汇表之外的 token 替换为 '<unk>'，保证 val_indices[token] 总是有效
+    if values.unk_token is not None:
+        corpus = [token if token in values.val_indices else values.unk_token
+                  for token in corpus]
 
     print(f"语料库创建完成。Token 总数: {len(corpus)}, 独立词汇表大小: {len(values)}")
-    return corpus, values, val_indices, indices_val
+    return corpus, values, values.val_indices, values.indices_val
+
+def build_corpus_shards(midi_dir,
+                        out_dir,
+                        melody_part_index=5,
+                        accompaniment_part_indices=[0, 1, 6, 7],
+                        workers=None,
+                        shard_size=1 << 20,
+                        cache_dir=CACHE_DIR):
+    """
+    批量预处理：遍历目录下的所有 MIDI 文件，并行解析，并把 token 序列写成
+    可以内存映射 (np.load(..., mmap_mode='r')) 的 int32 分片。
+
+    只做一遍解析：解析时先按 token 首次出现的顺序分配临时索引并写入分片，
+    全部解析完后再按词频排序得到最终词典，并用一次 NumPy 查表就地重映射
+    每个分片。整个过程中不需要在内存里保存全部 token 字符串。
+
+    参数:
+    midi_dir (str): MIDI 文件所在目录 (递归查找 *.mid / *.midi)
+    out_dir (str): 分片与词典的输出目录
+    melody_part_index (int): 旋律所在的轨道索引 (所有文件相同)
+    accompaniment_part_indices (list[int]): 伴奏所在的轨道索引列表
+    workers (int): 并行解析文件的进程数 (None 或 1 = 串行)
+    shard_size (int): 每个分片包含的 token 数
+    cache_dir (str): 传给 get_musical_data 的缓存目录 (None = 不使用缓存)
+
+    返回:
+    manifest (dict): 写入 out_dir/manifest.json 的内容 (分片列表、每个文件的
+                     token 范围、词典文件名等)
+    """
+    matches = []
+    for root, dirnames, filenames in os.walk(midi_dir):
+        for pattern in ('*.mid', '*.midi'):
+            for filename in fnmatch.filter(filenames, pattern):
+                matches.append(os.path.join(root, filename))
+    matches.sort()
+
+    if not matches:
+        print(f"错误: 在 '{midi_dir}' 中没有找到 MIDI 文件。", file=sys.stderr)
+        return None
+
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"共找到 {len(matches)} 个 MIDI 文件，开始批量解析...")
+
+    tasks = [(data_fn, melody_part_index, accompaniment_part_indices, cache_dir)
+             for data_fn in matches]
+
+    # 1. 解析 + 按首次出现顺序分配临时索引，边解析边写分片
+    first_seen = {}                 # token -> 临时索引
+    counts = []                     # 临时索引 -> 出现次数
+    writer = __ShardWriter(out_dir, shard_size)
+    files = []
+    num_tokens = 0
+
+    def consume(results):
+        nonlocal num_tokens
+        for data_fn, abstract_grammars in results:
+            if not abstract_grammars:
+                print(f"  跳过 '{data_fn}' (没有可用的语法)")
+                continue
+            ids = []
+            for measure_grammar in abstract_grammars:
+                for token in measure_grammar.split(' '):
+                    idx = first_seen.get(token)
+                    if idx is None:
+                        idx = len(first_seen)
+                        first_seen[token] = idx
+                        counts.append(0)
+                    counts[idx] += 1
+                    ids.append(idx)
+            files.append({'path': os.path.relpath(data_fn, midi_dir),
+                          'start': num_tokens,
+                          'length': len(ids)})
+            num_tokens += len(ids)
+            writer.extend(ids)
+            print(f"  '{data_fn}': {len(abstract_grammars)} 个小节, {len(ids)} 个 token")
+
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            consume(executor.map(__parse_corpus_file, tasks))
+    else:
+        consume(__parse_corpus_file(task) for task in tasks)
+
+    shard_files = writer.close()
+    if num_tokens == 0:
+        print("错误: 语料库为空，没有写出任何分片。", file=sys.stderr)
+        return None
+
+    # 2. 按词频 (降序) 排序得到确定的最终词典，相同词频按 token 字符串排序
+    vocab = Vocabulary.from_counts(dict(zip(first_seen, counts)))
+    remap = vocab.encode(list(first_seen)).astype(np.int32)
+
+    # 3. 就地把每个分片的临时索引重映射为最终索引
+    for file_name in shard_files:
+        shard = np.load(os.path.join(out_dir, file_name), mmap_mode='r+')
+        shard[:] = remap[shard]
+        shard.flush()
+        del shard
+
+    vocab.save(os.path.join(out_dir, 'vocab.json'))
+
+    manifest = {'num_tokens': num_tokens,
+                'shard_size': shard_size,
+                'shards': shard_files,
+                'vocab': 'vocab.json',
+                'files': files}
+    with open(os.path.join(out_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+    print(f"批量预处理完成。Token 总数: {num_tokens}, 词汇表大小: {len(vocab)}, 分片数: {len(shard_files)}")
+    return manifest
+
+def load_corpus_shards(out_dir):
+    """
+    读取 build_corpus_shards 的输出。分片以内存映射方式打开，不会读入内存。
+
+    返回:
+    shards (list[np.ndarray]): 每个分片的 int32 token 索引 (只读 memmap)
+    vocab (Vocabulary): 词汇表 (vocab.indices_val 即 索引 -> Token)
+    manifest (dict): manifest.json 的内容
+    """
+    with open(os.path.join(out_dir, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    vocab = Vocabulary.load(os.path.join(out_dir, manifest['vocab']))
+
+    shards = [np.load(os.path.join(out_dir, file_name), mmap_mode='r')
+              for file_name in manifest['shards']]
+    return shards, vocab, manifest
 
 
 # ------------------------------------------------------------------
@@ -172,7 +772,31 @@ def get_corpus_data(abstract_grammars):
 if __name__ == "__main__":
     """
     这是一个示例，展示如何使用这个新的 preprocess.py
+
+    不带参数运行时处理单个示例文件；批量预处理整个目录:
+        python preprocess.py --midi-dir data --out-dir corpus --workers 4
     """
+    parser = argparse.ArgumentParser(description="解析 MIDI 文件并生成抽象语法")
+    parser.add_argument('--midi-dir', help="批量模式：递归处理该目录下的所有 MIDI 文件")
+    parser.add_argument('--out-dir', default='corpus', help="批量模式：分片与词典的输出目录")
+    parser.add_argument('--melody-part', type=int, default=5, help="旋律轨道索引")
+    parser.add_argument('--accompaniment-parts', type=int, nargs='+', default=[0, 1, 6, 7],
+                        help="伴奏轨道索引列表")
+    parser.add_argument('--workers', type=int, default=None, help="并行进程数")
+    parser.add_argument('--shard-size', type=int, default=1 << 20, help="每个分片的 token 数")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="解析结果缓存目录")
+    args = parser.parse_args()
+
+    if args.midi_dir is not None:
+        build_corpus_shards(args.midi_dir,
+                            args.out_dir,
+                            melody_part_index=args.melody_part,
+                            accompaniment_part_indices=args.accompaniment_parts,
+                            workers=args.workers,
+                            shard_size=args.shard_size,
+                            cache_dir=args.cache_dir)
+        sys.exit(0)
+
     # 假设你的文件路径
     data_file = 'data/original_metheny.mid' 
     
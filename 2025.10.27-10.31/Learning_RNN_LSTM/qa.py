@@ -6,9 +6,10 @@ Purpose:    Provide pruning and cleanup functions.
 Code adapted from Evan Chow's jazzml, https://github.com/evancchow/jazzml 
 with express permission.
 '''
-from itertools import zip_longest
 import random
 
+import numpy as np
+
 from music21 import *
 
 #----------------------------HELPER FUNCTIONS----------------------------------#
@@ -29,11 +30,18 @@ def __roundUpDown(num, mult, upDown):
     else:
         return __roundUp(num, mult)
 
-''' Helper function, from recipes, to iterate over list in chunks of n 
-    length. '''
-def __grouper(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
+''' Helper function: one O(n) pass deciding which elements prune_notes keeps.
+    `keys` holds one comparable pitch key per element (None for anything that
+    is not a note). Elements are walked in fixed consecutive pairs (0, 1),
+    (2, 3), ...; when both are notes with the same key the second one is
+    dropped. This matches the original loop on a stream.Voice, which iterates
+    over a snapshot, so a removal never shifts the pairing. '''
+def __prune_keep(keys):
+    keep = [True] * len(keys)
+    for ix in range(0, len(keys) - 1, 2):
+        if keys[ix] is not None and keys[ix] == keys[ix + 1]:
+            keep[ix + 1] = False
+    return keep
 
 #----------------------------PUBLIC FUNCTIONS----------------------------------#
 
@@ -51,30 +59,145 @@ def prune_grammar(curr_grammar):
 
     return pruned_grammar
 
+''' Precompute the string tables used by prune_grammar_ids. For every token id
+    there are four pruned variants, indexed as tables[substituted, up, id]:
+    `substituted` replaces a leading 'A'/'X' with 'C' (the ' A' -> ' C' and
+    ' X' -> ' C' replacement generate_music applies to every token but the
+    first), and `up` picks the duration rounded up (1) or down (0) to the
+    nearest 0.250, exactly like prune_grammar. Tokens without a duration
+    (e.g. '<unk>') are kept as they are. '''
+def build_prune_tables(indices_val, n_values):
+    tables = np.empty((2, 2, n_values), dtype=object)
+
+    for ix in range(n_values):
+        gram = indices_val[ix]
+        for substituted in (0, 1):
+            if substituted and gram[:1] in ('A', 'X'):
+                terms = ('C' + gram[1:]).split(',')
+            else:
+                terms = gram.split(',')
+            for up in (0, 1):
+                if len(terms) < 2:
+                    tables[substituted, up, ix] = gram
+                    continue
+                pruned = list(terms)
+                pruned[1] = str(__roundUpDown(float(terms[1]), 0.250,
+                    1 if up else -1))
+                tables[substituted, up, ix] = ','.join(pruned)
+
+    return tables
+
+''' Vectorized equivalent of the A/X -> C substitution followed by
+    prune_grammar, on decoded token ids instead of grammar strings. `ids` is a
+    (num_measures, Ty) array, padded with negative ids after a measure's last
+    token; the first token of each row is not substituted. `rng` is a NumPy
+    Generator, or one Generator per row so that every measure can be seeded
+    on its own. Returns one pruned grammar string per row; strings are only
+    built here, at the unparse boundary. '''
+def prune_grammar_ids(ids, tables, rng=None):
+    ids = np.atleast_2d(np.asarray(ids))
+    num_rows, num_cols = ids.shape
+    valid = ids >= 0
+
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    if isinstance(rng, np.random.Generator):
+        up = rng.random(ids.shape) < 0.5
+    else:
+        up = np.array([r.random(num_cols) < 0.5 for r in rng],
+            dtype=bool).reshape(ids.shape)
+
+    substituted = np.ones(ids.shape, dtype=np.intp)
+    substituted[:, :1] = 0
+
+    grams = tables[substituted, up.astype(np.intp), np.where(valid, ids, 0)]
+    lengths = valid.sum(axis=1)
+
+    return [' '.join(grams[ix, :lengths[ix]]) for ix in range(num_rows)]
+
 ''' Remove repeated notes, and notes that are too close together. '''
 def prune_notes(curr_notes):
-    for n1, n2 in __grouper(curr_notes, n=2):
-        if n2 == None: # corner case: odd-length list
-            continue
-        if isinstance(n1, note.Note) and isinstance(n2, note.Note):
-            if n1.nameWithOctave == n2.nameWithOctave:
-                curr_notes.remove(n2)
+    keys = [n.nameWithOctave if isinstance(n, note.Note) else None
+            for n in curr_notes]
+    keep = __prune_keep(keys)
 
-    return curr_notes
+    return [n for n, kept in zip(curr_notes, keep) if kept]
+
+''' Same as prune_notes, on a compact representation: `pitches` is an array
+    of MIDI pitch numbers, negative for rests (or anything else that is not
+    a note). Returns a boolean mask of the elements to keep. '''
+def prune_notes_arrays(pitches):
+    pitches = np.asarray(pitches).tolist()
+    keys = [p if p >= 0 else None for p in pitches]
+
+    return np.array(__prune_keep(keys), dtype=bool)
 
 ''' Perform quality assurance on notes '''
 def clean_up_notes(curr_notes):
-    removeIxs = []
+    num_notes = len(curr_notes)
+    offsets = [m.offset for m in curr_notes]
+    keep = [True] * num_notes
     for ix, m in enumerate(curr_notes):
         # QA1: ensure nothing is of 0 quarter note len, if so changes its len
         if (m.quarterLength == 0.0):
             m.quarterLength = 0.250
         # QA2: ensure no two melody notes have same offset, i.e. form a chord.
         # Sorted, so same offset would be consecutive notes.
-        if (ix < (len(curr_notes) - 1)):
-            if (m.offset == curr_notes[ix + 1].offset and
+        if (ix < (num_notes - 1)):
+            if (offsets[ix] == offsets[ix + 1] and
                 isinstance(curr_notes[ix + 1], note.Note)):
-                removeIxs.append((ix + 1))
-    curr_notes = [i for ix, i in enumerate(curr_notes) if ix not in removeIxs]
+                keep[ix + 1] = False
+
+    return [m for m, kept in zip(curr_notes, keep) if kept]
+
+''' Same as clean_up_notes, on a compact representation: arrays of offsets,
+    quarter lengths and MIDI pitches (negative for non-notes). Returns the
+    boolean mask of elements to keep and the quarter lengths with zero
+    lengths replaced by 0.250. '''
+def clean_up_notes_arrays(offsets, quarter_lengths, pitches):
+    offsets = np.asarray(offsets, dtype=np.float64)
+    quarter_lengths = np.where(np.asarray(quarter_lengths) == 0.0, 0.250,
+        quarter_lengths).astype(np.float64)
+
+    keep = np.ones(len(offsets), dtype=bool)
+    keep[1:] = ~((offsets[:-1] == offsets[1:]) & (np.asarray(pitches)[1:] >= 0))
+
+    return keep, quarter_lengths
+
+''' prune_notes for an event array (see events.py). '''
+def prune_note_events(curr_events):
+    return curr_events[prune_notes_arrays(curr_events['pitch'])]
+
+''' clean_up_notes for an event array (see events.py). '''
+def clean_up_note_events(curr_events):
+    keep, quarter_lengths = clean_up_notes_arrays(curr_events['offset'],
+        curr_events['duration'], curr_events['pitch'])
+    cleaned = curr_events.copy()
+    cleaned['duration'] = quarter_lengths
+    return cleaned[keep]
+
+''' Targets and weights used by score_take to rank candidate takes of a
+    measure. The targets are typical of the training melody (about 1.5 notes
+    per quarter note, spanning about an octave). '''
+TAKE_TARGETS = {'density': 1.5, 'range': 12, 'density_weight': 0.5, 'range_weight': 0.5}
+
+''' Cheap array-based metrics of a measure's note events (see events.py):
+    returns (pitch range in semitones, notes per quarter note). '''
+def take_metrics(curr_events, measure_length):
+    pitches = curr_events['pitch'][curr_events['pitch'] >= 0]
+    if len(pitches) == 0:
+        return 0, 0.0
+    pitch_range = int(pitches.max()) - int(pitches.min())
+    return pitch_range, len(pitches) / max(float(measure_length), 0.25)
 
-    return curr_notes
\ No newline at end of file
+''' Score of a candidate take (higher is better): the scale-tone ratio, minus
+    how far the note density (on a log2 scale) and the pitch range (in
+    octaves) are from TAKE_TARGETS. A measure without notes scores -inf
+    unless every take is empty. '''
+def score_take(scale_ratio, pitch_range, density, targets=TAKE_TARGETS):
+    if density == 0.0:
+        return float('-inf')
+    density_error = abs(np.log2(density / targets['density']))
+    range_error = abs(pitch_range - targets['range']) / 12.0
+    return (scale_ratio - targets['density_weight'] * density_error
+        - targets['range_weight'] * range_error)
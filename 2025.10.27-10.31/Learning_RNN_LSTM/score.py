@@ -0,0 +1,884 @@
+'''
+score.py
+不经过 music21 converter.parse 的 MIDI 解析：由 smf.read_midi 读出的音符数组直接构建
+小节结构，并用纵向切片 (vertical slices) 实现与 Score.chordify() 等价的和弦分析。
+
+预处理只需要每个 Part 的小节划分与 chordify 的结果，但 converter.parse 会为每个
+MIDI 事件创建 music21 对象，再做量化、分小节、分声部、连音、补休止符，对大文件要几秒；
+chordify 还要更久。这里用轻量的 Element/Container 模拟同样的步骤，只在最后为
+parse_melody 创建它真正需要的 Note/Rest/Chord。
+
+为了让 abstract grammars 与原来的 music21 流程逐个 token 一致，下面的每一步都按
+music21 (v9/v10) 的行为实现，包括它的一些特殊行为 (见各函数的说明)：
+    midiTrackToStream  -> __group_chords, __quantize
+    makeMeasures       -> __make_measures
+    makeVoices         -> __make_voices
+    makeTies           -> __make_ties
+    makeRests          -> __make_rests
+    flatten            -> flatten
+    chordify           -> chordify
+'''
+
+import bisect
+import functools
+import itertools
+import math
+import time
+import numpy as np
+from music21 import stream, note, chord, pitch
+from music21.common.numberTools import opFrac
+
+import events
+import smf
+
+# 元素类型 (前三个与 events.py 的取值相同)
+KIND_REST = events.KIND_REST
+KIND_NOTE = events.KIND_NOTE
+KIND_CHORD = events.KIND_CHORD
+KIND_UNPITCHED = 3  # 通道 10 的单个音 (music21 Unpitched)
+KIND_PERCUSSION = 4 # 含有通道 10 音符的和弦 (music21 PercussionChord)
+KIND_META = 5       # 拍号、调号、速度、乐器、谱号
+KIND_VOICE = 6      # 声部 (Container)
+
+NOTE_KINDS = (KIND_REST, KIND_NOTE, KIND_CHORD, KIND_UNPITCHED, KIND_PERCUSSION)
+
+QUANTIZE_DIVISORS = (4, 3) # 同 music21 defaults.quantizationQuarterLengthDivisors
+PERCUSSION_CHANNEL = 10
+
+# 同一 offset 上的排列顺序 (同 music21 的 classSortOrder)
+SORT_ORDER_NOTE = 20
+SORT_ORDER_VOICE = 5
+SORT_ORDER_CLEF = 0
+SORT_ORDER_INSTRUMENT = -25
+__META_SORT_ORDER = {smf.META_TIME_SIGNATURE: 4,
+                     smf.META_KEY_SIGNATURE: 2,
+                     smf.META_TEMPO: 1,
+                     smf.META_TRACK_NAME: SORT_ORDER_INSTRUMENT,
+                     smf.META_INSTRUMENT_NAME: SORT_ORDER_INSTRUMENT}
+# 轨道中只有这些 meta 事件的轨道是 conductor 轨道，它们会被插入到每个 Part 中
+__CONDUCTOR_META = (smf.META_TIME_SIGNATURE, smf.META_KEY_SIGNATURE, smf.META_TEMPO)
+
+class Element:
+    """
+    小节或声部中的一个元素。offset 是相对于所在容器的位置 (quarterLength)。
+
+    音符/和弦的 pitches、velocities、ties 按和弦中的音一一对应；
+    meta 元素的 meta 为 (meta 类型, 数据)。
+    """
+    __slots__ = ('offset', 'ql', 'kind', 'sort_order', 'pitches', 'velocities',
+                 'ties', 'grace', 'meta', 'index')
+
+    def __init__(self, offset, ql, kind, pitches=(), velocities=(), grace=False,
+                 sort_order=SORT_ORDER_NOTE, meta=None):
+        self.offset = offset
+        self.ql = ql
+        self.kind = kind
+        self.sort_order = sort_order
+        self.pitches = pitches
+        self.velocities = velocities
+        self.ties = [None] * len(pitches)
+        self.grace = grace
+        self.meta = meta
+        self.index = 0 # 插入顺序，同一位置的元素按它排序
+
+    def sort_key(self):
+        return (self.offset, self.sort_order, not self.grace, self.index)
+
+    def copy(self):
+        e = Element(self.offset, self.ql, self.kind, self.pitches, self.velocities,
+                    self.grace, self.sort_order, self.meta)
+        e.ties = list(self.ties)
+        return e
+
+    def __repr__(self):
+        return f"Element(offset={float(self.offset)}, ql={float(self.ql)}, kind={self.kind}, pitches={self.pitches})"
+
+class Container:
+    """
+    小节 (Measure) 或声部 (Voice)。声部同样作为元素放在小节的 elements 中。
+
+    为了得到与 music21 完全相同的结果，这里也模拟了 music21 Stream 的两个缓存：
+    highestTime 在被查询时缓存 (插入/删除元素时失效，并通知上层容器)；
+    isSorted 在按位置插入时维护，遍历时才排序。
+    music21 修改 Chord 的时值时不会让所在容器的缓存失效，makeRests 又用各小节
+    (可能过期的) highestTime 重新排列小节的位置，所以这些细节会影响最终的 offset。
+    """
+    _counter = itertools.count(1)
+
+    def __init__(self, offset=0.0, bar_length=4.0, voice=False):
+        self.elements = []
+        self.offset = offset
+        self.bar_length = bar_length
+        self.kind = KIND_VOICE if voice else None
+        self.sort_order = SORT_ORDER_VOICE
+        self.grace = False
+        self.index = 0
+        self.parent = None
+        self._highest_time = None
+        self._sorted = True
+
+    def sort_key(self):
+        return (self.offset, self.sort_order, True, self.index)
+
+    @property
+    def ql(self):
+        return self.highest_time()
+
+    def highest_time(self):
+        if self._highest_time is None:
+            self._highest_time = max([opFrac(e.offset + e.ql) for e in self.elements] + [0.0])
+        return self._highest_time
+
+    def lowest_offset(self):
+        return min([e.offset for e in self.elements] + [0.0])
+
+    def changed(self):
+        self._highest_time = None
+        if self.parent is not None:
+            self.parent.changed()
+
+    def sorted_elements(self):
+        if not self._sorted:
+            self.elements.sort(key=lambda e: e.sort_key())
+            self._sorted = True
+        return list(self.elements)
+
+    def voices(self):
+        return [e for e in self.sorted_elements() if e.kind == KIND_VOICE]
+
+    def has_voices(self):
+        return any(e.kind == KIND_VOICE for e in self.elements)
+
+    def insert(self, offset, e):
+        # 同 music21 Stream.coreInsert：插入到末尾之后时保持有序 (这一步会查询并缓存 highestTime)
+        still_sorted = False
+        if self._sorted:
+            highest_time = self.highest_time()
+            if highest_time < offset or not self.elements:
+                still_sorted = True
+            elif highest_time == offset:
+                still_sorted = self.elements[-1].sort_key()[:3] <= (offset, e.sort_order, not e.grace)
+        e.offset = offset
+        e.index = next(self._counter)
+        if isinstance(e, Container):
+            e.parent = self
+        self.elements.append(e)
+        self.changed()
+        self._sorted = still_sorted
+
+    def append_unsorted(self, e):
+        # 同 music21 Stream.coreInsert 之后不调用 coreElementsChanged 的用法
+        if self._sorted:
+            self.highest_time()
+        e.index = next(self._counter)
+        self.elements.append(e)
+
+    def remove(self, e):
+        self.elements.remove(e)
+        if isinstance(e, Container):
+            e.parent = None
+        self.changed()
+
+class Part:
+    """
+    一个 Part (包含音符的一条 MIDI 轨道)。
+
+    measures (list[Container]): 小节
+    meter (list[tuple]): (offset, 小节长度) 列表，拍号变化的位置
+    name (str): 轨道名 (没有时为 None)
+    program (int): 第一个 PROGRAM_CHANGE 的音色号 (没有时为 None)
+    channels (list[int]): 音符使用的通道
+    num_notes (int): 音符数
+    """
+    def __init__(self, measures, meter, name, program, channels, num_notes):
+        self.measures = measures
+        self.meter = meter
+        self.name = name
+        self.program = program
+        self.channels = channels
+        self.num_notes = num_notes
+
+    @property
+    def has_voices(self):
+        return any(m.has_voices() for m in self.measures)
+
+    def __repr__(self):
+        return f"Part(name={self.name!r}, measures={len(self.measures)}, notes={self.num_notes})"
+
+class Score:
+    """
+    read_score 的结果。
+
+    parts (list[Part]): 同 converter.parse(...).parts (没有音符的轨道不是 Part)
+    ticks_per_quarter (int): MIDI 文件的时间精度
+    """
+    def __init__(self, parts, ticks_per_quarter):
+        self.parts = parts
+        self.ticks_per_quarter = ticks_per_quarter
+
+    def __repr__(self):
+        return f"Score(parts={len(self.parts)})"
+
+#----------------------------量化 (midiTrackToStream)----------------------------------#
+
+def __nearest_multiple(n, unit):
+    mult = math.floor(n / unit)
+    half = unit / 2.0
+    low = unit * mult
+    high = unit * (mult + 1)
+    if low <= n <= low + half:
+        return low, round(n - low, 7), round(n - low, 7)
+    return high, round(high - n, 7), round(n - high, 7)
+
+@functools.lru_cache(maxsize=1 << 16) # 同一首曲子中的 offset/时值大量重复
+def __best_match(target, divisors, zero_allowed=True, gap=0.0):
+    """
+    辅助函数：同 music21 common.numberTools.bestMatch (Duration/offset 的量化)。
+
+    Return:
+    match (float): 量化后的值
+    """
+    found = []
+    for div in divisors:
+        tick = 1 / div
+        match, error, signed_error = __nearest_multiple(target, tick)
+        if not zero_allowed and match == 0.0:
+            match = tick
+            signed_error = round(target - match, 7)
+            error = abs(signed_error)
+        remaining = 0.0 if gap % tick == 0 else max(gap - match, 0.0)
+        found.append((remaining, error, tick, match, signed_error, div))
+    return min(found)[3]
+
+def __group_chords(notes, ticks_per_quarter, divisors):
+    """
+    辅助函数：同 midiTrackToStream 把几乎同时开始的音合并为和弦。
+
+    NOTE_ON 之间、NOTE_OFF 之间相差都小于容差的音合并为一个和弦；开始时间接近但
+    结束时间不同的音不合并，并标记这条轨道需要分声部 (makeVoices)。
+
+    Return:
+    groups (list[tuple]): (第一个音的 on, 最后一个音的 on, 最后一个音的 off, 成员下标)
+    voices_required (bool)
+    """
+    tolerance = ticks_per_quarter / max(divisors)
+    on = notes['on'].tolist()
+    off = notes['off'].tolist()
+    num_notes = len(on)
+    gathered = [False] * num_notes
+    groups = []
+    voices_required = False
+    for i in range(num_notes):
+        if gathered[i]:
+            continue
+        members = [i]
+        for j in range(i + 1, num_notes):
+            if abs(on[j] - on[i]) >= tolerance:
+                break
+            if abs(off[j] - off[i]) > tolerance:
+                voices_required = True
+                continue
+            members.append(j)
+            gathered[j] = True
+        last = members[-1]
+        groups.append((on[i], on[last], off[last], members))
+    return groups, voices_required
+
+def __quantize(items, divisors):
+    """
+    辅助函数：同 Stream.quantize(processOffsets=True, processDurations=True)。
+
+    music21 按排序后的顺序逐个量化，时值量化时会参考下一个 (量化后) 位置更靠后的
+    元素 (包括 meta 元素) 到当前元素的距离。
+
+    Parameters:
+    items (list[Element]): offset 与时值为未量化的值 (offset 为 tick / ticksPerQuarter)
+    """
+    items.sort(key=lambda e: (e.offset, e.sort_order, not e.grace))
+    matches = [__best_match(float(e.offset), divisors) for e in items]
+    num_items = len(items)
+    for i, e in enumerate(items):
+        offset = opFrac(matches[i])
+        e.offset = offset
+        if e.kind == KIND_META:
+            continue
+        j = i + 1
+        while j < num_items and matches[j] <= offset:
+            j += 1
+        if j < num_items:
+            ql = __best_match(float(e.ql), divisors, e.grace, opFrac(matches[j] - offset))
+        else:
+            ql = __best_match(float(e.ql), divisors, e.grace)
+        e.ql = opFrac(ql)
+    return items
+
+def __meter_length(data):
+    # 拍号 meta 的数据：分子、分母的 2 的幂次、...
+    return opFrac(data[0] * 4 / (2 ** data[1]))
+
+#----------------------------makeMeasures / makeVoices / makeTies / makeRests----------------------------------#
+
+def __max_overlap(notes):
+    """
+    辅助函数：同 music21 Stream.getOverlaps (makeVoices 用它决定声部数)：
+    返回最大的一组相互重叠的元素的个数。
+    """
+    spans = [(n.offset, opFrac(n.offset + n.ql)) for n in notes]
+    num_notes = len(spans)
+    overlaps = [[] for _ in range(num_notes)]
+    for i in range(num_notes):
+        for j in range(i + 1, num_notes):
+            if spans[i][0] <= spans[j][0] < spans[i][1]:
+                overlaps[i].append(j)
+                overlaps[j].append(i)
+            else:
+                break
+    for indices in overlaps:
+        indices.sort()
+
+    groups = {}
+    for i, indices in enumerate(overlaps):
+        if not indices:
+            continue
+        dst = None
+        for j in indices:
+            store = True
+            for key in groups:
+                if j in groups[key]:
+                    store = False
+                    dst = key
+                    break
+            if dst is None:
+                dst = notes[i].offset
+            if store:
+                groups.setdefault(dst, []).append(j)
+        if not any(i in members for members in groups.values()):
+            if dst is None:
+                dst = notes[i].offset
+            groups.setdefault(dst, []).append(i)
+    return max([len(members) for members in groups.values()] + [1])
+
+def __make_voices(m):
+    notes = [e for e in m.sorted_elements() if e.kind in NOTE_KINDS and e.kind != KIND_REST]
+    num_voices = __max_overlap(notes)
+    if num_voices == 1:
+        return
+    voices = [Container(voice=True) for _ in range(num_voices)]
+    for e in notes:
+        for v in voices:
+            if v.highest_time() <= e.offset:
+                v.insert(e.offset, e)
+                break
+        m.remove(e)
+    for v in voices:
+        if v.elements:
+            m.insert(0.0, v)
+    m.sorted_elements()
+
+def __split(e, at):
+    """
+    辅助函数：同 music21 splitAtQuarterLength 在 at 处拆开一个元素，返回后半部分，
+    并像 music21 一样设置两部分的连音线。
+    """
+    remainder = e.copy()
+    end = e.ql
+    e.ql = opFrac(at)
+    remainder.ql = opFrac(end - e.ql)
+    if e.kind in (KIND_NOTE, KIND_UNPITCHED, KIND_CHORD):
+        first, second = [], []
+        for tie in e.ties:
+            if tie is None:
+                first.append('start')
+                second.append('stop')
+            elif tie == 'stop':
+                first.append('continue')
+                second.append('stop')
+            else: # 'start' / 'continue'
+                first.append(tie)
+                second.append('continue')
+        e.ties = first
+        remainder.ties = second
+    return remainder
+
+def __make_ties(measures, kinds):
+    """
+    辅助函数：同 music21 makeTies：把超出小节线的元素拆开，后半部分放到下一个小节
+    (需要时在末尾新建小节)。
+
+    与 music21 一样：有声部的小节只处理声部中的元素；前一个小节有声部、下一个小节
+    没有时，把下一个小节的元素移到一个新声部中；修改 Chord 的时值不会让声部的
+    highestTime 缓存失效。
+    """
+    i = 0
+    while i < len(measures):
+        m = measures[i]
+        if i + 1 < len(measures):
+            m_next = measures[i + 1]
+            m_next_new = False
+        else:
+            m_next = Container(opFrac(m.offset + m.bar_length), m.bar_length)
+            m_next_new = True
+        next_has_voices = m_next.has_voices()
+        has_voices = m.has_voices()
+        bundle = m.voices() if has_voices else [m]
+
+        for v in bundle:
+            for e in v.sorted_elements():
+                if e.kind not in kinds:
+                    continue
+                if opFrac(e.offset + e.ql) - m.bar_length <= 0 or e.offset >= m.bar_length:
+                    continue
+                remainder = __split(e, opFrac(m.bar_length - e.offset))
+                if e.kind != KIND_CHORD:
+                    v.changed()
+                if remainder.ql <= 0:
+                    continue
+
+                if next_has_voices:
+                    dst = m_next if has_voices else m_next.voices()[0]
+                elif has_voices:
+                    voice = Container(voice=True)
+                    for x in [x for x in m_next.sorted_elements() if x.kind in NOTE_KINDS]:
+                        offset = x.offset
+                        m_next.remove(x)
+                        voice.insert(offset, x)
+                    m_next.insert(0.0, voice)
+                    dst = m_next.voices()[0]
+                else:
+                    dst = m_next
+                dst.insert(0.0, remainder)
+                if m_next_new:
+                    measures.append(m_next)
+                    m_next_new = False
+        i += 1
+
+    for m in measures:
+        __flatten_unnecessary_voices(m)
+
+def __flatten_unnecessary_voices(m):
+    # 同 music21 flattenUnnecessaryVoices：删除空声部，只剩一个声部时把它的元素移回小节
+    if not m.has_voices():
+        return
+    voices = []
+    for v in m.voices():
+        if v.elements:
+            voices.append(v)
+        else:
+            m.remove(v)
+    if len(voices) == 1:
+        v = voices[0]
+        for e in v.sorted_elements():
+            m.append_unsorted(e)
+        m.remove(v)
+        m._sorted = False
+
+def __fill_rests(c, bar_length):
+    # 同 music21 makeRests(fillGaps=True, timeRangeFromBarDuration=True) 对一个容器的处理
+    lowest = c.lowest_offset()
+    highest = c.highest_time()
+    if lowest > 0:
+        c.insert(0.0, Element(0.0, opFrac(lowest), KIND_REST))
+    if bar_length - highest > 0:
+        c.insert(highest, Element(highest, opFrac(bar_length - highest), KIND_REST))
+
+    gaps = []
+    end = 0.0
+    for e in c.sorted_elements():
+        if e.offset > end:
+            gaps.append((end, opFrac(e.offset - end)))
+        end = opFrac(max(end, e.offset + e.ql))
+    for offset, ql in gaps:
+        c.insert(offset, Element(offset, ql, KIND_REST))
+
+def __make_rests(measures):
+    for m in measures:
+        m.lowest_offset()
+        m.highest_time()
+        for v in m.voices():
+            __fill_rests(v, m.bar_length)
+        __fill_rests(m, m.bar_length)
+    __make_ties(measures, (KIND_REST,))
+
+    # music21 按各小节的 highestTime 依次重新排列小节的位置
+    offset = 0.0
+    for m in measures:
+        m.offset = offset
+        offset = opFrac(offset + m.highest_time())
+
+def __meter_at(meter, offset):
+    ix = 0
+    for i, (start, _) in enumerate(meter):
+        if start <= offset:
+            ix = i
+    return ix
+
+def __make_measures(elements, meter, time_signatures):
+    """
+    辅助函数：同 music21 makeMeasures：按拍号建立小节，每个元素按开始位置放进
+    所在的小节 (不拆分；拆分由 makeTies 完成)。
+
+    Parameters:
+    elements (list[Element]): 已量化、已排序的元素，offset 为整条轨道中的位置
+    meter (list[tuple]): (offset, 小节长度)
+    time_signatures (list): 与 meter 对应的拍号数据，拍号变化的小节开头会插入它
+    """
+    highest_time = max([opFrac(e.offset + e.ql) for e in elements] + [0.0])
+    measures = []
+    offset = 0.0
+    last = None
+    while True:
+        ix = __meter_at(meter, offset)
+        m = Container(offset, meter[ix][1])
+        if ix != last:
+            m.insert(0.0, Element(0.0, 0.0, KIND_META, sort_order=__META_SORT_ORDER[smf.META_TIME_SIGNATURE],
+                                  meta=(smf.META_TIME_SIGNATURE, time_signatures[ix])))
+            last = ix
+        if not measures:
+            m.insert(0.0, Element(0.0, 0.0, KIND_META, sort_order=SORT_ORDER_CLEF))
+        measures.append(m)
+        offset = opFrac(offset + m.bar_length)
+        if offset >= highest_time:
+            break
+
+    # 小节首尾相接，元素已按 offset 排序：顺序地向后找所在的小节
+    ix = 0
+    ends = [opFrac(m.offset + m.bar_length) for m in measures]
+    for e in elements:
+        while ix < len(measures) and e.offset >= ends[ix]:
+            ix += 1
+        if ix == len(measures) or e.offset < measures[ix].offset:
+            if e.offset == opFrac(e.offset + e.ql) == highest_time:
+                continue # music21 把它放在 Stream 的末尾 (storeAtEnd)，不属于任何小节
+            raise ValueError(f"无法把 {e} 放进任何小节")
+        m = measures[ix]
+        relative = opFrac(e.offset - m.offset)
+        if relative == 0 and e.kind == KIND_META and e.meta[0] == smf.META_TIME_SIGNATURE:
+            continue # 小节开头的拍号已经在上面处理
+        m.insert(relative, e)
+    return measures
+
+#----------------------------公共函数----------------------------------#
+
+def read_score(file_path, use_mmap=False, divisors=QUANTIZE_DIVISORS):
+    """
+    读取 MIDI 文件并构建小节结构 (相当于 converter.parse(file_path)，结果与它一致)。
+
+    Parameters:
+    file_path (str): MIDI 文件路径
+    use_mmap (bool): 以内存映射方式读取文件 (见 smf.read_midi)
+    divisors (tuple[int]): 量化的细分 (同 music21 quarterLengthDivisors)
+
+    Return:
+    score (Score)
+    """
+    ticks_per_quarter, tracks = smf.read_midi(file_path, use_mmap=use_mmap)
+
+    conductor = [] # 到目前为止的 conductor 轨道中的 (量化后的 offset, meta 类型, 数据)
+    parts = []
+    for track in tracks:
+        metas = [(tick, meta_type, data) for tick, meta_type, data in track.meta
+                 if meta_type in __META_SORT_ORDER]
+        notes = track.notes
+
+        # 没有音符的轨道：只收集拍号/调号/速度，插入到 (它之后的) 每个 Part 中
+        if len(notes) == 0:
+            for tick, meta_type, data in metas:
+                if meta_type in __CONDUCTOR_META:
+                    offset = opFrac(__best_match(float(opFrac(tick / ticks_per_quarter)), divisors))
+                    conductor.append((offset, meta_type, data))
+            continue
+
+        # 1. 合并和弦，量化 (meta 元素也参与量化，它们会影响音符时值的量化)
+        groups, voices_required = __group_chords(notes, ticks_per_quarter, divisors)
+        items = [Element(opFrac(tick / ticks_per_quarter), 0.0, KIND_META,
+                         sort_order=__META_SORT_ORDER[meta_type], meta=(meta_type, data))
+                 for tick, meta_type, data in metas]
+        items += [Element(opFrac(tick / ticks_per_quarter), 0.0, KIND_META,
+                          sort_order=SORT_ORDER_INSTRUMENT, meta=('program', program))
+                  for tick, _, program in track.programs]
+
+        pitches = notes['pitch'].tolist()
+        velocities = notes['velocity'].tolist()
+        channels = notes['channel'].tolist()
+        for on, last_on, off, members in groups:
+            grace = off == last_on # 时值为 0 的音是装饰音
+            percussion = any(channels[ix] == PERCUSSION_CHANNEL for ix in members)
+            if len(members) == 1:
+                kind = KIND_UNPITCHED if percussion else KIND_NOTE
+            else:
+                kind = KIND_PERCUSSION if percussion else KIND_CHORD
+            items.append(Element(opFrac(on / ticks_per_quarter),
+                                 0.0 if grace else opFrac((off - last_on) / ticks_per_quarter),
+                                 kind,
+                                 tuple(pitches[ix] for ix in members),
+                                 tuple(velocities[ix] for ix in members),
+                                 grace=grace))
+        items = __quantize(items, divisors)
+
+        # 2. 插入 conductor 轨道的 meta 元素，确定拍号
+        items += [Element(offset, 0.0, KIND_META, sort_order=__META_SORT_ORDER[meta_type], meta=(meta_type, data))
+                  for offset, meta_type, data in conductor]
+        items.sort(key=lambda e: (e.offset, e.sort_order, not e.grace))
+
+        time_signatures = [(offset, data) for offset, meta_type, data in conductor
+                           if meta_type == smf.META_TIME_SIGNATURE]
+        if not time_signatures:
+            time_signatures = [(e.offset, e.meta[1]) for e in items
+                               if e.kind == KIND_META and e.meta[0] == smf.META_TIME_SIGNATURE]
+        time_signatures.sort(key=lambda ts: ts[0])
+        if not any(offset == 0 for offset, _ in time_signatures):
+            time_signatures.insert(0, (0.0, bytes([4, 2, 24, 8])))
+        meter = [(offset, __meter_length(data)) for offset, data in time_signatures]
+
+        # 3. 分小节、分声部、连音、补休止符
+        measures = __make_measures(items, meter, [data for _, data in time_signatures])
+        if voices_required:
+            for m in measures:
+                __make_voices(m)
+        __make_ties(measures, NOTE_KINDS)
+        __make_rests(measures)
+
+        names = [data for _, meta_type, data in metas if meta_type == smf.META_TRACK_NAME]
+        name = names[0].decode('latin-1').strip() if names else None
+        program = track.programs[0][2] if track.programs else None
+        parts.append(Part(measures, meter, name, program, sorted(set(channels)), len(notes)))
+
+    return Score(parts, ticks_per_quarter)
+
+def flatten(part):
+    """
+    同 Part.flatten()：先按小节/声部的顺序展开，再按 (offset, classSortOrder, 是否装饰音)
+    稳定排序。
+
+    Return:
+    elements (list[tuple]): (整条轨道中的 offset, Element) 列表
+    """
+    flat = []
+    for m in part.measures:
+        for e in sorted(m.elements, key=lambda e: e.sort_key()):
+            if e.kind == KIND_VOICE:
+                for x in sorted(e.elements, key=lambda e: e.sort_key()):
+                    flat.append((opFrac(m.offset + x.offset), x))
+            else:
+                flat.append((opFrac(m.offset + e.offset), e))
+    flat.sort(key=lambda item: (item[0], item[1].sort_order, not item[1].grace))
+    return flat
+
+def part_events(part):
+    """
+    一个 Part 展开后的音符/和弦/休止符 (通道 10 的打击乐除外)，作为事件数组返回。
+    连音线拆开的音保持拆开的状态 (同 flatten())。
+
+    Return:
+    part_events (np.ndarray): EVENT_DTYPE 的结构化数组 (见 events.py)
+    """
+    records = []
+    for offset, e in flatten(part):
+        if e.kind == KIND_REST:
+            records.append((-1, offset, e.ql, 0, KIND_REST))
+        elif e.kind in (KIND_NOTE, KIND_CHORD):
+            records.extend((p, offset, e.ql, v, e.kind) for p, v in zip(e.pitches, e.velocities))
+    return events.make_events(records)
+
+def __sounding(measure):
+    # 辅助函数：小节中 (包括各声部中) 的音符/和弦/休止符
+    items = []
+    for e in measure.elements:
+        if e.kind == KIND_VOICE:
+            items.extend(x for x in e.elements if x.kind in NOTE_KINDS)
+        elif e.kind in NOTE_KINDS:
+            items.append(e)
+    return items
+
+def chordify(score):
+    """
+    同 Score.chordify()：以第一个 Part 的小节为模板，逐小节把所有 Part 在每个
+    时间点 (任一音符/休止符的开始或结束) 上正在发声的音合成一个和弦 (纵向切片)；
+    没有音的切片为休止符，相邻的休止符合并。打击乐的音不参与和弦。
+
+    Return:
+    chord_events (np.ndarray): EVENT_DTYPE 的结构化数组，offset 为整首曲子中的位置；
+                               同一个和弦的各个音相邻，按音高升序排列
+    """
+    records = []
+    if not score.parts:
+        return events.make_events()
+
+    for i, template in enumerate(score.parts[0].measures):
+        items = []
+        for part in score.parts:
+            if i < len(part.measures):
+                items.extend(__sounding(part.measures[i]))
+
+        # 切片的边界 (小节中的相对位置)
+        spans = [(e.offset, opFrac(e.offset + e.ql), e) for e in items]
+        points = sorted({0.0}.union(*((start, end) for start, end, _ in spans)))
+        spans = [(start, end, e.pitches) for start, end, e in spans if e.kind in (KIND_NOTE, KIND_CHORD)]
+        spans.sort(key=lambda span: span[0])
+
+        slices = []
+        for start, end in zip(points, points[1:]):
+            if math.isclose(start, end, abs_tol=1e-7):
+                continue
+            pitches = set()
+            for s_start, s_end, s_pitches in spans:
+                if s_start > start:
+                    break
+                if s_start == start or start < s_end:
+                    pitches.update(s_pitches)
+            ql = opFrac(end - start)
+            if not pitches and slices and not slices[-1][2]:
+                slices[-1][1] = opFrac(slices[-1][1] + ql) # consolidateRests
+            else:
+                slices.append([start, ql, sorted(pitches)])
+
+        for start, ql, pitches in slices:
+            offset = opFrac(template.offset + start)
+            if pitches:
+                records.extend((p, offset, ql, 0, KIND_CHORD) for p in pitches)
+            else:
+                records.append((-1, offset, ql, 0, KIND_REST))
+    return events.make_events(records)
+
+def __grid(offsets, meter, highest_time):
+    """
+    辅助函数：同 Stream.makeMeasures() 对一个展开的 Stream：按拍号建立小节，元素按
+    开始位置放进小节 (不拆分)。
+
+    Parameters:
+    offsets (list): 按顺序排列的元素位置
+
+    Return:
+    starts (list): 每个小节的开始位置
+    placement (list[int]): 每个元素所在小节的下标 (不在任何小节中时为 None)
+    """
+    starts = []
+    ends = []
+    offset = 0.0
+    while True:
+        starts.append(offset)
+        offset = opFrac(offset + meter[__meter_at(meter, offset)][1])
+        ends.append(offset)
+        if offset >= highest_time:
+            break
+
+    placement = []
+    ix = 0
+    for offset in offsets:
+        if not starts[ix] <= offset < ends[ix]:
+            ix = next((k for k in range(len(starts)) if starts[k] <= offset < ends[k]), None)
+            if ix is None: # 超出最后一个小节 (music21 放在 Stream 的末尾)
+                placement.append(None)
+                ix = 0
+                continue
+        placement.append(ix)
+    return starts, placement
+
+def __to_measures(starts, placement, offsets, elements):
+    # 辅助函数：按 __grid 的结果创建 music21 小节 (offset 为小节中的相对位置)
+    measures = [stream.Measure(number=i + 1) for i in range(len(starts))]
+    for ix, offset, element in zip(placement, offsets, elements):
+        if ix is not None and element is not None:
+            measures[ix].coreInsert(opFrac(offset - starts[ix]), element)
+    for m in measures:
+        m.coreElementsChanged()
+    return measures
+
+def grammar_measures(score, melody_part_index):
+    """
+    为 parse_melody 构建对齐的小节，等价于原来的
+        s.parts[melody_part_index].flatten().makeMeasures() 与 s.chordify().makeMeasures()
+
+    只创建 parse_melody 用到的元素：旋律中的 Note/Rest，以及和弦分析中会被某个旋律音
+    查到的 Chord (在它之前开始的最后一个和弦，和每个小节的第一个和弦)。parse_melody
+    对这些和弦的查找结果与使用全部和弦时相同。
+
+    Return:
+    melody_measures (list[stream.Measure])
+    chord_measures (list[stream.Measure])
+    """
+    part = score.parts[melody_part_index]
+    flat = flatten(part)
+    highest_time = max([opFrac(offset + e.ql) for offset, e in flat] + [0.0])
+    flat = [(offset, e) for offset, e in flat if e.kind in (KIND_NOTE, KIND_REST)]
+    melody_offsets = [offset for offset, _ in flat]
+    melody_starts, melody_placement = __grid(melody_offsets, part.meter, highest_time)
+
+    # 和弦分析：(offset, 时值, 音高) 列表 (休止符只影响小节数)
+    chord_events = chordify(score)
+    chords = []
+    highest_time = 0.0
+    ix = 0
+    while ix < len(chord_events):
+        _, offset, ql, _, kind = chord_events[ix].item()
+        offset, ql = opFrac(offset), opFrac(ql)
+        end = ix + 1
+        if kind == KIND_CHORD:
+            while (end < len(chord_events) and chord_events[end]['kind'] == KIND_CHORD
+                   and chord_events[end]['offset'] == chord_events[ix]['offset']):
+                end += 1
+            chords.append((offset, ql, chord_events['pitch'][ix:end].tolist()))
+        highest_time = max(highest_time, opFrac(offset + ql))
+        ix = end
+    chord_offsets = [offset for offset, _, _ in chords]
+    chord_starts, chord_placement = __grid(chord_offsets, score.parts[0].meter, highest_time)
+
+    # 找出会被查到的和弦：每个小节的第一个和弦，以及每个旋律音之前的最后一个和弦
+    by_measure = {}
+    for k, ix in enumerate(chord_placement):
+        if ix is not None:
+            by_measure.setdefault(ix, []).append(k)
+    used = set(members[0] for members in by_measure.values())
+    for offset, ix in zip(melody_offsets, melody_placement):
+        if ix is None or ix not in by_measure or ix >= len(chord_starts):
+            continue
+        relative = opFrac(offset - melody_starts[ix])
+        members = by_measure[ix]
+        relative_offsets = [opFrac(chord_offsets[k] - chord_starts[ix]) for k in members]
+        pos = bisect.bisect_right(relative_offsets, relative) - 1
+        used.add(members[max(pos, 0)])
+
+    melody_elements = [note.Note(pitch.Pitch(midi=e.pitches[0]), quarterLength=e.ql) if e.kind == KIND_NOTE
+                       else note.Rest(quarterLength=e.ql) for _, e in flat]
+    chord_elements = []
+    for k, (_, ql, pitches) in enumerate(chords):
+        if k in used:
+            c = chord.Chord([pitch.Pitch(midi=p) for p in pitches])
+            c.quarterLength = ql
+            chord_elements.append(c)
+        else:
+            chord_elements.append(None)
+    return (__to_measures(melody_starts, melody_placement, melody_offsets, melody_elements),
+            __to_measures(chord_starts, chord_placement, chord_offsets, chord_elements))
+
+def benchmark_read(file_path='data/original_metheny.mid', repeats=1):
+    """
+    对比 music21 (converter.parse + chordify) 与 read_score + chordify 的耗时，
+    并检查两者 chordify 的结果是否一致。
+
+    Return:
+    results (dict): 耗时 (秒) 与是否一致
+    """
+    from music21 import converter
+
+    m21_time = direct_time = float('inf')
+    for _ in range(repeats):
+        # 先测 read_score：music21 创建的大量对象会让之后的垃圾回收变慢
+        start = time.perf_counter()
+        chord_events = chordify(read_score(file_path))
+        direct_time = min(direct_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        m21_chords = converter.parse(file_path).chordify().flatten()
+        m21_time = min(m21_time, time.perf_counter() - start)
+
+    expected = events.from_music21([(m21_chords.elementOffset(n), n) for n in m21_chords.notesAndRests])
+    identical = (len(expected) == len(chord_events)
+                 and all((expected[field] == chord_events[field]).all()
+                         for field in ('pitch', 'offset', 'duration', 'kind')))
+    print(f"{file_path}: music21 {m21_time * 1000:9.1f} ms | "
+          f"direct {direct_time * 1000:7.1f} ms | chordify 一致: {identical}")
+    return {'music21_s': m21_time, 'direct_s': direct_time, 'identical': identical}
+
+if __name__ == '__main__':
+    benchmark_read()
@@ -0,0 +1,323 @@
+'''
+smf.py
+直接读写 Standard MIDI File。
+
+写：把事件数组 (见 events.py) 一次性编码为 delta-time 轨道，
+不再经过 stream.Stream -> midi.translate.streamToMidiFile。
+
+输出与 music21 对同样的音符写出的文件逐字节一致：格式 1，一条 conductor 轨道
+(速度 + 4/4 拍号) 加一条音符轨道，ticksPerQuarter = 10080，通道 1，未设置力度的音符
+使用 music21 的默认力度 90。
+
+读：read_midi 只解析预处理需要的信息 (每条轨道的音符 on/off、拍号、速度、调号、
+音色)，音符以 NumPy 结构化数组返回，不创建任何 music21 对象 (见 score.py)。
+'''
+
+import mmap
+import time
+import numpy as np
+
+import events
+
+TICKS_PER_QUARTER = 10080 # 同 music21 defaults.ticksPerQuarter
+DEFAULT_VELOCITY = 90     # 同 music21：Volume 未设置力度时 realize 的结果
+
+# 同一 tick 上的事件顺序 (同 music21 MidiEvent.sortOrder)：NOTE_OFF, PITCH_BEND, 其他
+__ORDER_NOTE_OFF = -20
+__ORDER_PITCH_BEND = -10
+__ORDER_NOTE_ON = 0
+
+__END_OF_TRACK = b'\xff\x2f\x00'
+
+def __vlq(values):
+    """
+    辅助函数：把非负整数批量编码为 MIDI 变长数 (每个最多 4 字节)。
+
+    Return:
+    data (np.ndarray): (N, 4) uint8，右对齐的编码字节
+    mask (np.ndarray): (N, 4) bool，True 表示该字节属于编码
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if values.size and (values.min() < 0 or values.max() >= 1 << 28):
+        raise ValueError("delta time 超出 MIDI 变长数的范围 (0 <= t < 2**28)")
+
+    data = np.empty((len(values), 4), dtype=np.uint8)
+    for j in range(4):
+        data[:, 3 - j] = (values >> (7 * j)) & 0x7f
+    data[:, :3] |= 0x80
+
+    num_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    mask = np.arange(4) >= 4 - num_bytes[:, None]
+    return data, mask
+
+def __chunk(kind, body):
+    return kind + len(body).to_bytes(4, 'big') + body
+
+def __conductor_track(bpm):
+    mspq = int(round(60_000_000 / bpm)) # 每个四分音符的微秒数
+    data, mask = __vlq([TICKS_PER_QUARTER])
+    return (b'\x00\xff\x51\x03' + mspq.to_bytes(3, 'big')
+            + b'\x00\xff\x58\x04\x04\x02\x18\x08' # 4/4 拍
+            + data[mask].tobytes() + __END_OF_TRACK)
+
+def __note_track(event_arrays):
+    """
+    辅助函数：按 music21 的规则排序音符事件并编码音符轨道。
+
+    music21 先按 offset (相同时按插入顺序) 遍历元素，每个元素产生 NOTE_ON 与
+    NOTE_OFF，再按 (tick, sortOrder) 稳定排序；最后在 tick 0 补一个复位 pitch bend。
+    这里用一次 lexsort 得到同样的顺序。
+    """
+    all_events = np.concatenate(event_arrays) if len(event_arrays) else events.make_events()
+    all_events = all_events[all_events['kind'] != events.KIND_REST]
+    all_events = all_events[np.argsort(all_events['offset'], kind='stable')]
+    num_events = len(all_events)
+
+    body = b'\x00\xff\x03\x00' # 空的 SEQUENCE_TRACK_NAME
+    if num_events > 0:
+        on_ticks = np.rint(all_events['offset'] * TICKS_PER_QUARTER).astype(np.int64)
+        off_ticks = on_ticks + np.rint(all_events['duration'] * TICKS_PER_QUARTER).astype(np.int64)
+        velocity = all_events['velocity']
+        velocity = np.where(velocity > 0, velocity, DEFAULT_VELOCITY)
+
+        # 2N 个音符消息 + 1 个 pitch bend
+        messages = np.empty((2 * num_events + 1, 3), dtype=np.uint8)
+        messages[:num_events, 0] = 0x90
+        messages[:num_events, 1] = all_events['pitch']
+        messages[:num_events, 2] = velocity
+        messages[num_events:-1, 0] = 0x80
+        messages[num_events:-1, 1] = all_events['pitch']
+        messages[num_events:-1, 2] = 0
+        messages[-1] = (0xe0, 0x00, 0x40)
+
+        ticks = np.concatenate([on_ticks, off_ticks, [0]])
+        sort_order = np.concatenate([np.full(num_events, __ORDER_NOTE_ON),
+                                     np.full(num_events, __ORDER_NOTE_OFF),
+                                     [__ORDER_PITCH_BEND]])
+        sequence = np.concatenate([np.arange(num_events), np.arange(num_events), [-1]])
+        order = np.lexsort((sequence, sort_order, ticks))
+
+        ticks = ticks[order]
+        delta_data, delta_mask = __vlq(np.diff(ticks, prepend=0))
+        rows = np.concatenate([delta_data, messages[order]], axis=1)
+        mask = np.concatenate([delta_mask, np.ones((len(rows), 3), dtype=bool)], axis=1)
+        body += rows[mask].tobytes()
+
+    data, mask = __vlq([TICKS_PER_QUARTER]) # music21 在轨道末尾留出一个四分音符
+    return body + data[mask].tobytes() + __END_OF_TRACK
+
+def midi_file_bytes(event_arrays, bpm=120):
+    """
+    Parameters:
+    event_arrays (list[np.ndarray]): 事件数组列表 (见 events.py)，offset 为整首曲子中的位置；
+                                     顺序相当于插入 music21 Stream 的顺序
+                                     (只在 offset 相同时影响输出)
+    bpm (float): 速度 (四分音符每分钟)
+
+    Return:
+    data (bytes): 完整的 MIDI 文件内容
+    """
+    header = (1).to_bytes(2, 'big') + (2).to_bytes(2, 'big') + TICKS_PER_QUARTER.to_bytes(2, 'big')
+    return (__chunk(b'MThd', header)
+            + __chunk(b'MTrk', __conductor_track(bpm))
+            + __chunk(b'MTrk', __note_track(event_arrays)))
+
+def write_midi(file_path, event_arrays, bpm=120):
+    """
+    把事件数组写成 MIDI 文件 (参数同 midi_file_bytes)。
+    """
+    data = midi_file_bytes(event_arrays, bpm)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    return file_path
+
+# read_midi 返回的音符：tick 为文件中的原始时间 (未量化)，通道从 1 开始 (同 music21)
+NOTE_DTYPE = np.dtype([('on', np.int64),       # NOTE_ON 的 tick
+                       ('off', np.int64),      # 对应 NOTE_OFF 的 tick
+                       ('pitch', np.int16),    # MIDI 音高
+                       ('velocity', np.uint8), # NOTE_ON 的力度
+                       ('channel', np.uint8)]) # 通道 1-16 (10 为打击乐)
+
+# 预处理用到的 meta 事件类型
+META_TRACK_NAME = 0x03
+META_INSTRUMENT_NAME = 0x04
+META_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+
+class MidiTrack:
+    """
+    read_midi 解析出的一条轨道。
+
+    notes (np.ndarray): NOTE_DTYPE 的音符数组，按 NOTE_ON 在轨道中的顺序排列
+    meta (list[tuple]): (tick, meta 类型, 数据 bytes) 列表
+    programs (list[tuple]): (tick, 通道, 音色号) 列表 (PROGRAM_CHANGE)
+    """
+    def __init__(self, notes, meta, programs):
+        self.notes = notes
+        self.meta = meta
+        self.programs = programs
+
+    def __repr__(self):
+        return f"MidiTrack(notes={len(self.notes)}, meta={len(self.meta)}, programs={len(self.programs)})"
+
+def __read_vlq(buf, pos):
+    value = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7f)
+        if b < 0x80:
+            return value, pos
+
+def __pair_notes(timed):
+    """
+    辅助函数：把 NOTE_ON/NOTE_OFF 配对成音符 (同 music21 midi.translate.getNotesFromEvents)。
+
+    从后往前扫描，每个 NOTE_ON 与其后同一音高、同一通道的第一个 NOTE_OFF 配对
+    (velocity 为 0 的 NOTE_ON 视为 NOTE_OFF)；没有 NOTE_OFF 的 NOTE_ON 被丢弃。
+    """
+    pending = {} # (音高, 通道) -> 后面最近的 NOTE_OFF 的 tick
+    notes = []
+    for tick, is_on, pitch, channel, velocity in reversed(timed):
+        if not is_on:
+            pending[(pitch, channel)] = tick
+        else:
+            off = pending.get((pitch, channel))
+            if off is not None:
+                notes.append((tick, off, pitch, velocity, channel))
+    notes.reverse()
+    return np.array(notes, dtype=NOTE_DTYPE)
+
+def __read_track(buf, pos, end):
+    """
+    辅助函数：解析一个 MTrk chunk 的内容 (支持 running status)。
+    """
+    tick = 0
+    status = 0
+    timed = []    # (tick, 是否 NOTE_ON, 音高, 通道, 力度)
+    meta = []
+    programs = []
+    while pos < end:
+        delta, pos = __read_vlq(buf, pos)
+        tick += delta
+        if buf[pos] >= 0x80:
+            status = buf[pos]
+            pos += 1
+
+        if status == 0xff:
+            meta_type = buf[pos]
+            length, pos = __read_vlq(buf, pos + 1)
+            meta.append((tick, meta_type, bytes(buf[pos:pos + length])))
+            pos += length
+            status = 0 # meta/sysex 之后不能使用 running status
+        elif status in (0xf0, 0xf7):
+            length, pos = __read_vlq(buf, pos)
+            pos += length
+            status = 0
+        else:
+            message = status & 0xf0
+            channel = (status & 0x0f) + 1
+            if message in (0xc0, 0xd0): # 只有一个数据字节
+                if message == 0xc0:
+                    programs.append((tick, channel, buf[pos]))
+                pos += 1
+            else:
+                pitch, velocity = buf[pos], buf[pos + 1]
+                pos += 2
+                if message == 0x90 and velocity > 0:
+                    timed.append((tick, True, pitch, channel, velocity))
+                elif message in (0x80, 0x90):
+                    timed.append((tick, False, pitch, channel, 0))
+    return MidiTrack(__pair_notes(timed), meta, programs)
+
+def parse_midi(buf):
+    """
+    解析内存中的 MIDI 文件内容 (bytes、bytearray 或 mmap 都可以)。
+
+    Return:
+    ticks_per_quarter (int): 每个四分音符的 tick 数
+    tracks (list[MidiTrack]): 按文件中的顺序排列的轨道
+    """
+    if bytes(buf[:4]) != b'MThd':
+        raise ValueError("不是 MIDI 文件 (缺少 MThd 头)")
+    header_length = int.from_bytes(buf[4:8], 'big')
+    num_tracks = int.from_bytes(buf[10:12], 'big')
+    ticks_per_quarter = int.from_bytes(buf[12:14], 'big')
+    if ticks_per_quarter & 0x8000:
+        raise ValueError("不支持 SMPTE 时间格式的 MIDI 文件")
+
+    tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(buf) and len(tracks) < num_tracks:
+        kind = bytes(buf[pos:pos + 4])
+        length = int.from_bytes(buf[pos + 4:pos + 8], 'big')
+        start, pos = pos + 8, pos + 8 + length
+        if kind == b'MTrk': # 跳过未知类型的 chunk
+            tracks.append(__read_track(buf, start, min(pos, len(buf))))
+    return ticks_per_quarter, tracks
+
+def read_midi(file_path, use_mmap=False):
+    """
+    读取 MIDI 文件的音符与 meta 事件。
+
+    Parameters:
+    file_path (str): MIDI 文件路径
+    use_mmap (bool): True = 内存映射文件而不是整个读入 (适合很大的文件；
+                     返回的数组是复制出来的，不引用映射)
+
+    Return:
+    ticks_per_quarter (int): 每个四分音符的 tick 数
+    tracks (list[MidiTrack]): 按文件中的顺序排列的轨道
+    """
+    with open(file_path, 'rb') as f:
+        if not use_mmap:
+            return parse_midi(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return parse_midi(buf)
+
+def benchmark_write(num_events=(1000, 5000, 20000), bpm=130, repeats=1, seed=0):
+    """
+    对比 music21 (逐个插入 Stream + streamToMidiFile) 与 write_midi 的导出耗时，
+    并检查两者输出的字节是否一致。
+
+    Return:
+    results (list[dict]): 每个规模的耗时 (秒) 与是否一致
+    """
+    from music21 import stream, tempo, midi
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in num_events:
+        # 随机的旋律：音符与休止符，时值取 grammar 中常见的值
+        durations = rng.choice([0.25, 0.333, 0.5, 0.75, 1.0, 1.5, 2.0], size=n)
+        records = [(int(rng.integers(48, 84)) if rng.random() < 0.85 else -1,
+                    float(o), float(d), int(rng.integers(0, 128)) if rng.random() < 0.5 else 0,
+                    events.KIND_NOTE)
+                   for o, d in zip(np.cumsum(durations) - durations, durations)]
+        records = [(p, o, d, v if p >= 0 else 0, k if p >= 0 else events.KIND_REST)
+                   for p, o, d, v, k in records]
+        melody = events.make_events(records)
+
+        m21_time = direct_time = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            s = stream.Stream()
+            for offset, element in events.to_music21(melody):
+                s.insert(offset, element)
+            s.insert(0.0, tempo.MetronomeMark(number=bpm))
+            m21_bytes = midi.translate.streamToMidiFile(s).writestr()
+            m21_time = min(m21_time, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            direct_bytes = midi_file_bytes([melody], bpm)
+            direct_time = min(direct_time, time.perf_counter() - start)
+
+        results.append({'num_events': n, 'music21_s': m21_time, 'direct_s': direct_time,
+                        'identical': m21_bytes == direct_bytes})
+        print(f"{n:>6} 个事件: music21 {m21_time * 1000:9.1f} ms | "
+              f"direct {direct_time * 1000:7.2f} ms | 字节一致: {m21_bytes == direct_bytes}")
+    return results
+
+if __name__ == '__main__':
+    benchmark_write()
@@ -0,0 +1,45 @@
+'''
+test_preprocess.py
+get_musical_data 的快速解析器 (parser='fast'，score.py) 与原来的
+music21 解析 (converter.parse + chordify) 的结果对比。
+
+运行: python -m pytest -q test_preprocess.py
+'''
+import os
+
+import pytest
+
+from preprocess import get_musical_data
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def stream_signature(s):
+    """
+    把伴奏流展开成 (类型, 偏移量, 时值, 音高) 的列表，便于逐个元素比较
+    """
+    return [(type(e).__name__, float(e.offset), float(e.quarterLength),
+             tuple(p.nameWithOctave for p in e.pitches))
+            for e in s.flatten().notesAndRests]
+
+
+@pytest.mark.parametrize('data_fn', ['example.mid', 'guitar.mid', 'Piano.mid'])
+def test_fast_parser_matches_music21(data_fn):
+    path = os.path.join(DATA_DIR, data_fn)
+    # 这些文件只有一个轨道，旋律与伴奏都取第 0 轨；不使用缓存，两种 parser 都真正解析一遍
+    fast_chords, fast_grammars = get_musical_data(path, melody_part_index=0, accompaniment_part_indices=[0],
+                                                  cache_dir=None, parser='fast')
+    m21_chords, m21_grammars = get_musical_data(path, melody_part_index=0, accompaniment_part_indices=[0],
+                                                cache_dir=None, parser='music21')
+
+    assert fast_grammars == m21_grammars
+    assert stream_signature(fast_chords) == stream_signature(m21_chords)
+
+
+def test_fast_parser_produces_grammars():
+    path = os.path.join(DATA_DIR, 'example.mid')
+    _, grammars = get_musical_data(path, melody_part_index=0, accompaniment_part_indices=[0],
+                                   cache_dir=None, parser='fast')
+    assert len(grammars) > 0
+    assert all(g.strip() for g in grammars)
@@ -0,0 +1,80 @@
+'''
+test_qa.py
+prune_notes / prune_notes_arrays / prune_note_events 与原版 prune_notes
+(作用在 generate_music 传入的 stream.Voice 上) 的结果对比。
+
+运行: python -m pytest -q test_qa.py
+'''
+import random
+from itertools import zip_longest
+
+import pytest
+from music21 import note, stream
+
+import events
+from qa import prune_notes, prune_notes_arrays, prune_note_events
+
+
+def baseline_prune_notes(curr_notes):
+    """
+    原版 qa.prune_notes (遍历 __grouper 的同时 remove)。
+    Voice 的迭代基于快照，所以 remove 不会打乱配对。
+    """
+    args = [iter(curr_notes)] * 2
+    for n1, n2 in zip_longest(*args, fillvalue=None):
+        if n2 == None: # corner case: odd-length list
+            continue
+        if isinstance(n1, note.Note) and isinstance(n2, note.Note):
+            if n1.nameWithOctave == n2.nameWithOctave:
+                curr_notes.remove(n2)
+    return curr_notes
+
+
+def make_voice(names):
+    """
+    names: 'C4' 之类的音名，'R' 为休止符；每个元素时值 0.25，依次排列
+    """
+    voice = stream.Voice()
+    for ix, name in enumerate(names):
+        element = note.Rest(quarterLength=0.25) if name == 'R' else note.Note(name, quarterLength=0.25)
+        voice.insert(ix * 0.25, element)
+    return voice
+
+
+def element_names(elements):
+    return ['R' if isinstance(e, note.Rest) else e.nameWithOctave for e in elements]
+
+
+CASES = [
+    (['C4', 'C4', 'D4', 'D4'], ['C4', 'D4']),
+    (['C4', 'C4', 'D4', 'E4', 'E4', 'F4', 'G4'], ['C4', 'D4', 'E4', 'E4', 'F4', 'G4']),
+    (['C4', 'C4', 'C4', 'C4', 'C4'], ['C4', 'C4', 'C4']),
+    (['R', 'R', 'C4', 'C4'], ['R', 'R', 'C4']),
+    ([], []),
+]
+
+
+@pytest.mark.parametrize('names, expected', CASES)
+def test_prune_notes_matches_baseline_voice(names, expected):
+    assert element_names(baseline_prune_notes(make_voice(names))) == expected
+    assert element_names(prune_notes(list(make_voice(names)))) == expected
+
+
+def test_prune_notes_random_measures():
+    rng = random.Random(0)
+    for _ in range(200):
+        names = [rng.choice(['R', 'C4', 'D4', 'E4']) for _ in range(rng.randrange(12))]
+        expected = element_names(baseline_prune_notes(make_voice(names)))
+
+        assert element_names(prune_notes(list(make_voice(names)))) == expected
+
+        pitches = [-1 if name == 'R' else note.Note(name).pitch.midi for name in names]
+        keep = prune_notes_arrays(pitches)
+        assert [name for name, kept in zip(names, keep) if kept] == expected
+
+        curr_events = events.make_events(
+            (pitch, ix * 0.25, 0.25, 0 if pitch < 0 else 100,
+             events.KIND_REST if pitch < 0 else events.KIND_NOTE)
+            for ix, pitch in enumerate(pitches))
+        pruned = prune_note_events(curr_events)
+        assert pruned['pitch'].tolist() == [pitch for pitch, kept in zip(pitches, keep) if kept]